@@ -1,11 +1,20 @@
-from fastapi import FastAPI, HTTPException, Depends
+from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from typing import List, Optional
 import asyncpg # Using asyncpg for async database operations
+import asyncio
 import os
+import sys
 from dotenv import load_dotenv
 
+# Shared cache modules live next to flask_pos_server.py in the project root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from stock_cache import StockSnapshotCache, REFRESH_INTERVAL, STOCK_CHANNEL, decode_movements
+from search_index import NgramIndex, BarcodeIndex, build_catalog_docs
+from price_cache import PriceCache, PRICE_QUERY
+from image_store import derivative_url
+
 # Load environment variables from .env.development
 load_dotenv(dotenv_path='.env.development')
 
@@ -44,6 +53,119 @@ app.add_middleware(
 # Global connection pool for asyncpg
 pool = None
 
+# Stock snapshots per (whcode, loccode), refreshed in the background and patched from NOTIFY
+stock_snapshots = StockSnapshotCache(refresh_interval=REFRESH_INTERVAL)
+_snapshot_locks = {}
+_listener_conn = None
+_background_tasks = []
+
+async def _load_stock_snapshot(whcode, loccode):
+    """Run the SML stock function once for a warehouse/location"""
+    async with pool.acquire() as conn:
+        return await conn.fetch(
+            """
+            SELECT a.ic_code, a.ic_name, a.ic_unit_code, a.balance_qty, p.url_image
+            FROM sml_ic_function_stock_balance_warehouse_location('2099-12-31', '', $1, $2) a
+            LEFT JOIN product_image p ON p.ic_code = a.ic_code AND p.line_number = 1
+            """,
+            whcode, loccode
+        )
+
+async def get_stock_snapshot(whcode, loccode):
+    """Stock snapshot for a warehouse/location; concurrent misses share one load"""
+    snapshot = stock_snapshots.get(whcode, loccode)
+    if snapshot is not None:
+        return snapshot
+    lock = _snapshot_locks.setdefault((whcode, loccode), asyncio.Lock())
+    async with lock:
+        snapshot = stock_snapshots.get(whcode, loccode)
+        if snapshot is None:
+            snapshot = stock_snapshots.put(whcode, loccode, await _load_stock_snapshot(whcode, loccode))
+        return snapshot
+
+# Search index over item code, name and barcodes, plus the exact barcode lookup used by scanners;
+# both are re-synced every CATALOG_INDEX_REFRESH_SECONDS
+catalog_index = NgramIndex()
+barcode_index = BarcodeIndex()
+CATALOG_REFRESH_INTERVAL = int(os.getenv("CATALOG_INDEX_REFRESH_SECONDS", 300))
+
+async def refresh_catalog_index():
+    async with pool.acquire() as conn:
+        item_rows = await conn.fetch("SELECT code, name_1 FROM ic_inventory")
+        barcode_rows = await conn.fetch("SELECT ic_code, barcode, unit_code FROM ic_inventory_barcode")
+    barcode_index.load(barcode_rows)
+    changed, removed = catalog_index.sync(build_catalog_docs(item_rows, barcode_rows))
+    if changed or removed:
+        print(f"Search index synced: {changed} items (re)indexed, {removed} removed")
+
+async def _refresh_catalog_index_loop():
+    while True:
+        try:
+            await refresh_catalog_index()
+        except Exception as e:
+            print(f"Error refreshing search index: {e}")
+        await asyncio.sleep(CATALOG_REFRESH_INTERVAL)
+
+# Effective prices, bulk-loaded and valid until the next from_date/to_date boundary
+price_cache = PriceCache()
+_price_lock = asyncio.Lock()
+
+async def refresh_prices():
+    # After a failed reload, requests skip the lock and the query until the retry delay has passed
+    if not price_cache.reload_due():
+        return
+    async with _price_lock:
+        if not price_cache.reload_due():
+            return
+        try:
+            async with pool.acquire() as conn:
+                rows = await conn.fetch(PRICE_QUERY)
+        except Exception as e:
+            price_cache.reload_failed(e)
+            return
+        price_cache.load(rows)
+
+def _on_stock_movement(connection, pid, channel, payload):
+    try:
+        stock_snapshots.apply_movements(decode_movements(payload))
+    except ValueError as e:
+        print(f"Warning: Ignoring malformed stock movement payload: {e}")
+
+async def _listen_for_stock_movements():
+    """(Re)connect the dedicated LISTEN connection; snapshots are dropped once a reconnect succeeded"""
+    global _listener_conn
+    if _listener_conn is not None and not _listener_conn.is_closed():
+        return
+    conn = await asyncpg.connect(
+        user=DATABASE_CONFIG["user"],
+        password=DATABASE_CONFIG["password"],
+        host=DATABASE_CONFIG["host"],
+        port=DATABASE_CONFIG["port"],
+        database=DATABASE_CONFIG["database"],
+    )
+    try:
+        await conn.add_listener(STOCK_CHANNEL, _on_stock_movement)
+    except Exception:
+        await conn.close()
+        raise
+    # Movements sent while the old connection was down were missed; until now the stale snapshots stayed in use
+    if _listener_conn is not None:
+        stock_snapshots.invalidate_all()
+    _listener_conn = conn
+
+async def _refresh_stock_snapshots():
+    while True:
+        await asyncio.sleep(stock_snapshots.refresh_interval)
+        try:
+            await _listen_for_stock_movements()
+        except Exception as e:
+            print(f"Warning: Stock movement listener unavailable: {e}")
+        for whcode, loccode in stock_snapshots.keys_to_refresh():
+            try:
+                stock_snapshots.put(whcode, loccode, await _load_stock_snapshot(whcode, loccode))
+            except Exception as e:
+                print(f"Error refreshing stock snapshot {whcode}/{loccode}: {e}")
+
 @app.on_event("startup")
 async def startup_event():
     global pool
@@ -59,6 +181,12 @@ async def startup_event():
             max_size=20
         )
         print("Check Price API database connection pool created successfully")
+        try:
+            await _listen_for_stock_movements()
+        except Exception as e:
+            print(f"Warning: Stock movement listener unavailable: {e}")
+        _background_tasks.append(asyncio.create_task(_refresh_stock_snapshots()))
+        _background_tasks.append(asyncio.create_task(_refresh_catalog_index_loop()))
     except Exception as e:
         print(f"Warning: Check Price API could not connect to database: {e}")
         print("Check Price API will start without database connection")
@@ -67,17 +195,14 @@ async def startup_event():
 @app.on_event("shutdown")
 async def shutdown_event():
     global pool
+    for task in _background_tasks:
+        task.cancel()
+    if _listener_conn is not None and not _listener_conn.is_closed():
+        await _listener_conn.close()
     if pool:
         print("Shutting down Check Price API... Closing database connection pool")
         await pool.close()
 
-# Dependency to get a database connection
-async def get_db():
-    if not pool:
-        raise HTTPException(status_code=503, detail="Database not available for Check Price API")
-    async with pool.acquire() as connection:
-        yield connection
-
 # Pydantic model for product response
 class Product(BaseModel):
     item_code: str
@@ -85,6 +210,7 @@ class Product(BaseModel):
     price: float
     unit_code: str
     url_image: Optional[str] = None
+    url_image_medium: Optional[str] = None
     stock_quantity: int
     barcode: Optional[str] = None
 
@@ -92,83 +218,93 @@ class Product(BaseModel):
 async def check_price_product(
     search: str,
     whcode: str = "1301",
-    loccode: str = "130101",
-    db: asyncpg.Connection = Depends(get_db)
+    loccode: str = "130101"
 ):
     """
     API endpoint to check product price by item code or name.
     """
     if not search.strip():
-        print(f"DEBUG: Received empty search term.") # Debug log
         raise HTTPException(status_code=400, detail="Search term cannot be empty")
 
-    print(f"DEBUG: Received search request - search='{search}', whcode='{whcode}', loccode='{loccode}'") # Debug log
+    if not pool:
+        raise HTTPException(status_code=503, detail="Database not available for Check Price API")
 
     try:
         # Use the search term directly for barcode exact match
         search_term_exact = search.strip()
-        # Use a pattern for name/code partial match
-        search_pattern_like = f"%{search_term_exact}%"
-
-        query = """
-            WITH found_product AS (
-                SELECT
-                    a.ic_code,
-                    a.ic_name,
-                    a.ic_unit_code,
-                    a.balance_qty
-                FROM
-                    sml_ic_function_stock_balance_warehouse_location('2099-12-31', '', $1, $2) a
-                LEFT JOIN
-                    ic_inventory_barcode b ON a.ic_code = b.ic_code
-                WHERE
-                    (a.ic_name ILIKE $3 OR a.ic_code ILIKE $3 OR b.barcode = $4)
-                    AND a.balance_qty > 0
-                LIMIT 1
+        needle = search_term_exact.lower()
+
+        snapshot = await get_stock_snapshot(whcode, loccode)
+
+        found = None
+
+        # Scanner fast path: exact barcode hit resolved entirely from memory. A scanned
+        # barcode names one item, so when it is out of stock nothing is returned rather
+        # than whatever the fuzzy search would match
+        barcode_hit = barcode_index.lookup(search_term_exact)
+        if barcode_hit is not None:
+            row = snapshot.items.get(barcode_hit[0])
+            if row is None or row["balance_qty"] <= 0:
+                return []
+            found = row
+        elif catalog_index.loaded:
+            # Best in-stock hit: exact code/barcode first, then prefixes, then other matches
+            best = min(
+                ((rank, snapshot.items[code]["ic_name"] or "", code)
+                 for code, rank in catalog_index.search(search_term_exact).items()
+                 if code in snapshot.items and snapshot.items[code]["balance_qty"] > 0),
+                default=None
             )
-            SELECT
-                fp.ic_code as item_code,
-                fp.ic_name as item_name,
-                fp.ic_unit_code as unit_code,
-                fp.balance_qty as stock_quantity,
-                (SELECT barcode FROM ic_inventory_barcode WHERE ic_code = fp.ic_code LIMIT 1) as barcode,
-                COALESCE((SELECT sale_price1 FROM ic_inventory_price
-                          WHERE current_date BETWEEN from_date AND to_date
-                          AND currency_code ='02'
-                          AND ic_code=fp.ic_code
-                          AND unit_code=fp.ic_unit_code
-                          AND cust_group_1='101'
-                          ORDER BY roworder DESC LIMIT 1), 0) as price,
-                (SELECT url_image FROM product_image WHERE ic_code = fp.ic_code AND line_number = 1) as url_image
-            FROM
-                found_product fp;
-        """
-        
-        query_params = (whcode, loccode, search_pattern_like, search_term_exact)
-
-        print(f"DEBUG: Executing SQL query:\n{query}")
-        print(f"DEBUG: With parameters: whcode='{whcode}', loccode='{loccode}', search_pattern_like='{search_pattern_like}', search_term_exact='{search_term_exact}'")
-
-        rows = await db.fetch(query, *query_params)
-        
-        print(f"DEBUG: Raw database result (rows): {rows}")
-
-        if not rows:
-            print(f"DEBUG: No product found for search='{search}'")
+            if best is not None:
+                found = snapshot.items[best[2]]
+        else:
+            # Index not built yet: substring match over the snapshot, then exact barcode
+            found = next(
+                (row for row in snapshot.in_stock()
+                 if needle in (row["ic_name"] or "").lower() or needle in row["ic_code"].lower()),
+                None
+            )
+            if found is None:
+                async with pool.acquire() as db:
+                    barcode_codes = await db.fetch(
+                        "SELECT ic_code FROM ic_inventory_barcode WHERE barcode = $1", search_term_exact
+                    )
+                for barcode_row in barcode_codes:
+                    row = snapshot.items.get(barcode_row["ic_code"])
+                    if row is not None and row["balance_qty"] > 0:
+                        found = row
+                        break
+
+        if found is None:
             return []
 
+        await refresh_prices()
+        # Priced in the stock unit, the unit stock_quantity is counted in, whichever barcode was scanned
+        unit_code = found["ic_unit_code"]
+        price = price_cache.price(found["ic_code"], unit_code) or 0
+
+        if barcode_hit is not None and barcode_hit[0] == found["ic_code"]:
+            barcode = search_term_exact
+        elif barcode_index.loaded:
+            barcode = barcode_index.first_barcode(found["ic_code"])
+        else:
+            async with pool.acquire() as db:
+                barcode = await db.fetchval(
+                    "SELECT barcode FROM ic_inventory_barcode WHERE ic_code = $1 LIMIT 1", found["ic_code"]
+                )
+
         products = [
             Product(
-                item_code=row["item_code"],
-                item_name=row["item_name"],
-                price=float(row["price"]),
-                unit_code=row["unit_code"],
-                url_image=row["url_image"],
-                stock_quantity=int(row["stock_quantity"]),
-                barcode=row["barcode"]
-            ) for row in rows
+                item_code=found["ic_code"],
+                item_name=found["ic_name"],
+                price=float(price),
+                unit_code=unit_code,
+                url_image=found.get("url_image"),
+                url_image_medium=derivative_url(found.get("url_image"), "medium"),
+                stock_quantity=int(found["balance_qty"]),
+                barcode=barcode
+            )
         ]
-        print(f"DEBUG: Found product(s): {products}")
         return products
 
     except Exception as e:
@@ -1,11 +1,29 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, Header, HTTPException, Request, Response
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from typing import List, Optional
-import psycopg2
-import psycopg2.pool
-from datetime import datetime, date
+import json
+from datetime import datetime, date, timedelta
 import os
+import sys
+import threading
+import time
+
+# Shared modules live next to flask_pos_server.py in the project root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from stock_cache import notify_stock_movements
+from doc_numbers import DocNumberAllocator
+from db_pool import ConnectionPool, PoolTimeout
+from pagination import encode_cursor, decode_cursor
+from reference_data import ReferenceDataCache, etag_matches
+from streaming import stream_format, stream_rows, mimetype
+import idempotency
+from psycopg2.extras import execute_values
+from stock_history import (
+    latest_snapshot_dates, balance_source, balances_at, take_snapshot, repair_stale_snapshots, ensure_tables
+)
 
 # Database connection configuration
 DATABASE_CONFIG = {
@@ -39,21 +57,54 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-After", idempotency.REPLAYED_HEADER],
 )
 
+# Transfer list page size when neither `date` nor `limit` is given, and the largest page allowed
+TRANSFER_PAGE_SIZE = 100
+TRANSFER_MAX_PAGE_SIZE = 1000
+
+# Most detail lines accepted by one POST /api/transfers/bulk
+BULK_TRANSFER_MAX_LINES = int(os.getenv("BULK_TRANSFER_MAX_LINES", 5000))
+
 # Global connection pool
 connection_pool = None
 
+# Transfer numbers come from blocks reserved in pos_doc_sequence (see doc_numbers.py)
+doc_numbers = None
+
+# Warehouses, shelves and units are served from memory with an ETag (see reference_data.py)
+reference_data = None
+
 @app.on_event("startup")
 async def startup_event():
-    global connection_pool
+    global connection_pool, doc_numbers, reference_data
     try:
         print("Starting up... Creating database connection pool")
-        connection_pool = psycopg2.pool.SimpleConnectionPool(
-            1, 20,  # min and max connections
-            **DATABASE_CONFIG
+        # Endpoints are plain `def`, so FastAPI runs them in its worker threadpool and a slow
+        # query no longer blocks the event loop; when every connection is busy a request
+        # waits up to DB_POOL_WAIT_TIMEOUT seconds for one instead of failing immediately
+        connection_pool = ConnectionPool(
+            DATABASE_CONFIG,
+            minconn=int(os.getenv("DB_POOL_MIN", 1)),
+            maxconn=int(os.getenv("DB_POOL_MAX", 20)),
+            wait_timeout=float(os.getenv("DB_POOL_WAIT_TIMEOUT", 10)),
         )
+        connection_pool.prewarm()
+        doc_numbers = DocNumberAllocator(connection_pool, {"FR": ("FR", 124)})
+        reference_data = ReferenceDataCache(connection_pool)
+        reference_data.start_refresh_thread()
         print("Database connection pool created successfully")
+        try:
+            _run_with_connection(ensure_tables)
+        except Exception as e:
+            print(f"Warning: Could not create stock snapshot tables: {e}")
+        try:
+            _run_with_connection(idempotency.ensure_table)
+        except Exception as e:
+            print(f"Warning: Could not create idempotency key table: {e}")
+        if STOCK_SNAPSHOT_HOUR >= 0:
+            threading.Thread(target=_stock_snapshot_loop, name="stock-snapshot", daemon=True).start()
     except Exception as e:
         print(f"Warning: Could not connect to database: {e}")
         print("Server will start without database connection")
@@ -63,9 +114,87 @@ async def startup_event():
 async def shutdown_event():
     global connection_pool
     if connection_pool:
+        # Hand unused reserved transfer numbers back so a restart does not leave a gap
+        doc_numbers.release()
         print("Shutting down... Closing database connection pool")
         connection_pool.closeall()
 
+# Hour of the day (server time) at which yesterday's closing stock balances are snapshotted; -1 disables
+STOCK_SNAPSHOT_HOUR = int(os.getenv("STOCK_SNAPSHOT_HOUR", 1))
+# Only one process takes the nightly snapshot when several run this service
+STOCK_SNAPSHOT_LOCK_ID = 730117
+
+def _run_with_connection(callback):
+    connection = connection_pool.getconn()
+    try:
+        with connection.cursor() as cursor:
+            callback(cursor)
+        connection.commit()
+    finally:
+        connection_pool.putconn(connection)
+
+def _take_stock_snapshot(day=None, repair=False):
+    """Snapshot `day` (default yesterday) unless another process is already doing it
+
+    With repair=True, snapshots made stale by back-dated or cancelled documents
+    are re-taken first.
+    """
+    connection = connection_pool.getconn()
+    try:
+        connection.autocommit = True
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_try_advisory_lock(%s)", (STOCK_SNAPSHOT_LOCK_ID,))
+            if not cursor.fetchone()[0]:
+                return None
+        try:
+            connection.autocommit = False
+            if repair:
+                retaken, dropped = repair_stale_snapshots(connection)
+                if retaken or dropped:
+                    print(f"Stale stock snapshots: {retaken} re-taken, {dropped} dropped")
+            return take_snapshot(connection, day)
+        finally:
+            connection.autocommit = True
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT pg_advisory_unlock(%s)", (STOCK_SNAPSHOT_LOCK_ID,))
+    finally:
+        connection_pool.putconn(connection)
+
+def _stock_snapshot_loop():
+    while True:
+        now = datetime.now()
+        next_run = now.replace(hour=STOCK_SNAPSHOT_HOUR, minute=0, second=0, microsecond=0)
+        if next_run <= now:
+            next_run += timedelta(days=1)
+        time.sleep((next_run - now).total_seconds())
+        try:
+            written = _take_stock_snapshot(repair=True)
+            if written is not None:
+                print(f"Stock snapshot taken for {written} locations")
+        except Exception as e:
+            print(f"Error taking stock snapshot: {e}")
+
+def acquire_connection():
+    """Check out a pooled connection, answering 503 if none frees up in time"""
+    try:
+        return connection_pool.getconn()
+    except PoolTimeout:
+        raise HTTPException(status_code=503, detail="Database busy, please retry")
+
+def streamed_response(request, stream, query, params=None):
+    """StreamingResponse of the query rows when ?stream=json|ndjson (or Accept: application/x-ndjson) asks for it, else None"""
+    fmt = stream_format(stream, request.headers.get("accept", ""))
+    if fmt is None:
+        return None
+    try:
+        chunks = stream_rows(connection_pool, query, params, fmt)
+    except PoolTimeout:
+        raise HTTPException(status_code=503, detail="Database busy, please retry")
+    except Exception as e:
+        print(f"Error starting streamed query: {e}")
+        raise HTTPException(status_code=500, detail="Internal Server Error")
+    return StreamingResponse(chunks, media_type=mimetype(fmt))
+
 # Pydantic models for request/response
 class LoginRequest(BaseModel):
     code: str
@@ -84,10 +213,12 @@ async def root():
 @app.get("/health")
 async def health_check():
     """Health check endpoint"""
-    return {"status": "healthy", "database": "connected" if connection_pool else "disconnected"}
+    if not connection_pool:
+        return {"status": "healthy", "database": "disconnected"}
+    return {"status": "healthy", "database": "connected", "db_pool": connection_pool.stats()}
 
 @app.post("/api/login", response_model=LoginResponse)
-async def login(request: LoginRequest):
+def login(request: LoginRequest):
     """
     User login endpoint
     
@@ -100,9 +231,8 @@ async def login(request: LoginRequest):
     if not connection_pool:
         raise HTTPException(status_code=503, detail="Database not available")
     
-    connection = None
+    connection = acquire_connection()
     try:
-        connection = connection_pool.getconn()
         cursor = connection.cursor()
         
         query = """
@@ -138,21 +268,24 @@ async def login(request: LoginRequest):
             connection_pool.putconn(connection)
 
 @app.get("/api/transactions")
-async def get_transactions():
+def get_transactions(request: Request, stream: Optional[str] = None):
     """Get transaction data"""
     if not connection_pool:
         raise HTTPException(status_code=503, detail="Database not available")
+
+    query = """
+    SELECT item_code, item_name, qty, unit_code, trans_flag 
+    FROM ic_trans_detail 
+    LIMIT 20
+    """
+    streamed = streamed_response(request, stream, query)
+    if streamed is not None:
+        return streamed
     
-    connection = None
+    connection = acquire_connection()
     try:
-        connection = connection_pool.getconn()
         cursor = connection.cursor()
         
-        query = """
-        SELECT item_code, item_name, qty, unit_code, trans_flag 
-        FROM ic_trans_detail 
-        LIMIT 20
-        """
         cursor.execute(query)
         results = cursor.fetchall()
         
@@ -168,82 +301,105 @@ async def get_transactions():
             connection_pool.putconn(connection)
 
 @app.get("/api/analysis-data")
-async def get_analysis_data(
+def get_analysis_data(
     doc_date: Optional[str] = None,
     wh_code: Optional[str] = None,
     user_wh_code: Optional[str] = None,
     limit: int = 20,
     offset: int = 0
 ):
-    """Get analysis data for inventory"""
+    """Get analysis data for inventory (limit=0 returns every row, e.g. for export)"""
     if not connection_pool:
         raise HTTPException(status_code=503, detail="Database not available")
+
+    try:
+        report_date = date.fromisoformat(doc_date) if doc_date else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="doc_date must be YYYY-MM-DD")
     
-    connection = None
+    connection = acquire_connection()
     try:
-        connection = connection_pool.getconn()
         cursor = connection.cursor()
         
-        current_date = f"'{doc_date}'" if doc_date else 'CURRENT_DATE'
-        previous_date = f"'{doc_date}'::date - 1" if doc_date else 'CURRENT_DATE - 1'
-        
         # Use user's warehouse or default to '1301' for main data
         user_warehouse = user_wh_code if user_wh_code else '1301'
         
         # Use selected warehouse for comparison or default to '1302'
         compare_warehouse = wh_code if wh_code else '1302'
-        
+
+        user_location_code = user_warehouse + '01' if len(user_warehouse) >= 4 else '130101'
+        compare_location_code = compare_warehouse + '01' if len(compare_warehouse) >= 4 else '130101'
+
         # Check if there are sales for the date
-        sales_check_query = f"SELECT 1 FROM ic_trans_detail WHERE doc_date = {current_date} LIMIT 1"
-        cursor.execute(sales_check_query)
-        sales_check_result = cursor.fetchone()
+        cursor.execute(
+            """
+            SELECT d, EXISTS (SELECT 1 FROM ic_trans_detail WHERE doc_date = d)
+            FROM (SELECT COALESCE(%s::date, CURRENT_DATE) AS d) r
+            """,
+            (report_date,)
+        )
+        report_day, has_sales = cursor.fetchone()
         
-        if not sales_check_result:
+        if not has_sales:
             return []
-        
+
+        user_location = (user_warehouse, user_location_code)
+        compare_location = (compare_warehouse, compare_location_code)
+        start_day = report_day - timedelta(days=1)
+        start_snapshots = {}
+        if start_day < date.today():
+            try:
+                start_snapshots = latest_snapshot_dates(cursor, start_day, [user_location])
+            except Exception as e:
+                connection.rollback()
+                print(f"Warning: Stock snapshots unavailable, using the stock function: {e}")
+
+        # The start-of-day balance is a past day, so it can come from the latest daily
+        # snapshot plus the movements since. The report-day balances always use one
+        # stock function call per warehouse/location, joined on ic_code instead of
+        # re-running the function per output row. Items missing from the comparison
+        # location keep balance_qty_compare NULL, as the old per-row subquery returned
+        start_sql, params = balance_source("s_", start_day, *user_location, start_snapshots.get(user_location))
+        current_sql, current_params = balance_source("c_", report_day, *user_location)
+        compare_sql, compare_params = balance_source("x_", report_day, *compare_location)
+        params.update(current_params)
+        params.update(compare_params)
+        params.update(report_day=report_day, user_wh=user_warehouse)
+
         query = f"""
         WITH StockBalances AS (
-            SELECT ic_code, ic_name, ic_unit_code, warehouse, balance_qty AS balance_qty_start
-            FROM sml_ic_function_stock_balance_warehouse_location({previous_date}, '', %s, %s)
+            SELECT ic_code, ic_name, ic_unit_code, balance_qty AS balance_qty_start
+            FROM ({start_sql}) s
             WHERE balance_qty > 0
         ),
         SalesData AS (
             SELECT item_code, SUM(qty) AS sale_qty
             FROM ic_trans_detail
-            WHERE trans_flag IN (44) AND doc_date = {current_date} AND wh_code = %s
+            WHERE trans_flag IN (44) AND doc_date = %(report_day)s AND wh_code = %(user_wh)s
             GROUP BY item_code
+        ),
+        CurrentBalances AS (
+            SELECT ic_code, balance_qty FROM ({current_sql}) c
+        ),
+        CompareBalances AS (
+            SELECT ic_code, COALESCE(balance_qty, 0) AS balance_qty FROM ({compare_sql}) x
         )
         SELECT
-            {current_date} as doc_date, a.ic_code as item_code, a.ic_name as item_name, a.ic_unit_code as unit_code,
+            %(report_day)s::date as doc_date, a.ic_code as item_code, a.ic_name as item_name, a.ic_unit_code as unit_code,
             round(a.balance_qty_start, 2) as balance_qty_start, COALESCE(b.sale_qty, 0) AS sale_qty,
-            (SELECT round(balance_qty, 2) FROM sml_ic_function_stock_balance_warehouse_location({current_date}, a.ic_code, %s, %s)) AS balance_qty,
-            (SELECT COALESCE(round(balance_qty, 2), 0) FROM sml_ic_function_stock_balance_warehouse_location({current_date}, a.ic_code, %s, %s)) AS balance_qty_compare
+            round(c.balance_qty, 2) AS balance_qty,
+            round(d.balance_qty, 2) AS balance_qty_compare
         FROM StockBalances a
         LEFT JOIN SalesData b ON a.ic_code = b.item_code
+        LEFT JOIN CurrentBalances c ON a.ic_code = c.ic_code
+        LEFT JOIN CompareBalances d ON a.ic_code = d.ic_code
         ORDER BY a.ic_code ASC
-        LIMIT %s OFFSET %s
         """
-        
-        # Parameters for the query:
-        # 1. user_warehouse for StockBalances CTE
-        # 2. location code for user warehouse
-        # 3. user_warehouse for SalesData WHERE clause
-        # 4. user_warehouse for balance_qty subquery
-        # 5. location code for user warehouse
-        # 6. compare_warehouse for balance_qty_compare subquery
-        # 7. location code for compare warehouse
-        # 8. limit
-        # 9. offset
-        
-        user_location_code = user_warehouse + '01' if len(user_warehouse) >= 4 else '130101'
-        compare_location_code = compare_warehouse + '01' if len(compare_warehouse) >= 4 else '130101'
-        cursor.execute(query, (
-            user_warehouse, user_location_code,
-            user_warehouse,
-            user_warehouse, user_location_code,
-            compare_warehouse, compare_location_code,
-            limit, offset
-        ))
+        if limit > 0:
+            query += " LIMIT %(limit)s OFFSET %(offset)s"
+            params.update(limit=limit, offset=offset)
+
+        cursor.execute(query, params)
         results = cursor.fetchall()
         
         columns = [desc[0] for desc in cursor.description]
@@ -256,6 +412,53 @@ async def get_analysis_data(
         if connection:
             connection_pool.putconn(connection)
 
+@app.post("/api/stock-snapshots")
+def create_stock_snapshot(snapshot_date: Optional[str] = None):
+    """Snapshot closing stock balances of a past day (default yesterday) on demand"""
+    if not connection_pool:
+        raise HTTPException(status_code=503, detail="Database not available")
+
+    try:
+        day = date.fromisoformat(snapshot_date) if snapshot_date else None
+        written = _take_stock_snapshot(day)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except PoolTimeout:
+        raise HTTPException(status_code=503, detail="Database busy, please retry")
+    except Exception as e:
+        print(f"Error taking stock snapshot: {e}")
+        raise HTTPException(status_code=500, detail="Internal Server Error")
+
+    if written is None:
+        raise HTTPException(status_code=409, detail="A stock snapshot is already running")
+    return {"snapshot_date": (day or date.today() - timedelta(days=1)).isoformat(), "locations": written}
+
+@app.get("/api/stock-balance")
+def get_stock_balance(wh_code: str, shelf_code: str, balance_date: Optional[str] = None):
+    """Closing balances of a warehouse/location at a date; past days come from the latest snapshot plus later movements"""
+    if not connection_pool:
+        raise HTTPException(status_code=503, detail="Database not available")
+
+    try:
+        day = date.fromisoformat(balance_date) if balance_date else date.today()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="balance_date must be YYYY-MM-DD")
+
+    connection = acquire_connection()
+    try:
+        cursor = connection.cursor()
+        rows = balances_at(cursor, day, wh_code, shelf_code)
+        return [
+            {"item_code": row[0], "item_name": row[1], "unit_code": row[2], "balance_qty": row[3]}
+            for row in rows if row[3]
+        ]
+    except Exception as e:
+        print(f"Error fetching stock balance for {wh_code}/{shelf_code}: {e}")
+        raise HTTPException(status_code=500, detail="Internal Server Error")
+    finally:
+        if connection:
+            connection_pool.putconn(connection)
+
 class TransferDetail(BaseModel):
     item_code: str
     item_name: str
@@ -267,7 +470,6 @@ class TransferDetail(BaseModel):
     shelf_code_2: str
 
 class TransferRequest(BaseModel):
-    transfer_no: str
     creator: str
     wh_from: str
     location_from: str
@@ -275,110 +477,118 @@ class TransferRequest(BaseModel):
     location_to: str
     details: List[TransferDetail]
 
-@app.get("/api/generate-transfer-no")
-async def generate_transfer_no():
-    """Generate new transfer number with format FR{YYMM}{sequential}"""
+class BulkTransfer(BaseModel):
+    wh_from: str
+    location_from: str
+    wh_to: str
+    location_to: str
+    details: List[TransferDetail]
+    ref: Optional[str] = None  # client's own reference, echoed back in the results
+
+class BulkTransferRequest(BaseModel):
+    creator: str
+    transfers: List[BulkTransfer]
+
+TRANSFER_HEADER_INSERT = """
+    INSERT INTO ic_trans (
+        trans_type, trans_flag, doc_date, doc_no, doc_ref, doc_ref_date,
+        branch_code, project_code, sale_code, remark, doc_time, doc_format_code,
+        wh_from, location_from, wh_to, location_to, creator_code,
+        create_datetime, last_editor_code, lastedit_datetime
+    ) VALUES %s
+"""
+
+TRANSFER_DETAIL_INSERT = """
+    INSERT INTO ic_trans_detail (
+        trans_type, trans_flag, doc_date, doc_no, item_code, item_name,
+        unit_code, qty, branch_code, wh_code, shelf_code, wh_code_2,
+        shelf_code_2, stand_value, divide_value, doc_time, sale_code,
+        create_datetime, last_editor_code, lastedit_datetime
+    ) VALUES %s
+"""
+
+def idempotent_replay(stored):
+    """The stored response of an earlier request with the same Idempotency-Key"""
+    status_code, response_text = stored
+    return Response(content=response_text, status_code=status_code, media_type="application/json",
+                    headers={idempotency.REPLAYED_HEADER: "true"})
+
+@app.post("/api/transfers")
+def create_transfer(request: TransferRequest, idempotency_key: Optional[str] = Header(None, alias=idempotency.HEADER)):
+    """Create a new transfer
+
+    The transfer number is allocated by the server and returned as
+    transfer_no. With an Idempotency-Key header a retried request gets the first
+    request's response back instead of creating the transfer twice.
+    """
     if not connection_pool:
         raise HTTPException(status_code=503, detail="Database not available")
+
+    request_fingerprint = None
+    if idempotency_key is not None:
+        try:
+            idempotency.validate_key(idempotency_key)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        request_fingerprint = idempotency.fingerprint(request.dict())
     
-    connection = None
+    doc_date = datetime.now()
+    doc_time = doc_date.strftime("%H:%M")
+    # Allocated before the connection is taken (see doc_numbers.py); usually from memory
     try:
-        connection = connection_pool.getconn()
-        cursor = connection.cursor()
-        
-        query = """
-        WITH last_doc AS (
-            SELECT max(doc_no) AS max_doc
-            FROM ic_trans
-            WHERE doc_format_code = 'FR'
-              AND trans_flag = 124
-              AND to_char(doc_date, 'yyyy-mm') = to_char(current_date, 'yyyy-mm')
-        )
-        SELECT 
-            CASE 
-                WHEN max_doc IS NULL 
-                    THEN 'FR' || to_char(current_date, 'YYMM') || '0001'
-                ELSE 'FR' || to_char(current_date, 'YYMM') || 
-                     lpad((right(max_doc, 4)::int + 1)::text, 4, '0')
-            END AS new_doc_no
-        FROM last_doc
-        """
-        
-        cursor.execute(query)
-        result = cursor.fetchone()
-        
-        if result:
-            return {"transfer_no": result[0]}
-        else:
-            raise HTTPException(status_code=500, detail="Failed to generate transfer number")
-            
+        transfer_no = doc_numbers.next("FR", doc_date.date())
     except Exception as e:
-        print(f"Error generating transfer number: {e}")
+        print(f"Error allocating a transfer number: {e}")
         raise HTTPException(status_code=500, detail="Internal Server Error")
-    finally:
-        if connection:
-            connection_pool.putconn(connection)
 
-@app.post("/api/transfers")
-async def create_transfer(request: TransferRequest):
-    """Create a new transfer"""
-    if not connection_pool:
-        raise HTTPException(status_code=503, detail="Database not available")
-    
-    connection = None
     try:
-        connection = connection_pool.getconn()
+        connection = acquire_connection()
+    except HTTPException:
+        doc_numbers.put_back("FR", [transfer_no])
+        raise
+    written = False
+    try:
         connection.autocommit = False
         cursor = connection.cursor()
         
         print(f"Received transfer payload: {request.dict()}")
+
+        if idempotency_key:
+            stored = idempotency.begin(cursor, "transfers", idempotency_key, request_fingerprint)
+            if stored is not None:
+                connection.rollback()
+                return idempotent_replay(stored)
         
-        doc_date = datetime.now()
-        doc_time = doc_date.strftime("%H:%M")
-        
-        # Insert header
-        trans_header_query = """
-        INSERT INTO ic_trans (
-            trans_type, trans_flag, doc_date, doc_no, doc_ref, doc_ref_date, 
-            branch_code, project_code, sale_code, remark, doc_time, doc_format_code, 
-            wh_from, location_from, wh_to, location_to, creator_code, 
-            create_datetime, last_editor_code, lastedit_datetime
-        ) VALUES (
-            %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s
-        )
-        """
-        
-        cursor.execute(trans_header_query, (
-            3, 124, doc_date, request.transfer_no, request.creator, doc_date, 
-            '00', '', request.creator, f'Web: {request.transfer_no}', doc_time, 'FR',
-            request.wh_from, request.location_from, request.wh_to, request.location_to, 
+        # Insert header (the same statement bulk create uses)
+        execute_values(cursor, TRANSFER_HEADER_INSERT, [(
+            3, 124, doc_date, transfer_no, request.creator, doc_date,
+            '00', '', request.creator, f'Web: {transfer_no}', doc_time, 'FR',
+            request.wh_from, request.location_from, request.wh_to, request.location_to,
             request.creator, doc_date, request.creator, doc_date
-        ))
+        )])
         
-        # Insert details
-        for item in request.details:
-            print(f"Processing item: {item.dict()}")
-            trans_detail_query = """
-            INSERT INTO ic_trans_detail (
-                trans_type, trans_flag, doc_date, doc_no, item_code, item_name, 
-                unit_code, qty, branch_code, wh_code, shelf_code, wh_code_2, 
-                shelf_code_2, stand_value, divide_value, doc_time, sale_code, 
-                create_datetime, last_editor_code, lastedit_datetime
-            ) VALUES (
-                %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s
-            )
-            """
-            
-            cursor.execute(trans_detail_query, (
-                3, 124, doc_date, request.transfer_no, item.item_code, item.item_name,
-                item.unit_code, item.quantity, '00', item.wh_code, item.shelf_code,
-                item.wh_code_2, item.shelf_code_2, 1, 1, doc_time, request.creator,
-                doc_date, request.creator, doc_date
-            ))
+        # Insert details, all lines in one multi-row INSERT
+        execute_values(cursor, TRANSFER_DETAIL_INSERT, [(
+            3, 124, doc_date, transfer_no, item.item_code, item.item_name,
+            item.unit_code, item.quantity, '00', item.wh_code, item.shelf_code,
+            item.wh_code_2, item.shelf_code_2, 1, 1, doc_time, request.creator,
+            doc_date, request.creator, doc_date
+        ) for item in request.details], page_size=1000)
         
-        connection.commit()
+        # Let services holding stock snapshots patch both shelves once this commits
+        stock_movements = []
+        for item in request.details:
+            stock_movements.append({
+                "wh_code": item.wh_code, "shelf_code": item.shelf_code, "item_code": item.item_code,
+                "qty": -item.quantity, "item_name": item.item_name, "unit_code": item.unit_code
+            })
+            stock_movements.append({
+                "wh_code": item.wh_code_2, "shelf_code": item.shelf_code_2, "item_code": item.item_code,
+                "qty": item.quantity, "item_name": item.item_name, "unit_code": item.unit_code
+            })
+        notify_stock_movements(cursor, stock_movements)
         
-        # Get result
+        # Get result (inside the transaction, so it can be stored with the key)
         result_query = """
         SELECT doc_no AS transfer_no, doc_no AS id, 
                to_char(create_datetime, 'YYYY-MM-DD HH24:MI:SS') AS doc_date_time, 
@@ -386,15 +596,27 @@ async def create_transfer(request: TransferRequest):
                (SELECT SUM(qty) FROM ic_trans_detail WHERE doc_no = %s) AS quantity 
         FROM ic_trans WHERE doc_no = %s
         """
-        cursor.execute(result_query, (request.transfer_no, request.transfer_no))
+        cursor.execute(result_query, (transfer_no, transfer_no))
         result = cursor.fetchone()
         
-        if result:
-            columns = [desc[0] for desc in cursor.description]
-            return dict(zip(columns, result))
-        else:
+        if not result:
             raise HTTPException(status_code=500, detail="Failed to create transfer")
+
+        columns = [desc[0] for desc in cursor.description]
+        body = jsonable_encoder(dict(zip(columns, result)))
+        if idempotency_key:
+            idempotency.store_response(cursor, "transfers", idempotency_key, 200, json.dumps(body, ensure_ascii=False))
+
+        connection.commit()
+        written = True
+        return body
             
+    except idempotency.KeyMismatch as e:
+        connection.rollback()
+        raise HTTPException(status_code=422, detail=str(e))
+    except idempotency.KeyInUse as e:
+        connection.rollback()
+        raise HTTPException(status_code=409, detail=str(e))
     except Exception as e:
         if connection:
             connection.rollback()
@@ -403,16 +625,190 @@ async def create_transfer(request: TransferRequest):
     finally:
         if connection:
             connection_pool.putconn(connection)
+        if not written:
+            doc_numbers.put_back("FR", [transfer_no])
+
+def _bulk_transfer_errors(transfers, known_items, known_shelves):
+    """Validation errors per transfer (index -> list of messages)"""
+    errors = {}
+    for index, transfer in enumerate(transfers):
+        problems = []
+        if not transfer.details:
+            problems.append("no detail lines")
+        if (transfer.wh_from, transfer.location_from) == (transfer.wh_to, transfer.location_to):
+            problems.append("source and destination are the same location")
+        for location in ((transfer.wh_from, transfer.location_from), (transfer.wh_to, transfer.location_to)):
+            if known_shelves is not None and location not in known_shelves:
+                problems.append(f"unknown location {location[0]}/{location[1]}")
+        for line, item in enumerate(transfer.details, start=1):
+            if item.quantity <= 0:
+                problems.append(f"line {line}: quantity must be positive")
+            if item.item_code not in known_items:
+                problems.append(f"line {line}: unknown item {item.item_code}")
+            # Lines move stock between the header's locations, which were checked above
+            if (item.wh_code, item.shelf_code) != (transfer.wh_from, transfer.location_from):
+                problems.append(f"line {line}: source {item.wh_code}/{item.shelf_code} is not the transfer's "
+                                f"{transfer.wh_from}/{transfer.location_from}")
+            if (item.wh_code_2, item.shelf_code_2) != (transfer.wh_to, transfer.location_to):
+                problems.append(f"line {line}: destination {item.wh_code_2}/{item.shelf_code_2} is not the transfer's "
+                                f"{transfer.wh_to}/{transfer.location_to}")
+        if problems:
+            errors[index] = problems
+    return errors
+
+@app.post("/api/transfers/bulk")
+def create_transfers_bulk(request: BulkTransferRequest, idempotency_key: Optional[str] = Header(None, alias=idempotency.HEADER)):
+    """Create many transfers in one transaction
+
+    All transfers are validated first (items exist, locations exist, each
+    line moves stock between its transfer's locations, positive
+    quantities); if any is invalid nothing is written and the 422 lists the
+    errors per transfer. Otherwise headers and details are written with
+    one multi-row INSERT each, numbered from FR numbers allocated before the
+    connection is taken and put back if nothing is written. The response
+    has one result per transfer, in request order.
+    """
+    if not connection_pool:
+        raise HTTPException(status_code=503, detail="Database not available")
+
+    transfers = request.transfers
+    line_count = sum(len(transfer.details) for transfer in transfers)
+    if not transfers:
+        raise HTTPException(status_code=400, detail="No transfers given")
+    if line_count > BULK_TRANSFER_MAX_LINES:
+        raise HTTPException(status_code=413, detail=f"At most {BULK_TRANSFER_MAX_LINES} detail lines per request")
+
+    request_fingerprint = None
+    if idempotency_key is not None:
+        try:
+            idempotency.validate_key(idempotency_key)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        request_fingerprint = idempotency.fingerprint(request.dict())
+
+    try:
+        known_shelves = {(row["whcode"], row["code"]) for row in reference_data.get("shelves").rows}
+    except Exception as e:
+        # Let the database enforce what it enforces rather than refusing every request
+        print(f"Warning: Could not load shelves for bulk transfer validation: {e}")
+        known_shelves = None
+
+    doc_date = datetime.now()
+    doc_time = doc_date.strftime("%H:%M")
+    # Allocated before the connection is taken (see doc_numbers.py)
+    try:
+        transfer_nos = doc_numbers.allocate("FR", len(transfers), doc_date.date())
+    except Exception as e:
+        print(f"Error allocating transfer numbers: {e}")
+        raise HTTPException(status_code=500, detail="Internal Server Error")
+
+    try:
+        connection = acquire_connection()
+    except HTTPException:
+        doc_numbers.put_back("FR", transfer_nos)
+        raise
+    written = False
+    try:
+        connection.autocommit = False
+        cursor = connection.cursor()
+
+        if idempotency_key:
+            stored = idempotency.begin(cursor, "transfers-bulk", idempotency_key, request_fingerprint)
+            if stored is not None:
+                connection.rollback()
+                return idempotent_replay(stored)
+
+        item_codes = list({item.item_code for transfer in transfers for item in transfer.details})
+        cursor.execute("SELECT code FROM ic_inventory WHERE code = ANY(%s)", (item_codes,))
+        known_items = {row[0] for row in cursor.fetchall()}
+
+        errors = _bulk_transfer_errors(transfers, known_items, known_shelves)
+        if errors:
+            connection.rollback()
+            return JSONResponse(status_code=422, content={
+                "created": 0,
+                "results": [
+                    {"index": index, "ref": transfer.ref, "status": "invalid" if index in errors else "not_created",
+                     "errors": errors.get(index, [])}
+                    for index, transfer in enumerate(transfers)
+                ],
+            })
+
+        creator = request.creator
+
+        header_rows = []
+        detail_rows = []
+        stock_movements = []
+        for transfer_no, transfer in zip(transfer_nos, transfers):
+            header_rows.append((
+                3, 124, doc_date, transfer_no, creator, doc_date,
+                '00', '', creator, f'Web: {transfer_no}', doc_time, 'FR',
+                transfer.wh_from, transfer.location_from, transfer.wh_to, transfer.location_to,
+                creator, doc_date, creator, doc_date
+            ))
+            for item in transfer.details:
+                detail_rows.append((
+                    3, 124, doc_date, transfer_no, item.item_code, item.item_name,
+                    item.unit_code, item.quantity, '00', item.wh_code, item.shelf_code,
+                    item.wh_code_2, item.shelf_code_2, 1, 1, doc_time, creator,
+                    doc_date, creator, doc_date
+                ))
+                stock_movements.append({
+                    "wh_code": item.wh_code, "shelf_code": item.shelf_code, "item_code": item.item_code,
+                    "qty": -item.quantity, "item_name": item.item_name, "unit_code": item.unit_code
+                })
+                stock_movements.append({
+                    "wh_code": item.wh_code_2, "shelf_code": item.shelf_code_2, "item_code": item.item_code,
+                    "qty": item.quantity, "item_name": item.item_name, "unit_code": item.unit_code
+                })
+
+        execute_values(cursor, TRANSFER_HEADER_INSERT, header_rows, page_size=1000)
+        execute_values(cursor, TRANSFER_DETAIL_INSERT, detail_rows, page_size=1000)
+        notify_stock_movements(cursor, stock_movements)
+
+        doc_date_time = doc_date.strftime("%Y-%m-%d %H:%M:%S")
+        body = {
+            "created": len(transfers),
+            "results": [
+                {"index": index, "ref": transfer.ref, "status": "created", "transfer_no": transfer_no,
+                 "doc_date_time": doc_date_time, "lines": len(transfer.details),
+                 "quantity": sum(item.quantity for item in transfer.details)}
+                for index, (transfer_no, transfer) in enumerate(zip(transfer_nos, transfers))
+            ],
+        }
+        if idempotency_key:
+            idempotency.store_response(cursor, "transfers-bulk", idempotency_key, 200, json.dumps(body, ensure_ascii=False))
+
+        connection.commit()
+        written = True
+        print(f"Bulk transfer by {creator}: {len(transfers)} transfers, {line_count} lines ({transfer_nos[0]}..{transfer_nos[-1]})")
+        return body
+
+    except idempotency.KeyMismatch as e:
+        connection.rollback()
+        raise HTTPException(status_code=422, detail=str(e))
+    except idempotency.KeyInUse as e:
+        connection.rollback()
+        raise HTTPException(status_code=409, detail=str(e))
+    except Exception as e:
+        if connection:
+            connection.rollback()
+        print(f"Error during bulk transfer: {e}")
+        raise HTTPException(status_code=500, detail="Internal Server Error during bulk transfer")
+    finally:
+        if connection:
+            connection_pool.putconn(connection)
+        if not written:
+            doc_numbers.put_back("FR", transfer_nos)
 
 @app.get("/api/transfers/{transfer_id}")
-async def get_transfer_details(transfer_id: str):
+def get_transfer_details(transfer_id: str):
     """Get transfer details by ID"""
     if not connection_pool:
         raise HTTPException(status_code=503, detail="Database not available")
     
-    connection = None
+    connection = acquire_connection()
     try:
-        connection = connection_pool.getconn()
         cursor = connection.cursor()
         
         # Get header with warehouse and location names
@@ -466,69 +862,119 @@ async def get_transfer_details(transfer_id: str):
             connection_pool.putconn(connection)
 
 @app.get("/api/transfers")
-async def get_transfers(date: Optional[str] = None):
-    """Get list of transfers with status information"""
+def get_transfers(
+    request: Request,
+    response: Response,
+    date: Optional[str] = None,
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+    limit: Optional[int] = None,
+    after: Optional[str] = None,
+    stream: Optional[str] = None
+):
+    """Get list of transfers with status information.
+
+    `date` lists one day oldest first (everything unless `limit` is given);
+    otherwise transfers are listed newest first, optionally within
+    date_from..date_to, TRANSFER_PAGE_SIZE at a time. When more rows follow,
+    the X-Next-After header holds the cursor to pass back as `after`.
+    A streamed request (?stream=json|ndjson) returns every matching row
+    unless `limit` is given.
+    """
+    streaming = stream_format(stream, request.headers.get("accept", "")) is not None
     if not connection_pool:
         raise HTTPException(status_code=503, detail="Database not available")
-    
-    connection = None
+
+    where_clauses = ["a.trans_flag = 124"]
+    query_params = {}
     try:
-        connection = connection_pool.getconn()
-        cursor = connection.cursor()
-        
-        # Use the improved query from senior colleague
         if date:
-            query = """
-            SELECT a.doc_date, a.doc_no as transfer_no, a.doc_no as id, a.creator_code,
-                   u.name_1 as creator_name, u.name_1 as creator,
-                   (SELECT sum(qty) FROM ic_trans_detail WHERE doc_no = a.doc_no) as all_qty,
-                   (SELECT sum(qty) FROM ic_trans_detail WHERE doc_no = a.doc_no) as quantity,
-                   CASE WHEN a.doc_success = 0 THEN 'ລໍຖ້າໂອນ' 
-                        WHEN a.doc_success = 1 THEN 'ໂອນສຳເລັດ' 
-                        ELSE '' END AS status_name,
-                   to_char(a.create_datetime, 'YYYY-MM-DD HH24:MI:SS') as doc_date_time,
-                   wh_from.name_1 as wh_from_name, wh_to.name_1 as wh_to_name,
-                   loc_from.name_1 as location_from_name, loc_to.name_1 as location_to_name,
-                   a.wh_from, a.wh_to, a.location_from, a.location_to
-            FROM ic_trans a
-            LEFT JOIN erp_user u ON u.code = a.creator_code
-            LEFT JOIN ic_warehouse wh_from ON a.wh_from = wh_from.code
-            LEFT JOIN ic_warehouse wh_to ON a.wh_to = wh_to.code
-            LEFT JOIN ic_shelf loc_from ON a.location_from = loc_from.code AND a.wh_from = loc_from.whcode
-            LEFT JOIN ic_shelf loc_to ON a.location_to = loc_to.code AND a.wh_to = loc_to.whcode
-            WHERE a.trans_flag = 124 AND a.doc_date = %s
-            ORDER BY a.doc_date, a.doc_no
-            """
-            query_params = [date]
-        else:
-            query = """
-            SELECT a.doc_date, a.doc_no as transfer_no, a.doc_no as id, a.creator_code,
-                   u.name_1 as creator_name, u.name_1 as creator,
-                   (SELECT sum(qty) FROM ic_trans_detail WHERE doc_no = a.doc_no) as all_qty,
-                   (SELECT sum(qty) FROM ic_trans_detail WHERE doc_no = a.doc_no) as quantity,
-                   CASE WHEN a.doc_success = 0 THEN 'ລໍຖ້າໂອນ' 
-                        WHEN a.doc_success = 1 THEN 'ໂອນສຳເລັດ' 
-                        ELSE '' END AS status_name,
-                   to_char(a.create_datetime, 'YYYY-MM-DD HH24:MI:SS') as doc_date_time,
-                   wh_from.name_1 as wh_from_name, wh_to.name_1 as wh_to_name,
-                   loc_from.name_1 as location_from_name, loc_to.name_1 as location_to_name,
-                   a.wh_from, a.wh_to, a.location_from, a.location_to
-            FROM ic_trans a
-            LEFT JOIN erp_user u ON u.code = a.creator_code
-            LEFT JOIN ic_warehouse wh_from ON a.wh_from = wh_from.code
-            LEFT JOIN ic_warehouse wh_to ON a.wh_to = wh_to.code
-            LEFT JOIN ic_shelf loc_from ON a.location_from = loc_from.code AND a.wh_from = loc_from.whcode
-            LEFT JOIN ic_shelf loc_to ON a.location_to = loc_to.code AND a.wh_to = loc_to.whcode
-            WHERE a.trans_flag = 124
-            ORDER BY a.doc_date DESC, a.doc_no DESC
-            """
-            query_params = []
+            where_clauses.append("a.doc_date = %(date)s")
+            query_params["date"] = datetime.strptime(date, "%Y-%m-%d").date()
+        if date_from:
+            where_clauses.append("a.doc_date >= %(date_from)s")
+            query_params["date_from"] = datetime.strptime(date_from, "%Y-%m-%d").date()
+        if date_to:
+            where_clauses.append("a.doc_date <= %(date_to)s")
+            query_params["date_to"] = datetime.strptime(date_to, "%Y-%m-%d").date()
+        if after:
+            after_date, after_doc_no = decode_cursor(after, str, str)
+            query_params["after_date"] = datetime.strptime(after_date, "%Y-%m-%d").date()
+            query_params["after_doc_no"] = after_doc_no
+    except (ValueError, TypeError) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid filter: {e}")
+
+    # A single day keeps its original oldest-first order; listings page newest first
+    descending = not date
+    if after:
+        where_clauses.append(
+            "(a.doc_date, a.doc_no) < (%(after_date)s, %(after_doc_no)s)" if descending
+            else "(a.doc_date, a.doc_no) > (%(after_date)s, %(after_doc_no)s)"
+        )
+    order = "a.doc_date DESC, a.doc_no DESC" if descending else "a.doc_date, a.doc_no"
+    if limit is None and not date and not streaming:
+        limit = TRANSFER_PAGE_SIZE
+    limit_sql = ""
+    if limit is not None:
+        limit = max(1, limit if streaming else min(limit, TRANSFER_MAX_PAGE_SIZE))
+        limit_sql = "LIMIT %(limit)s"
+        # One extra row tells whether another page follows
+        query_params["limit"] = limit if streaming else limit + 1
+
+    # Page the headers first, then sum the quantities of just those documents in one grouped join
+    query = f"""
+    WITH page AS (
+        SELECT a.*
+        FROM ic_trans a
+        WHERE {" AND ".join(where_clauses)}
+        ORDER BY {order}
+        {limit_sql}
+    ),
+    quantities AS (
+        SELECT d.doc_no, sum(d.qty) AS qty
+        FROM ic_trans_detail d
+        WHERE d.doc_no IN (SELECT doc_no FROM page)
+        GROUP BY d.doc_no
+    )
+    SELECT a.doc_date, a.doc_no as transfer_no, a.doc_no as id, a.creator_code,
+           u.name_1 as creator_name, u.name_1 as creator,
+           q.qty as all_qty,
+           q.qty as quantity,
+           CASE WHEN a.doc_success = 0 THEN 'ລໍຖ້າໂອນ' 
+                WHEN a.doc_success = 1 THEN 'ໂອນສຳເລັດ' 
+                ELSE '' END AS status_name,
+           to_char(a.create_datetime, 'YYYY-MM-DD HH24:MI:SS') as doc_date_time,
+           wh_from.name_1 as wh_from_name, wh_to.name_1 as wh_to_name,
+           loc_from.name_1 as location_from_name, loc_to.name_1 as location_to_name,
+           a.wh_from, a.wh_to, a.location_from, a.location_to
+    FROM page a
+    LEFT JOIN quantities q ON q.doc_no = a.doc_no
+    LEFT JOIN erp_user u ON u.code = a.creator_code
+    LEFT JOIN ic_warehouse wh_from ON a.wh_from = wh_from.code
+    LEFT JOIN ic_warehouse wh_to ON a.wh_to = wh_to.code
+    LEFT JOIN ic_shelf loc_from ON a.location_from = loc_from.code AND a.wh_from = loc_from.whcode
+    LEFT JOIN ic_shelf loc_to ON a.location_to = loc_to.code AND a.wh_to = loc_to.whcode
+    ORDER BY {order}
+    """
+
+    streamed = streamed_response(request, stream, query, query_params)
+    if streamed is not None:
+        return streamed
+
+    connection = acquire_connection()
+    try:
+        cursor = connection.cursor()
         
         cursor.execute(query, query_params)
         results = cursor.fetchall()
         
         columns = [desc[0] for desc in cursor.description]
-        return [dict(zip(columns, row)) for row in results]
+        transfers = [dict(zip(columns, row)) for row in results]
+        if limit is not None and len(transfers) > limit:
+            transfers = transfers[:limit]
+            last = transfers[-1]
+            response.headers["X-Next-After"] = encode_cursor(last["doc_date"].isoformat(), last["transfer_no"])
+        return transfers
         
     except Exception as e:
         print(f"Error executing transfers query: {e}")
@@ -545,14 +991,13 @@ class UpdateTransferRequest(BaseModel):
     location_to: str
 
 @app.put("/api/transfers/{transfer_id}")
-async def update_transfer(transfer_id: str, request: UpdateTransferRequest):
+def update_transfer(transfer_id: str, request: UpdateTransferRequest):
     """Update transfer details"""
     if not connection_pool:
         raise HTTPException(status_code=503, detail="Database not available")
     
-    connection = None
+    connection = acquire_connection()
     try:
-        connection = connection_pool.getconn()
         connection.autocommit = False
         cursor = connection.cursor()
         
@@ -591,126 +1036,69 @@ async def update_transfer(transfer_id: str, request: UpdateTransferRequest):
         if connection:
             connection_pool.putconn(connection)
 
+def reference_response(request, name, build=None, variant=""):
+    """Rows of a reference dataset, or 304 when the client's ETag is current"""
+    dataset = reference_data.get(name)
+    etag = dataset.etag(variant)
+    # Revalidate on every use; a 304 costs no query
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    return JSONResponse(dataset.view(variant, build) if build else dataset.rows, headers=headers)
+
+def _shelves_of(warehouse):
+    return lambda rows: [{"code": row["code"], "name": row["name"]} for row in rows if row["whcode"] == warehouse]
+
 @app.get("/api/warehouses")
-async def get_warehouses():
+def get_warehouses(request: Request):
     """Get list of warehouses"""
     if not connection_pool:
         raise HTTPException(status_code=503, detail="Database not available")
     
-    connection = None
     try:
-        connection = connection_pool.getconn()
-        cursor = connection.cursor()
-        
-        query = """
-        SELECT code, name_1 as name
-        FROM ic_warehouse 
-        ORDER BY code
-        """
-        cursor.execute(query)
-        results = cursor.fetchall()
-        
-        columns = [desc[0] for desc in cursor.description]
-        return [dict(zip(columns, row)) for row in results]
-        
+        return reference_response(request, "warehouses")
     except Exception as e:
         print(f"Error fetching warehouses: {e}")
         raise HTTPException(status_code=500, detail="Internal Server Error")
-    finally:
-        if connection:
-            connection_pool.putconn(connection)
 
 @app.get("/api/locations/{warehouse}")
-async def get_locations(warehouse: str):
+def get_locations(warehouse: str, request: Request):
     """Get locations for a specific warehouse"""
     if not connection_pool:
         raise HTTPException(status_code=503, detail="Database not available")
     
-    connection = None
     try:
-        connection = connection_pool.getconn()
-        cursor = connection.cursor()
-        
-        query = """
-        SELECT code, name_1 as name
-        FROM ic_shelf 
-        WHERE whcode = %s
-        ORDER BY code
-        """
-        cursor.execute(query, (warehouse,))
-        results = cursor.fetchall()
-        
-        columns = [desc[0] for desc in cursor.description]
-        return [dict(zip(columns, row)) for row in results]
-        
+        return reference_response(request, "shelves", _shelves_of(warehouse), variant=warehouse)
     except Exception as e:
         print(f"Error fetching locations for warehouse {warehouse}: {e}")
         raise HTTPException(status_code=500, detail="Internal Server Error")
-    finally:
-        if connection:
-            connection_pool.putconn(connection)
 
 @app.get("/api/destination-warehouses")
-async def get_destination_warehouses():
+def get_destination_warehouses(request: Request):
     """Get destination warehouses"""
     if not connection_pool:
         raise HTTPException(status_code=503, detail="Database not available")
     
-    connection = None
     try:
-        connection = connection_pool.getconn()
-        cursor = connection.cursor()
-        
-        query = """
-        SELECT code, name_1 as name
-        FROM ic_warehouse 
-        ORDER BY code
-        """
-        cursor.execute(query)
-        results = cursor.fetchall()
-        
-        columns = [desc[0] for desc in cursor.description]
-        return [dict(zip(columns, row)) for row in results]
-        
+        return reference_response(request, "warehouses")
     except Exception as e:
         print(f"Error fetching destination warehouses: {e}")
         raise HTTPException(status_code=500, detail="Internal Server Error")
-    finally:
-        if connection:
-            connection_pool.putconn(connection)
 
 @app.get("/api/destination-locations/{warehouse}")
-async def get_destination_locations(warehouse: str):
+def get_destination_locations(warehouse: str, request: Request):
     """Get destination locations for a specific warehouse"""
     if not connection_pool:
         raise HTTPException(status_code=503, detail="Database not available")
     
-    connection = None
     try:
-        connection = connection_pool.getconn()
-        cursor = connection.cursor()
-        
-        query = """
-        SELECT code, name_1 as name
-        FROM ic_shelf 
-        WHERE whcode = %s
-        ORDER BY code
-        """
-        cursor.execute(query, (warehouse,))
-        results = cursor.fetchall()
-        
-        columns = [desc[0] for desc in cursor.description]
-        return [dict(zip(columns, row)) for row in results]
-        
+        return reference_response(request, "shelves", _shelves_of(warehouse), variant=warehouse)
     except Exception as e:
         print(f"Error fetching destination locations for warehouse {warehouse}: {e}")
         raise HTTPException(status_code=500, detail="Internal Server Error")
-    finally:
-        if connection:
-            connection_pool.putconn(connection)
 
 @app.get("/api/units", response_model=List[str])
-async def get_units():
+def get_units(request: Request):
     """
     API endpoint to get all unique unit codes (categories).
     """
@@ -718,33 +1106,28 @@ async def get_units():
         print("Database not available, returning mock units")
         return ["PCS", "BOX", "SET"]
     
-    connection = None
     try:
-        connection = connection_pool.getconn()
-        cursor = connection.cursor()
-        
         # Using unit_code_1 from ic_master as it's the master table for items
-        query = """
-        SELECT DISTINCT unit_code_1 
-        FROM ic_master 
-        WHERE unit_code_1 IS NOT NULL AND unit_code_1 <> ''
-        ORDER BY unit_code_1 ASC;
-        """
-        cursor.execute(query)
-        results = cursor.fetchall()
-        
-        # The result from fetchall is a list of tuples, e.g., [('PCS',), ('BOX',)]
-        return [row[0] for row in results]
-        
+        return reference_response(request, "units", lambda rows: [row["code"] for row in rows], variant="codes")
     except Exception as e:
         print(f"Error fetching units: {e}")
         return ["PCS", "BOX", "SET"] # Fallback mock data
-    finally:
-        if connection:
-            connection_pool.putconn(connection)
+
+@app.post("/api/reference-data/refresh")
+def refresh_reference_data(name: Optional[str] = None):
+    """Reload cached reference data now (?name=warehouses|shelves|units), e.g. after editing it in SML"""
+    if not connection_pool:
+        raise HTTPException(status_code=503, detail="Database not available")
+    if name and name not in reference_data.datasets:
+        raise HTTPException(status_code=400, detail=f"Unknown dataset: {name}")
+    try:
+        return {"versions": reference_data.invalidate(name)}
+    except Exception as e:
+        print(f"Error refreshing reference data: {e}")
+        raise HTTPException(status_code=500, detail="Internal Server Error")
 
 @app.get("/api/pos-products")
-async def get_pos_products(limit: int = 30, offset: int = 0):
+def get_pos_products(limit: int = 30, offset: int = 0):
     """
     API endpoint to get products for POS with pagination.
     This endpoint fetches product data specifically for the POS page.
@@ -764,9 +1147,8 @@ async def get_pos_products(limit: int = 30, offset: int = 0):
             })
         return mock_products
     
-    connection = None
+    connection = acquire_connection()
     try:
-        connection = connection_pool.getconn()
         cursor = connection.cursor()
         
         # Query to fetch products for POS - using the same approach as analysis-data endpoint
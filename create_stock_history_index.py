@@ -0,0 +1,28 @@
+"""One-off migration: index ic_trans for the stock snapshot staleness checks.
+
+Run once per database (python create_stock_history_index.py) before relying on
+stock snapshots. The index is built CONCURRENTLY, so POS terminals keep writing
+bills while it runs; running it again is a no-op.
+"""
+import psycopg2
+
+from stock_history import ENTERED_INDEX_NAME, create_entered_index
+
+# Database connection configuration
+DATABASE_CONFIG = {
+    "host": "183.182.125.245",
+    "port": 5432,
+    "database": "odg_test",
+    "user": "postgres",
+    "password": "od@2022"
+}
+
+if __name__ == "__main__":
+    conn = psycopg2.connect(**DATABASE_CONFIG)
+    try:
+        if create_entered_index(conn):
+            print(f"Created index {ENTERED_INDEX_NAME}")
+        else:
+            print(f"Index {ENTERED_INDEX_NAME} already exists")
+    finally:
+        conn.close()
@@ -0,0 +1,243 @@
+"""Shared, thread-safe PostgreSQL connection pool for the POS services.
+
+The database lives on a remote host, so opening a connection costs a full
+TCP + auth handshake over the WAN. This pool keeps connections open between
+requests, warms them up at startup, checks them before handing them out and
+makes callers wait (with a timeout) instead of failing when it is exhausted.
+"""
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import psycopg2
+from psycopg2 import extensions
+from psycopg2.pool import PoolError
+
+# TCP keepalives stop NAT/firewalls on the WAN link from silently dropping idle connections
+KEEPALIVE_OPTIONS = {
+    "keepalives": 1,
+    "keepalives_idle": 30,
+    "keepalives_interval": 10,
+    "keepalives_count": 3,
+}
+
+
+class PoolTimeout(PoolError):
+    """Raised when no connection becomes available within the wait timeout."""
+
+
+class ConnectionPool:
+    """Bounded pool of psycopg2 connections.
+
+    - minconn connections are opened by prewarm() and kept open
+    - at most maxconn connections exist at the same time
+    - getconn() blocks up to wait_timeout seconds when every connection is in use
+    - a connection idle for more than healthcheck_after seconds is pinged before reuse
+    """
+
+    def __init__(self, db_config, minconn=2, maxconn=10, wait_timeout=10.0,
+                 healthcheck_after=30.0, connect_timeout=5):
+        if minconn < 0 or maxconn < 1 or minconn > maxconn:
+            raise ValueError("Invalid pool size: require 0 <= minconn <= maxconn and maxconn >= 1")
+
+        self.db_config = dict(db_config)
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.wait_timeout = wait_timeout
+        self.healthcheck_after = healthcheck_after
+        self.connect_timeout = connect_timeout
+
+        self._lock = threading.Lock()
+        self._available = threading.Condition(self._lock)
+        self._idle = deque()  # (connection, last_used_monotonic)
+        self._in_use = set()
+        self._opening = 0  # connections being opened outside the lock
+        self._closed = False
+
+        self._stats = {
+            "checkouts": 0,
+            "waits": 0,
+            "wait_time_total": 0.0,
+            "wait_time_max": 0.0,
+            "timeouts": 0,
+            "created": 0,
+            "discarded": 0,
+            "healthcheck_failures": 0,
+            "peak_in_use": 0,
+        }
+
+    def _connect(self):
+        options = dict(KEEPALIVE_OPTIONS)
+        options.update(self.db_config)
+        options.setdefault("connect_timeout", self.connect_timeout)
+        return psycopg2.connect(**options)
+
+    def _size(self):
+        return len(self._idle) + len(self._in_use) + self._opening
+
+    def prewarm(self):
+        """Open connections until minconn are idle. Returns the number opened."""
+        opened = 0
+        while True:
+            with self._lock:
+                if self._closed or self._size() >= self.minconn:
+                    return opened
+                self._opening += 1
+            try:
+                conn = self._connect()
+            except Exception:
+                with self._available:
+                    self._opening -= 1
+                    self._available.notify()
+                raise
+            with self._available:
+                self._opening -= 1
+                self._stats["created"] += 1
+                self._idle.append((conn, time.monotonic()))
+                self._available.notify()
+            opened += 1
+
+    def _is_healthy(self, conn, last_used):
+        if conn.closed:
+            return False
+        if time.monotonic() - last_used < self.healthcheck_after:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def getconn(self, timeout=None):
+        """Check out a healthy connection, waiting up to timeout seconds."""
+        timeout = self.wait_timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        waited = False
+        wait_started = time.monotonic()
+
+        while True:
+            with self._available:
+                while True:
+                    if self._closed:
+                        raise PoolError("connection pool is closed")
+                    if self._idle:
+                        conn, last_used = self._idle.pop()  # most recently used first
+                        self._in_use.add(conn)
+                        action = "check"
+                        break
+                    if self._size() < self.maxconn:
+                        self._opening += 1
+                        action = "open"
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._stats["timeouts"] += 1
+                        raise PoolTimeout(
+                            f"No database connection available within {timeout:.1f}s "
+                            f"(max {self.maxconn} in use)"
+                        )
+                    waited = True
+                    self._available.wait(remaining)
+
+            if action == "open":
+                try:
+                    conn = self._connect()
+                except Exception:
+                    with self._available:
+                        self._opening -= 1
+                        self._available.notify()
+                    raise
+                with self._lock:
+                    self._opening -= 1
+                    self._stats["created"] += 1
+                    self._in_use.add(conn)
+                    self._record_checkout(waited, wait_started)
+                return conn
+
+            # Health-check outside the lock; a dead connection frees its slot and we retry
+            if self._is_healthy(conn, last_used):
+                with self._lock:
+                    self._record_checkout(waited, wait_started)
+                return conn
+
+            self._discard(conn)
+            with self._available:
+                self._in_use.discard(conn)
+                self._stats["discarded"] += 1
+                self._stats["healthcheck_failures"] += 1
+                self._available.notify()
+
+    def _record_checkout(self, waited, wait_started):
+        self._stats["checkouts"] += 1
+        self._stats["peak_in_use"] = max(self._stats["peak_in_use"], len(self._in_use))
+        if waited:
+            wait_time = time.monotonic() - wait_started
+            self._stats["waits"] += 1
+            self._stats["wait_time_total"] += wait_time
+            self._stats["wait_time_max"] = max(self._stats["wait_time_max"], wait_time)
+
+    def putconn(self, conn, discard=False):
+        """Return a connection to the pool, resetting any open transaction."""
+        if conn is None:
+            return
+
+        if not discard and not conn.closed:
+            try:
+                if conn.info.transaction_status != extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+                if conn.autocommit:
+                    conn.autocommit = False
+            except Exception:
+                discard = True
+
+        with self._available:
+            self._in_use.discard(conn)
+            if discard or conn.closed or self._closed:
+                self._stats["discarded"] += 1
+                self._discard(conn)
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._available.notify()
+
+    @contextmanager
+    def connection(self, timeout=None):
+        """Context manager that checks a connection out and always returns it."""
+        conn = self.getconn(timeout)
+        try:
+            yield conn
+        finally:
+            self.putconn(conn)
+
+    def closeall(self):
+        """Close every idle connection and refuse further checkouts."""
+        with self._available:
+            self._closed = True
+            while self._idle:
+                conn, _ = self._idle.pop()
+                self._discard(conn)
+            self._available.notify_all()
+
+    def stats(self):
+        """Snapshot of pool sizing and wait statistics."""
+        with self._lock:
+            stats = dict(self._stats)
+            stats.update({
+                "min_size": self.minconn,
+                "max_size": self.maxconn,
+                "size": self._size(),
+                "idle": len(self._idle),
+                "in_use": len(self._in_use),
+                "wait_timeout": self.wait_timeout,
+                "closed": self._closed,
+            })
+        stats["wait_time_avg"] = stats["wait_time_total"] / stats["waits"] if stats["waits"] else 0.0
+        return stats
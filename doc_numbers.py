@@ -0,0 +1,175 @@
+"""Document number allocator shared by the Flask POS server and the FastAPI backend.
+
+Numbers have the form {prefix}{YYMM}{0001} (e.g. POS26100001, FR26100001).
+Instead of scanning ic_trans for max(doc_no) on every request, each
+(prefix, YYMM) has a row in pos_doc_sequence holding the next free number.
+A process reserves a block of numbers with one short UPDATE ... RETURNING,
+committed on its own, and hands them out from memory, so terminals never
+wait on each other and two of them can never get the same number.
+
+Every program that writes POS or FR documents must take its numbers from
+pos_doc_sequence. As a safety net, reserving a block also looks up the
+highest number of the month in ic_trans (one index probe on doc_no) and
+starts after it if another writer got ahead of the sequence, so numbers
+written with the old max(doc_no) + 1 method cannot collide with it.
+
+Numbers can have gaps: a number handed out for a document that is then not
+written is only reused if no later number was handed out (put_back()), and
+a crash skips the rest of the process's blocks. On shutdown, unused numbers
+of each block are given back if nobody reserved after them.
+
+Blocks are reserved on a pool connection of their own, so call allocate()
+before taking the request's connection, never while holding one.
+"""
+import os
+import threading
+from datetime import date
+
+BLOCK_SIZE = int(os.getenv("DOCNO_BLOCK_SIZE", 20))
+
+SEQUENCE_DDL = """
+    CREATE TABLE IF NOT EXISTS pos_doc_sequence (
+        prefix varchar(10) NOT NULL,
+        period char(4) NOT NULL,
+        next_no integer NOT NULL,
+        PRIMARY KEY (prefix, period)
+    )
+"""
+
+# Seed from documents already written (also by other programs) for the month
+SEED_QUERY = """
+    INSERT INTO pos_doc_sequence (prefix, period, next_no)
+    SELECT %s, %s, COALESCE(max(right(doc_no, 4)::int), 0) + 1
+    FROM ic_trans
+    WHERE doc_format_code = %s
+      AND trans_flag = %s
+      AND doc_no LIKE %s
+      AND right(doc_no, 4) ~ '^[0-9]+$'
+    ON CONFLICT (prefix, period) DO NOTHING
+"""
+
+# A block of numbers, first catching up with numbers written to ic_trans
+# without going through the sequence. The doc_no range lets an index on
+# doc_no find the month's highest number directly.
+RESERVE_QUERY = """
+    UPDATE pos_doc_sequence s
+    SET next_no = GREATEST(s.next_no, COALESCE((
+            SELECT right(doc_no, 4)::int
+            FROM ic_trans
+            WHERE doc_no > %(low)s AND doc_no < %(high)s
+              AND doc_format_code = %(doc_format_code)s
+              AND trans_flag = %(trans_flag)s
+              AND doc_no LIKE %(pattern)s
+              AND right(doc_no, 4) ~ '^[0-9]+$'
+            ORDER BY doc_no DESC
+            LIMIT 1
+        ), 0) + 1) + %(count)s
+    WHERE s.prefix = %(prefix)s AND s.period = %(period)s
+    RETURNING s.next_no - %(count)s AS start_no
+"""
+
+RELEASE_QUERY = """
+    UPDATE pos_doc_sequence
+    SET next_no = %s
+    WHERE prefix = %s AND period = %s AND next_no = %s
+"""
+
+
+def format_doc_no(prefix, period, number):
+    return f"{prefix}{period}{number:04d}"
+
+
+class DocNumberAllocator:
+    """Hands out document numbers from blocks reserved in pos_doc_sequence.
+
+    `pool` is anything with getconn()/putconn() (db_pool.ConnectionPool or a
+    psycopg2 pool). `formats` maps a prefix to the (doc_format_code,
+    trans_flag) of its documents in ic_trans.
+    """
+
+    def __init__(self, pool, formats, block_size=BLOCK_SIZE):
+        self.pool = pool
+        self.formats = formats
+        self.block_size = max(1, block_size)
+        self._blocks = {}  # (prefix, period) -> [next_no, end_no (exclusive)]
+        self._lock = threading.Lock()
+        self._table_ready = False
+
+    def _run(self, callback):
+        conn = self.pool.getconn()
+        try:
+            conn.autocommit = False
+            with conn.cursor() as cur:
+                result = callback(cur)
+            conn.commit()
+            return result
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            self.pool.putconn(conn)
+
+    def _reserve(self, prefix, period, count):
+        """First of `count` numbers reserved in a transaction of their own."""
+        doc_format_code, trans_flag = self.formats[prefix]
+        params = {
+            "prefix": prefix, "period": period, "count": count,
+            "doc_format_code": doc_format_code, "trans_flag": trans_flag,
+            "low": f"{prefix}{period}", "high": f"{prefix}{period}Z", "pattern": f"{prefix}{period}%",
+        }
+
+        def reserve(cur):
+            if not self._table_ready:
+                cur.execute(SEQUENCE_DDL)
+            cur.execute(RESERVE_QUERY, params)
+            row = cur.fetchone()
+            if row is None:
+                cur.execute(SEED_QUERY, (prefix, period, doc_format_code, trans_flag, f"{prefix}{period}%"))
+                cur.execute(RESERVE_QUERY, params)
+                row = cur.fetchone()
+            return row["start_no"] if isinstance(row, dict) else row[0]
+
+        start = self._run(reserve)
+        self._table_ready = True
+        return start
+
+    def allocate(self, prefix, count=1, day=None):
+        """`count` numbers of `day`'s month (default today), consecutive where the block allows."""
+        period = (day or date.today()).strftime("%y%m")
+        numbers = []
+        with self._lock:
+            block = self._blocks.get((prefix, period))
+            while len(numbers) < count:
+                if block is None or block[0] >= block[1]:
+                    size = max(self.block_size, count - len(numbers))
+                    start = self._reserve(prefix, period, size)
+                    block = [start, start + size]
+                    self._blocks[(prefix, period)] = block
+                numbers.append(format_doc_no(prefix, period, block[0]))
+                block[0] += 1
+        return numbers
+
+    def next(self, prefix, day=None):
+        return self.allocate(prefix, 1, day)[0]
+
+    def put_back(self, prefix, numbers):
+        """Return numbers of a document that was not written, if none was handed out after them."""
+        with self._lock:
+            for doc_no in sorted(numbers, reverse=True):
+                period, number = doc_no[len(prefix):len(prefix) + 4], int(doc_no[len(prefix) + 4:])
+                block = self._blocks.get((prefix, period))
+                if block is None or block[0] != number + 1:
+                    return
+                block[0] = number
+
+    def release(self):
+        """Give back the unused numbers of every block (call on shutdown)."""
+        with self._lock:
+            for (prefix, period), (next_no, end_no) in self._blocks.items():
+                if next_no >= end_no:
+                    continue
+                try:
+                    self._run(lambda cur: cur.execute(RELEASE_QUERY, (next_no, prefix, period, end_no)))
+                except Exception as e:
+                    print(f"Warning: Could not give back document numbers {prefix}{period} {next_no}-{end_no - 1}: {e}")
+            self._blocks.clear()
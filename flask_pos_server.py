@@ -1,10 +1,31 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 from flask_cors import CORS
 import psycopg2
-from psycopg2.extras import RealDictCursor
+from psycopg2.extras import RealDictCursor, execute_values
+import bisect
+import heapq
+from datetime import date, datetime
 import os
+import re
+import threading
+import time
 
-import os
+from db_pool import ConnectionPool, PoolTimeout, KEEPALIVE_OPTIONS
+import stock_cache
+from stock_cache import StockSnapshotCache, notify_stock_movements
+from pagination import encode_cursor, decode_cursor
+from search_index import NgramIndex, RANK_SUBSTRING, build_catalog_docs
+from price_cache import PriceCache, PRICE_QUERY
+from doc_numbers import DocNumberAllocator
+from parked_bills import ParkedBillStore
+import image_store
+from reference_data import ReferenceDataCache, etag_matches
+from session_context import SessionContext
+import sales_outbox as outbox_config
+import idempotency
+from sales_outbox import SalesOutbox, LinkMonitor
+from streaming import stream_format, stream_rows, mimetype as stream_mimetype
+import atexit
 
 app = Flask(__name__)
 
@@ -16,7 +37,7 @@ allowed_origins = [
 if frontend_ip_url:
     allowed_origins.append(frontend_ip_url)
 
-CORS(app, origins="*")
+CORS(app, origins="*", expose_headers=[idempotency.REPLAYED_HEADER])
 
 # Database connection configuration
 DATABASE_CONFIG = {
@@ -27,19 +48,275 @@ DATABASE_CONFIG = {
     "password": "od@2022"
 }
 
+# Shared connection pool; size it for the number of POS terminals hitting this server
+db_pool = ConnectionPool(
+    DATABASE_CONFIG,
+    minconn=int(os.getenv("DB_POOL_MIN", 2)),
+    maxconn=int(os.getenv("DB_POOL_MAX", 10)),
+    wait_timeout=float(os.getenv("DB_POOL_WAIT_TIMEOUT", 10)),
+)
+
 def get_connection():
-    """Create a new database connection"""
+    """Check out a pooled database connection"""
     try:
-        conn = psycopg2.connect(**DATABASE_CONFIG)
-        return conn
+        return db_pool.getconn()
     except Exception as e:
         print(f"Error connecting to database: {e}")
         return None
 
+def release_connection(conn):
+    """Return a connection to the pool"""
+    db_pool.putconn(conn)
+
+# POS bill numbers come from blocks reserved in pos_doc_sequence (see doc_numbers.py)
+doc_numbers = DocNumberAllocator(db_pool, {'POS': ('POS', 44)})
+
+# --- Stock snapshot cache ---
+stock_snapshots = StockSnapshotCache(refresh_interval=stock_cache.REFRESH_INTERVAL)
+
+# Categories hidden from the POS grid and category list
+EXCLUDED_CATEGORIES = ('ຂອງແຖມ',)
+
+def _load_stock_snapshot(whcode, loccode):
+    """Run the SML stock function once for a warehouse/location, with the item fields the POS needs"""
+    conn = db_pool.getconn()
+    try:
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+            cur.execute("""SELECT a.ic_code, a.ic_name, a.ic_unit_code, a.balance_qty,
+                                  f.name_1 AS category_name,
+                                  p.url_image
+                           FROM sml_ic_function_stock_balance_warehouse_location('2099-12-31', '', %s, %s) a
+                           LEFT JOIN ic_inventory b ON b.code = a.ic_code
+                           LEFT JOIN ic_category f ON f.code = b.item_category
+                           LEFT JOIN product_image p ON p.ic_code = a.ic_code AND p.line_number = 1""",
+                        (whcode, loccode))
+            return cur.fetchall()
+    finally:
+        db_pool.putconn(conn)
+
+def get_stock_snapshot(whcode, loccode):
+    """Stock snapshot for a warehouse/location, loaded on first use"""
+    return stock_snapshots.get_or_load(whcode, loccode, _load_stock_snapshot)
+
+# --- Effective price cache ---
+price_cache = PriceCache()
+
+def _load_prices():
+    conn = db_pool.getconn()
+    try:
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+            cur.execute(PRICE_QUERY)
+            return cur.fetchall()
+    finally:
+        db_pool.putconn(conn)
+
+def refresh_prices():
+    """Reload prices if a from_date/to_date boundary was crossed or they are too old"""
+    price_cache.ensure_fresh(_load_prices)
+
+def _price_refresh_loop():
+    # Reload in the background so requests rarely wait for the bulk load
+    while True:
+        try:
+            refresh_prices()
+        except Exception as e:
+            print(f"Error refreshing prices: {e}")
+        time.sleep(30)
+
+# --- Product search index ---
+catalog_index = NgramIndex()
+_catalog_load_lock = threading.Lock()
+
+# Seconds between catalog re-syncs; only items whose name or barcodes changed are re-indexed
+CATALOG_REFRESH_INTERVAL = int(os.getenv("CATALOG_INDEX_REFRESH_SECONDS", 300))
+
+def _load_catalog():
+    """Item codes, names and barcodes for the search index"""
+    conn = db_pool.getconn()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT code, name_1 FROM ic_inventory")
+            item_rows = cur.fetchall()
+            cur.execute("SELECT ic_code, barcode FROM ic_inventory_barcode")
+            barcode_rows = cur.fetchall()
+        return build_catalog_docs(item_rows, barcode_rows)
+    finally:
+        db_pool.putconn(conn)
+
+def refresh_catalog_index():
+    """Sync the search index with the catalog"""
+    with _catalog_load_lock:
+        changed, removed = catalog_index.sync(_load_catalog())
+    if changed or removed:
+        print(f"Search index synced: {changed} items (re)indexed, {removed} removed")
+
+def search_catalog(term):
+    """{ic_code: rank} for catalog items matching term, or None if the index cannot be loaded"""
+    if not catalog_index.loaded:
+        try:
+            with _catalog_load_lock:
+                if not catalog_index.loaded:
+                    catalog_index.sync(_load_catalog())
+        except Exception as e:
+            print(f"Error loading search index: {e}")
+            return None
+    return catalog_index.search(term)
+
+def _catalog_refresh_loop():
+    # Builds the index at startup, then keeps it in sync
+    while True:
+        try:
+            refresh_catalog_index()
+        except Exception as e:
+            print(f"Error refreshing search index: {e}")
+        time.sleep(CATALOG_REFRESH_INTERVAL)
+
+# --- Customer search index ---
+customer_index = NgramIndex()
+customer_rows = {}
+_customer_load_lock = threading.Lock()
+
+# Seconds between customer re-syncs; only customers whose names or phone changed are re-indexed
+CUSTOMER_REFRESH_INTERVAL = int(os.getenv("CUSTOMER_INDEX_REFRESH_SECONDS", 300))
+
+# Walk-in (counter) customers, pinned above search results in this order; the first is the POS default
+WALK_IN_CUSTOMER_CODES = [code.strip() for code in os.getenv(
+    "WALK_IN_CUSTOMER_CODES", "01-0239,2012344321,01-2125,01-2127,01-2126").split(',') if code.strip()]
+
+CUSTOMER_SEARCH_LIMIT = 20
+CUSTOMER_SEARCH_MAX_LIMIT = 100
+
+def _phone_keys(telephone):
+    """Each phone number as written and as digits only, so '020 5555-1234' matches '55551234'"""
+    keys = []
+    for phone in re.split(r'[,;/]', telephone or ''):
+        keys += [phone.strip(), re.sub(r'\D', '', phone)]
+    return [key for key in keys if key]
+
+def _load_customers():
+    """Customer codes, Lao/English names and phone numbers for the search index"""
+    conn = db_pool.getconn()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT code, name_1, name_2, telephone FROM ar_customer")
+            return cur.fetchall()
+    finally:
+        db_pool.putconn(conn)
+
+def refresh_customer_index():
+    """Sync the customer search index with ar_customer"""
+    global customer_rows
+    with _customer_load_lock:
+        rows = _load_customers()
+        changed, removed = customer_index.sync(
+            {row[0]: ((row[1], row[2]), _phone_keys(row[3])) for row in rows})
+        customer_rows = {row[0]: {'code': row[0], 'name': row[1], 'name_2': row[2], 'telephone': row[3]}
+                         for row in rows}
+    if changed or removed:
+        print(f"Customer index synced: {changed} customers (re)indexed, {removed} removed")
+
+# Used until the index is first built: matches the same fields as the index, walk-in customers first
+CUSTOMER_DB_SEARCH_QUERY = """
+    SELECT code, name_1, name_2, telephone
+    FROM ar_customer
+    WHERE (%(term)s = '' AND code = ANY(%(walk_in)s))
+       OR (%(term)s <> '' AND (code ILIKE %(like)s OR name_1 ILIKE %(like)s OR name_2 ILIKE %(like)s
+           OR telephone ILIKE %(like)s
+           OR (%(digits)s <> '' AND regexp_replace(telephone, '\\D', '', 'g') LIKE %(digits_like)s)))
+    ORDER BY code = ANY(%(walk_in)s) DESC, code = %(term)s DESC,
+             (code ILIKE %(prefix)s OR name_1 ILIKE %(prefix)s OR name_2 ILIKE %(prefix)s) DESC, name_1, code
+    LIMIT %(limit)s
+"""
+
+def _search_customers_db(term, limit):
+    """Customer rows keyed by code for a search answered by ar_customer directly"""
+    digits = re.sub(r'\D', '', term)
+    conn = db_pool.getconn()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(CUSTOMER_DB_SEARCH_QUERY, {
+                'term': term, 'like': f"%{term}%", 'prefix': f"{term}%",
+                'digits': digits, 'digits_like': f"%{digits}%",
+                'walk_in': WALK_IN_CUSTOMER_CODES, 'limit': limit + len(WALK_IN_CUSTOMER_CODES),
+            })
+            rows = cur.fetchall()
+    finally:
+        db_pool.putconn(conn)
+    return {row[0]: {'code': row[0], 'name': row[1], 'name_2': row[2], 'telephone': row[3]} for row in rows}
+
+def search_customers(term, limit, include_walk_in=True):
+    """Walk-in customers matching term (all of them without a term), then the best `limit` other matches"""
+    if not customer_index.loaded:
+        # The index is built in the background at startup; do not make this request wait for it
+        rows = _search_customers_db(term, limit)
+        walk_in = set(WALK_IN_CUSTOMER_CODES)
+        result = []
+        if include_walk_in:
+            result = [dict(rows[code], walk_in=True) for code in WALK_IN_CUSTOMER_CODES if code in rows]
+        result += [dict(row, walk_in=False) for code, row in rows.items() if code not in walk_in][:limit]
+        return result
+
+    rows = customer_rows
+    ranks = customer_index.search(term) if term else {}
+
+    result = []
+    if include_walk_in:
+        result = [dict(rows[code], walk_in=True) for code in WALK_IN_CUSTOMER_CODES
+                  if code in rows and (not term or code in ranks)]
+    walk_in = set(WALK_IN_CUSTOMER_CODES)
+    keys = ((rank, rows[code]['name'] or '', code) for code, rank in ranks.items()
+            if code in rows and code not in walk_in)
+    result += [dict(rows[code], walk_in=False) for _, _, code in heapq.nsmallest(limit, keys)]
+    return result
+
+def _customer_refresh_loop():
+    # Builds the index at startup, then keeps it in sync
+    while True:
+        try:
+            refresh_customer_index()
+        except Exception as e:
+            print(f"Error refreshing customer index: {e}")
+        time.sleep(CUSTOMER_REFRESH_INTERVAL)
+
 @app.route('/health')
 def health_check():
     """Health check endpoint"""
-    return jsonify({'status': 'healthy', 'service': 'flask-pos-api'})
+    return jsonify({'status': 'healthy', 'service': 'flask-pos-api', 'db_pool': db_pool.stats()})
+
+@app.route('/health/db-pool')
+def db_pool_stats():
+    """Connection pool statistics, used to size the pool for the number of terminals"""
+    return jsonify(db_pool.stats())
+
+@app.route('/health/search-index')
+def search_index_stats():
+    """Product search index statistics"""
+    return jsonify(catalog_index.stats())
+
+@app.route('/health/price-cache')
+def price_cache_stats():
+    """Effective price cache statistics"""
+    return jsonify(price_cache.stats())
+
+@app.route('/health/stock-cache')
+def stock_cache_stats():
+    """Stock snapshot cache statistics"""
+    return jsonify(stock_snapshots.stats())
+
+@app.route('/health/customer-index')
+def customer_index_stats():
+    """Customer search index statistics"""
+    return jsonify(customer_index.stats())
+
+@app.route('/health/session-context')
+def session_context_stats():
+    """User profile and exchange rate cache statistics"""
+    return jsonify(session_context.stats())
+
+@app.route('/health/outbox')
+def outbox_stats():
+    """Offline outbox depth and lag, and the database link state"""
+    return jsonify({'outbox': sales_outbox.stats(), 'link': db_link.stats()})
 
 @app.route('/category', methods=['GET'])
 def api_pos_category():
@@ -47,37 +324,19 @@ def api_pos_category():
     # รับค่าพารามิเตอร์จาก query string
     whcode = request.args.get('whcode', '1301')  # ค่า default
     loccode = request.args.get('loccode', '01')  # ค่า default
-    
-    conn = get_connection()
-    if not conn:
-        return jsonify({'success': False, 'error': 'Database connection failed'}), 500
-    
-    cur = conn.cursor(cursor_factory=RealDictCursor)
-    try:
-        cur.execute("""SELECT f.name_1, COUNT(a.ic_code) as count
-                       FROM sml_ic_function_stock_balance_warehouse_location('2099-12-31', '', %s, %s) a
-                       LEFT JOIN ic_inventory b ON b.code = a.ic_code
-                       LEFT JOIN ic_inventory_barcode c ON c.ic_code = b.code
-                       LEFT JOIN ic_group d ON d.code = b.group_main
-                       LEFT JOIN ic_group_sub e ON e.code = b.group_sub
-                       LEFT JOIN ic_category f ON f.code = b.item_category 
-                       WHERE a.balance_qty > 0 AND f.name_1 NOT IN ('ຂອງແຖມ')
-                       GROUP BY f.name_1
-                       ORDER BY f.name_1""", (whcode, loccode))
-
-        result = cur.fetchall()
-        return jsonify({'list': result}), 200
 
+    try:
+        snapshot = get_stock_snapshot(whcode, loccode)
     except Exception as e:
         # Log ข้อผิดพลาดสำหรับ debugging
         print(f"Error fetching categories: {str(e)}")
         return jsonify({'success': False, 'error': str(e)}), 500
 
-    finally:
-        if cur:
-            cur.close()
-        if conn:
-            conn.close()
+    # Counts are maintained by the snapshot as stock moves, one entry per distinct item
+    counts = snapshot.category_counts
+    result = [{'name_1': name, 'count': counts[name]}
+              for name in sorted(counts) if name not in EXCLUDED_CATEGORIES]
+    return jsonify({'list': result}), 200
 
 @app.route('/product', methods=['GET'])
 def api_pos_product():
@@ -87,445 +346,800 @@ def api_pos_product():
     loccode = request.args.get('loccode', '01')  # ค่า default
     category = request.args.get('category', None)  # หมวดหมู่
     search = request.args.get('search', '')  # คำค้นหา
-    limit = request.args.get('limit', 30)  # จำนวนรายการต่อหน้า
-    offset = request.args.get('offset', 0)  # ตำแหน่งเริ่มต้น
+    limit = request.args.get('limit', 30, type=int)  # จำนวนรายการต่อหน้า
+    offset = request.args.get('offset', 0, type=int)  # ตำแหน่งเริ่มต้น (legacy clients)
+    after = request.args.get('after', None)  # cursor จากหน้าก่อนหน้า
     image_status = request.args.get('image_status', None) # Filter for image status
-    
-    conn = get_connection()
-    if not conn:
-        return jsonify({'success': False, 'error': 'Database connection failed'}), 500
-    
-    cur = conn.cursor(cursor_factory=RealDictCursor)
-    try:
-        # สร้าง query สำหรับดึงข้อมูลสินค้า (เวอร์ชันใหม่ตามที่ผู้ใช้ให้มา)
-        query = """
-            SELECT
-                a.ic_code as item_code,
-                a.ic_name as item_name,
-                a.ic_unit_code as unit_code,
-                a.balance_qty as stock_quantity,
-                (SELECT url_image FROM product_image WHERE ic_code = a.ic_code AND line_number = 1) as url_image,
-                COALESCE((SELECT sale_price1 FROM ic_inventory_price
-                          WHERE current_date BETWEEN from_date AND to_date
-                          AND currency_code ='02'
-                          AND ic_code=a.ic_code
-                          AND unit_code=a.ic_unit_code
-                          AND cust_group_1='101'
-                          ORDER BY roworder DESC LIMIT 1), 0) as price
-            FROM
-                sml_ic_function_stock_balance_warehouse_location('2099-12-31', '', %s, %s) a
-            LEFT JOIN ic_inventory b ON b.code = a.ic_code
-        """
-
-        # Build WHERE clauses
-        where_clauses = ["a.balance_qty > 0"]
-        params = [whcode, loccode]
-
-        if category and category != 'All':
-            # Assuming category name is unique
-            where_clauses.append("b.item_category = (SELECT code FROM ic_category WHERE name_1 = %s LIMIT 1)")
-            params.append(category)
-
-        if search:
-            where_clauses.append("(a.ic_name ILIKE %s OR a.ic_code ILIKE %s)")
-            params.extend([f"%{search}%", f"%{search}%"])
 
-        if image_status == 'missing':
-            where_clauses.append("((SELECT url_image FROM product_image WHERE ic_code = a.ic_code AND line_number = 1) IS NULL OR (SELECT url_image FROM product_image WHERE ic_code = a.ic_code AND line_number = 1) = '')")
-
-        if where_clauses:
-            query += " WHERE " + " AND ".join(where_clauses)
+    if limit < 1:
+        return jsonify({'success': False, 'error': 'limit must be at least 1'}), 400
+    try:
+        # Search pages are ordered by (rank, ic_name, ic_code), plain pages by (ic_name, ic_code)
+        key_types = (int, str, str) if search else (str, str)
+        after_key = decode_cursor(after, *key_types) if after else None
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
 
-        # Add ordering, limit, and offset
-        query += " ORDER BY a.ic_name LIMIT %s OFFSET %s"
-        params.extend([limit, offset])  # pyright: ignore[reportArgumentType]
+    try:
+        snapshot = get_stock_snapshot(whcode, loccode)
+    except Exception as e:
+        print(f"Error fetching products: {str(e)}")
+        return jsonify({'success': False, 'error': str(e)}), 500
 
-        cur.execute(query, params)
-        result = cur.fetchall()
-        return jsonify({'list': result}), 200
+    items = snapshot.items
+
+    def matches(row):
+        if row['balance_qty'] <= 0:
+            return False
+        if category and category != 'All' and row.get('category_name') != category:
+            return False
+        if image_status == 'missing' and row.get('url_image'):
+            return False
+        return True
+
+    if search:
+        ranks = search_catalog(search)
+        if ranks is None:
+            # Index unavailable: plain substring match over the snapshot
+            needle = search.lower()
+            ranks = {code: RANK_SUBSTRING for code, row in items.items()
+                     if needle in (row['ic_name'] or '').lower() or needle in code.lower()}
+        # Exact code/barcode hits first, then prefixes, then other matches
+        keys = sorted((rank, items[code]['ic_name'] or '', code)
+                      for code, rank in ranks.items() if code in items and matches(items[code]))
+    else:
+        keys = snapshot.ordered_keys()
+
+    # Walk the keys in order, seeking straight to the cursor
+    start = bisect.bisect_right(keys, after_key) if after_key else 0
+    to_skip = 0 if after_key else offset
+    page = []
+    last_key = None
+    for index in range(start, len(keys)):
+        row = items[keys[index][-1]]
+        if not matches(row):
+            continue
+        if to_skip:
+            to_skip -= 1
+            continue
+        page.append(row)
+        last_key = keys[index]
+        if len(page) >= limit:
+            break
+
+    next_after = encode_cursor(*last_key) if page and len(page) >= limit else None
 
+    try:
+        refresh_prices()
     except Exception as e:
         # Log ข้อผิดพลาดสำหรับ debugging
         print(f"Error fetching products: {str(e)}")
         return jsonify({'success': False, 'error': str(e)}), 500
 
-    finally:
-        if cur:
-            cur.close()
-        if conn:
-            conn.close()
+    result = [{
+        'item_code': row['ic_code'],
+        'item_name': row['ic_name'],
+        'unit_code': row['ic_unit_code'],
+        'stock_quantity': row['balance_qty'],
+        'url_image': row.get('url_image'),
+        'url_thumb': image_store.derivative_url(row.get('url_image'), 'thumb'),
+        'price': price_cache.price(row['ic_code'], row['ic_unit_code']) or 0,
+    } for row in page]
+    return jsonify({'list': result, 'next_after': next_after}), 200
+
+# Warehouses, shelves and customers are served from memory with an ETag; see reference_data.py
+reference_data = ReferenceDataCache(db_pool)
+
+def reference_response(name, build=None, variant=''):
+    """{'list': rows} of a reference dataset, or 304 when the client's ETag is current"""
+    dataset = reference_data.get(name)
+    etag = dataset.etag(variant)
+    if etag_matches(request.headers.get('If-None-Match'), etag):
+        response = app.response_class(status=304)
+    else:
+        response = jsonify({'list': dataset.view(variant, build) if build else dataset.rows})
+    response.headers['ETag'] = etag
+    # Revalidate on every use; a 304 costs no query
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
 
 @app.route('/warehouse', methods=['GET'])
 def api_warehouse():
     """Get list of warehouses"""
-    conn = get_connection()
-    if not conn:
-        return jsonify({'success': False, 'error': 'Database connection failed'}), 500
-    
-    cur = conn.cursor(cursor_factory=RealDictCursor)
     try:
-        cur.execute("SELECT code, name_1 as name FROM ic_warehouse ORDER BY code")
-        result = cur.fetchall()
-        return jsonify({'list': result}), 200
+        return reference_response('warehouses')
 
     except Exception as e:
         print(f"Error fetching warehouses: {str(e)}")
         return jsonify({'success': False, 'error': str(e)}), 500
 
-    finally:
-        if cur:
-            cur.close()
-        if conn:
-            conn.close()
-
 @app.route('/location/<whcode>', methods=['GET'])
 def api_location(whcode):
     """Get locations for a specific warehouse"""
-    conn = get_connection()
-    if not conn:
-        return jsonify({'success': False, 'error': 'Database connection failed'}), 500
-    
-    cur = conn.cursor(cursor_factory=RealDictCursor)
     try:
-        cur.execute("SELECT code, name_1 as name FROM ic_shelf WHERE whcode = %s ORDER BY code", (whcode,))
-        result = cur.fetchall()
-        return jsonify({'list': result}), 200
+        return reference_response(
+            'shelves',
+            lambda rows: [{'code': row['code'], 'name': row['name']} for row in rows if row['whcode'] == whcode],
+            variant=whcode,
+        )
 
     except Exception as e:
         print(f"Error fetching locations: {str(e)}")
         return jsonify({'success': False, 'error': str(e)}), 500
 
-    finally:
-        if cur:
-            cur.close()
-        if conn:
-            conn.close()
+@app.route('/reference-data/refresh', methods=['POST'])
+def refresh_reference_data():
+    """Reload cached reference data now (?name=warehouses|shelves|customers), e.g. after editing it in SML"""
+    name = request.args.get('name')
+    if name and name not in reference_data.datasets:
+        return jsonify({'success': False, 'error': f'Unknown dataset: {name}'}), 400
+    try:
+        return jsonify({'success': True, 'versions': reference_data.invalidate(name)}), 200
+    except Exception as e:
+        print(f"Error refreshing reference data: {str(e)}")
+        return jsonify({'success': False, 'error': str(e)}), 500
 
 @app.route('/customer', methods=['GET'])
 def api_customer():
-    """Get list of customers"""
-    conn = get_connection()
-    if not conn:
-        return jsonify({'success': False, 'error': 'Database connection failed'}), 500
-    
-    cur = conn.cursor(cursor_factory=RealDictCursor)
+    """Get list of customers (?stream=json|ndjson streams the rows as they are read)"""
+    query = reference_data.datasets['customers']
+    fmt = stream_format(request.args.get('stream'), request.headers.get('Accept', ''))
+    if fmt is not None:
+        try:
+            chunks = stream_rows(db_pool, query, fmt=fmt, encode=app.json.dumps, prefix='{"list":[', suffix=']}')
+        except Exception as e:
+            print(f"Error fetching customers: {str(e)}")
+            return jsonify({'success': False, 'error': str(e)}), 500
+        return Response(chunks, mimetype=stream_mimetype(fmt))
+
     try:
-        cur.execute("SELECT code, name_1 as name FROM ar_customer ORDER BY name_1")
-        result = cur.fetchall()
-        return jsonify({'list': result}), 200
+        return reference_response('customers')
 
     except Exception as e:
         print(f"Error fetching customers: {str(e)}")
         return jsonify({'success': False, 'error': str(e)}), 500
 
-    finally:
-        if cur:
-            cur.close()
-        if conn:
-            conn.close()
+@app.route('/customer/search', methods=['GET'])
+def api_customer_search():
+    """Search customers by code, Lao/English name or phone
+
+    Returns walk-in customers first (only those without ?q=), then up to
+    ?limit= other customers, best matches first. ?walk_in=0 leaves the
+    walk-in customers out.
+    """
+    term = request.args.get('q', '').strip()
+    limit = min(max(request.args.get('limit', CUSTOMER_SEARCH_LIMIT, type=int), 0), CUSTOMER_SEARCH_MAX_LIMIT)
+    include_walk_in = request.args.get('walk_in', '1') != '0'
 
-@app.route('/docno', methods=['GET'])
-def api_docno():
-    """Generate new document number"""
-    conn = get_connection()
-    if not conn:
-        return jsonify({'success': False, 'error': 'Database connection failed'}), 500
-    
-    cur = conn.cursor(cursor_factory=RealDictCursor)
     try:
-        # Query สำหรับสร้างเลขที่เอกสารใหม่
-        query = """
-        WITH last_doc AS (
-            SELECT max(doc_no) AS max_doc
-            FROM ic_trans
-            WHERE doc_format_code = 'POS'
-              AND trans_flag = 44
-              AND to_char(doc_date, 'yyyy-mm') = to_char(current_date, 'yyyy-mm')
-        )
-        SELECT 
-            CASE 
-                WHEN max_doc IS NULL 
-                    THEN 'POS' || to_char(current_date, 'YYMM') || '0001'
-                ELSE 'POS' || to_char(current_date, 'YYMM') || 
-                     lpad((right(max_doc, 4)::int + 1)::text, 4, '0')
-            END AS new_doc_no
-        FROM last_doc
-        """
-        
-        cur.execute(query)
-        result = cur.fetchone()
-        return jsonify({'docno': result['new_doc_no']}), 200
+        return jsonify({'list': search_customers(term, limit, include_walk_in)}), 200
 
     except Exception as e:
-        print(f"Error generating document number: {str(e)}")
+        print(f"Error searching customers: {str(e)}")
         return jsonify({'success': False, 'error': str(e)}), 500
 
+# Cashier profiles and exchange rates used by /posbilling, kept in memory; see session_context.py
+session_context = SessionContext(db_pool)
+
+@app.route('/session', methods=['POST'])
+def api_session():
+    """Called after a successful login: (re)load the user's profile so checkout reads it from memory"""
+    user_code = (request.get_json(silent=True) or {}).get('user_code')
+    if not user_code:
+        return jsonify({'success': False, 'error': 'user_code is required'}), 400
+
+    try:
+        profile = session_context.refresh_user(user_code)
+        if profile is None:
+            return jsonify({'success': False, 'error': 'Unknown user'}), 404
+        return jsonify({'success': True, 'user': profile}), 200
+
+    except Exception as e:
+        print(f"Error loading session context: {str(e)}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/session-context/refresh', methods=['POST'])
+def refresh_session_context():
+    """Reload exchange rates (and ?users=1 every user profile) now, e.g. after the daily rate was entered"""
+    try:
+        rates = session_context.invalidate_rates()
+        if request.args.get('users') == '1':
+            session_context.load_users()
+        return jsonify({'success': True, 'rates': rates}), 200
+
+    except Exception as e:
+        print(f"Error refreshing session context: {str(e)}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+# Bills taken while the database link is down or slow wait here; see sales_outbox.py
+SALES_OUTBOX_DB = os.getenv('SALES_OUTBOX_DB', 'sales_outbox.db')
+sales_outbox = SalesOutbox(SALES_OUTBOX_DB)
+db_link = LinkMonitor(db_pool)
+
+# Errors meaning the database could not be reached (or timed out), as opposed to a bad bill
+DB_LINK_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError, PoolTimeout)
+
+# Payload field carrying a queued bill's Idempotency-Key, recorded when the bill is replayed
+OUTBOX_IDEMPOTENCY_FIELD = '_idempotency'
+
+def validate_bill(data):
+    """Stock movements of a /posbilling payload; ValueError if write_bill() could not write it"""
+    if not isinstance(data, dict):
+        raise ValueError('A JSON bill is required')
+    if not data.get('doc_date'):
+        raise ValueError('doc_date is required')
+    try:
+        bill_date(data)
+    except ValueError:
+        raise ValueError('doc_date must be YYYY-MM-DD')
+    try:
+        float(data.get('total_amount', 0))
+        for item in data.get('items', []):
+            float(item['price'])
+            float(item['amount'])
+        return bill_stock_movements(data)
+    except (KeyError, TypeError, ValueError) as e:
+        raise ValueError(f'Invalid bill line: {e!r}')
+
+def queued_bill_response(doc_no):
+    return jsonify({
+        'success': True,
+        'queued': True,
+        'message': 'Bill saved on this server and will be sent when the database is reachable',
+        'doc_no': doc_no,
+        'provisional': outbox_config.is_provisional(doc_no)
+    }), 202
+
+def repeat_of_queued_bill(queued, idempotency_key, request_fingerprint):
+    """Answer a retry of a bill already in the outbox as its first attempt was answered, or with its number once sent"""
+    if queued['payload'][OUTBOX_IDEMPOTENCY_FIELD]['fingerprint'] != request_fingerprint:
+        return jsonify({'success': False,
+                        'error': f"{idempotency.HEADER} {idempotency_key} was already used with a different request"}), 422
+    if queued['sent_doc_no']:
+        response, status = jsonify(bill_response_body(queued['sent_doc_no'])), 200
+    else:
+        response, status = queued_bill_response(queued['doc_no'])
+    response.headers[idempotency.REPLAYED_HEADER] = 'true'
+    return response, status
+
+def queue_bill(data, idempotency_key=None, request_fingerprint=None, doc_no=None):
+    """Store a bill in the local outbox and answer 202; stock is patched locally right away
+
+    doc_no is the number of a bill the link dropped under while it was
+    being written; it keeps that number, since the write may have committed.
+    A retry with the Idempotency-Key of a queued bill gets that bill's
+    answer back and is neither queued nor taken out of stock again.
+    """
+    # Checked before queueing: a bill that cannot be written must be refused now, not after it was accepted
+    try:
+        stock_movements = validate_bill(data)
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    try:
+        queued = sales_outbox.find(idempotency_key) if idempotency_key else None
+    except Exception as e:
+        print(f"Error reading the outbox: {str(e)}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+    if queued is not None:
+        return repeat_of_queued_bill(queued, idempotency_key, request_fingerprint)
+    # Otherwise the bill gets its number when it is replayed; until then the till prints this reference
+    if doc_no is None:
+        doc_no = outbox_config.new_reference()
+    outbox_key = idempotency_key
+    if not idempotency_key and outbox_config.is_provisional(doc_no):
+        # Without a number, the key is what keeps a replay from writing the bill twice
+        outbox_key = f"outbox-{doc_no}"
+        request_fingerprint = idempotency.fingerprint(data)
+    data = dict(data, doc_no=doc_no)
+    if outbox_key:
+        data[OUTBOX_IDEMPOTENCY_FIELD] = {'key': outbox_key, 'fingerprint': request_fingerprint}
+    try:
+        queued = sales_outbox.enqueue(doc_no, data, outbox_key)
+        # Lost a race with a concurrent retry of the same request
+        repeat = None if queued or not idempotency_key else sales_outbox.find(idempotency_key)
+    except Exception as e:
+        print(f"Error queueing bill {doc_no}: {str(e)}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+    if repeat is not None:
+        return repeat_of_queued_bill(repeat, idempotency_key, request_fingerprint)
+    if queued:
+        stock_snapshots.apply_movements(stock_movements)
+    return queued_bill_response(doc_no)
+
+def _write_queued_bill(cur, entry, doc_no):
+    """write_bill() for a replayed bill, recording its Idempotency-Key with the response a client would have got
+
+    A bill queued under a provisional reference is written as doc_no, the
+    number allocated for it at replay in the month of its doc_date. A bill
+    queued because the link dropped while it was being written keeps its
+    number and is skipped if that write did commit. Returns the bill number
+    written, or None if the bill had already been written under another key.
+    """
+    payload = entry.payload
+    keyed = payload.get(OUTBOX_IDEMPOTENCY_FIELD)
+    if keyed:
+        if not idempotency.claim(cur, 'posbilling', keyed['key'], keyed['fingerprint']):
+            # Already written: online under the same key, or by a replay that could not mark it sent
+            try:
+                stored = idempotency.lookup(cur, 'posbilling', keyed['key'], keyed['fingerprint'])
+            except (idempotency.KeyInUse, idempotency.KeyMismatch):
+                stored = None
+            return app.json.loads(stored[1]).get('doc_no') if stored else None
+    if not outbox_config.is_provisional(entry.doc_no):
+        cur.execute("SELECT 1 FROM ic_trans WHERE trans_flag = 44 AND doc_no = %s", (entry.doc_no,))
+        if cur.fetchone():
+            return entry.doc_no
+    # Dated and timed when the sale was made, not when the link came back
+    write_bill(cur, payload, doc_no, sold_at=datetime.fromtimestamp(entry.created_at))
+    if keyed:
+        idempotency.store_response(cur, 'posbilling', keyed['key'], 200,
+                                   app.json.dumps(bill_response_body(doc_no)))
+    return doc_no
+
+def _replay_one_by_one(conn, batch, numbers, written):
+    """Send bills one transaction each, in order, setting aside any the database rejects; returns how many were sent"""
+    sent = 0
+    for entry in batch:
+        try:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                doc_no = _write_queued_bill(cur, entry, numbers[entry.seq])
+            conn.commit()
+        except DB_LINK_ERRORS:
+            conn.rollback()
+            raise
+        except Exception as e:
+            conn.rollback()
+            # Not a link problem, so sending it again will not help: set it aside for review
+            print(f"Error replaying bill {entry.doc_no}, set aside as failed: {str(e)}")
+            sales_outbox.mark_failed(entry.seq, e)
+            continue
+        written[entry.seq] = doc_no
+        sales_outbox.mark_sent({entry.seq: doc_no})
+        sent += 1
+    return sent
+
+def replay_outbox():
+    """Send queued bills to the database in the order they were taken; returns how many were sent"""
+    sent = 0
+    while True:
+        batch = sales_outbox.pending(outbox_config.BATCH_SIZE)
+        if not batch:
+            return sent
+        # Numbers for provisional bills, allocated before the connection is taken (see doc_numbers.py)
+        allocated = {entry.seq: doc_numbers.next('POS', bill_date(entry.payload))
+                     for entry in batch if outbox_config.is_provisional(entry.doc_no)}
+        numbers = {entry.seq: allocated.get(entry.seq, entry.doc_no) for entry in batch}
+        written = {}
+        conn = db_pool.getconn()
+        try:
+            conn.autocommit = False
+            try:
+                # The whole batch in one transaction
+                with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                    batch_written = {entry.seq: _write_queued_bill(cur, entry, numbers[entry.seq]) for entry in batch}
+                conn.commit()
+            except DB_LINK_ERRORS:
+                conn.rollback()
+                raise
+            except Exception:
+                # Some bill in the batch is bad: send the others one by one
+                conn.rollback()
+                return sent + _replay_one_by_one(conn, batch, numbers, written)
+            written = batch_written
+            sales_outbox.mark_sent(written)
+            sent += len(batch)
+        finally:
+            release_connection(conn)
+            # Numbers of bills not written (rejected, or already written under their key)
+            for seq in sorted(allocated, reverse=True):
+                if written.get(seq) != allocated[seq]:
+                    doc_numbers.put_back('POS', [allocated[seq]])
+
+def _outbox_loop():
+    # Probes the link; while it is healthy, drains the queue
+    while True:
+        if db_link.probe():
+            try:
+                if sales_outbox.depth():
+                    sent = replay_outbox()
+                    if sent:
+                        print(f"Replayed {sent} queued bills, {sales_outbox.depth()} still queued")
+            except DB_LINK_ERRORS as e:
+                db_link.mark_down(e)
+            except Exception as e:
+                print(f"Error replaying queued bills: {e}")
+        time.sleep(outbox_config.PROBE_INTERVAL)
+
+@app.route('/outbox/failed', methods=['GET'])
+def api_outbox_failed():
+    """Queued bills the database rejected"""
+    return jsonify({'list': sales_outbox.failed()}), 200
+
+@app.route('/outbox/retry', methods=['POST'])
+def api_outbox_retry():
+    """Queue set-aside bills again (after fixing whatever made them fail)"""
+    return jsonify({'success': True, 'requeued': sales_outbox.retry_failed()}), 200
+
+def bill_response_body(doc_no):
+    return {
+        'success': True,
+        'message': 'Transaction completed and financial records created successfully',
+        'doc_no': doc_no
+    }
+
+def ensure_idempotency_table():
+    conn = db_pool.getconn()
+    try:
+        with conn.cursor() as cur:
+            idempotency.ensure_table(cur)
+        conn.commit()
     finally:
-        if cur:
-            cur.close()
-        if conn:
-            conn.close()
+        db_pool.putconn(conn)
+
+def idempotent_replay(stored):
+    """The stored response of an earlier request with the same Idempotency-Key"""
+    status_code, response_text = stored
+    response = app.response_class(response_text, status=status_code, mimetype='application/json')
+    response.headers[idempotency.REPLAYED_HEADER] = 'true'
+    return response
+
+def bill_date(data):
+    """doc_date of a /posbilling payload as a date"""
+    return date.fromisoformat(str(data['doc_date'])[:10])
+
+def bill_stock_movements(data):
+    """Stock moves out of the selling shelf for each line of a /posbilling payload"""
+    wh_code = data.get('wh_code', '1301')
+    shelf_code = data.get('shelf_code', '01')
+    return [{
+        'wh_code': wh_code,
+        'shelf_code': shelf_code,
+        'item_code': item['item_code'],
+        'qty': -float(item['qty']),
+        'item_name': item['item_name'],
+        'unit_code': item['unit_code'],
+    } for item in data.get('items', [])]
+
+def write_bill(cur, data, doc_no, sold_at=None):
+    """Insert one POS bill numbered doc_no and its financial records on cur's transaction; the caller commits.
+
+    sold_at (a datetime) is the time of sale for a bill written after the fact,
+    e.g. replayed from the outbox; it sets doc_time and create_datetime, and
+    lastedit_datetime records when the bill actually reached the database.
+    Without it the database clock is used. Returns the bill's stock movements,
+    which other services are told about on commit.
+    """
+    # --- Part 1: Insert into ic_trans and ic_trans_detail ---
+    doc_date = data.get('doc_date')
+    customer_code = data.get('customer_code')
+    total_amount = data.get('total_amount', 0)
+    items = data.get('items', [])
+    
+    # Get user-specific data from the payload
+    user_code = data.get('user_code', 'SYSTEM')
+    wh_code = data.get('wh_code', '1301') # Use user's warehouse or default
+    shelf_code = data.get('shelf_code', '01') # Use user's shelf or default
+    branch_code = data.get('branch_code', '00') # Use user's branch or default
+    payment_method = data.get('payment_method', 'cash') # Get payment_method, default to 'cash'
+
+    # side_code and department_code come from the cached erp_user profile of user_code
+    user_info_result = session_context.user(user_code, cur)
+    
+    side_code = user_info_result['side'] if user_info_result and user_info_result['side'] is not None else ''
+    department_code = user_info_result['department'] if user_info_result and user_info_result['department'] is not None else ''
+
+    # Extract additional fields for ic_trans from payload
+    remark = data.get('remark', '')
+
+    # Define constants for ic_trans
+    INQUIRY_TYPE_IC_TRANS = 1
+    VAT_TYPE_IC_TRANS = 2
+    VAT_RATE_IC_TRANS = 10
+    CURRENCY_CODE_IC_TRANS = '02' # LAK
+
+    # Cached exchange rate for LAK (code '02')
+    exchange_rate_lak = session_context.exchange_rate(CURRENCY_CODE_IC_TRANS, 0.0015673, cur) # Default to example rate if not found
+
+    # Calculate total amounts in primary currency (Baht)
+    total_amount_lak = float(total_amount) # total_amount from payload is in LAK
+    total_amount_baht = total_amount_lak * exchange_rate_lak
+    total_value_baht = total_amount_baht # Assuming total_value and total_amount are the same for now
+
+    # Apply rounding to 2 decimal places for ic_trans monetary values
+    total_amount_lak = round(total_amount_lak, 2)
+    total_amount_baht = round(total_amount_baht, 2)
+    total_value_baht = round(total_value_baht, 2)
+
+    # --- ic_trans INSERT ---
+    trans_query = """
+    INSERT INTO ic_trans (
+        trans_type, trans_flag, doc_date, doc_no, doc_time,
+        branch_code, project_code, sale_code, doc_format_code,
+        cust_code, total_amount_2, creator_code, create_datetime, lastedit_datetime,
+        side_code, department_code, inquiry_type, vat_type, vat_rate,
+        currency_code, exchange_rate, total_value, total_amount, remark, cashier_code,
+        total_value_2
+    ) VALUES (
+        2, 44, %s, %s, COALESCE(%s, LEFT(CAST(CURRENT_TIME AS VARCHAR), 5)),
+        %s, %s, %s, %s,
+        %s, %s, %s, COALESCE(%s::timestamp, CURRENT_TIMESTAMP), CASE WHEN %s THEN CURRENT_TIMESTAMP END,
+        %s, %s, %s, %s, %s,
+        %s, %s, %s, %s, %s, %s,
+        %s
+    )
+    RETURNING doc_time, create_datetime
+    """
+    cur.execute(trans_query, (
+        doc_date, doc_no, sold_at.strftime('%H:%M') if sold_at else None,
+        branch_code, '', user_code, 'POS',
+        customer_code, total_amount_lak, user_code, sold_at, sold_at is not None,
+        side_code, department_code, INQUIRY_TYPE_IC_TRANS, VAT_TYPE_IC_TRANS, VAT_RATE_IC_TRANS,
+        CURRENCY_CODE_IC_TRANS, exchange_rate_lak, total_value_baht, total_amount_baht, remark, user_code,
+        total_amount_lak
+    ))
+    header = cur.fetchone()
+    doc_time = header['doc_time']
+    create_datetime = header['create_datetime']
+
+    # --- ic_trans_detail INSERT ---
+    # Fetch average_cost for every item in one round trip
+    average_cost_query = "SELECT code, COALESCE(average_cost, 0) AS average_cost FROM ic_inventory WHERE code = ANY(%s)"
+    cur.execute(average_cost_query, (list({item['item_code'] for item in items}),))
+    average_costs = {row['code']: float(row['average_cost']) for row in cur.fetchall()}
+
+    detail_rows = []
+    for idx, item in enumerate(items):
+        item_price_lak = float(item['price'])
+        item_amount_lak = float(item['amount'])
+        item_price_baht = item_price_lak * exchange_rate_lak
+        item_sum_amount_baht = item_amount_lak * exchange_rate_lak
+
+        # Apply rounding to 2 decimal places for monetary values
+        item_price_lak = round(item_price_lak, 2)
+        item_amount_lak = round(item_amount_lak, 2)
+        item_price_baht = round(item_price_baht, 2)
+        item_sum_amount_baht = round(item_sum_amount_baht, 2)
+
+        fetched_average_cost = average_costs.get(item['item_code'], 0.0)
+
+        item_qty = float(item['qty'])
+        calculated_sum_of_cost = fetched_average_cost * item_qty
+
+        # Apply rounding to 4 decimal places for cost values
+        fetched_average_cost = round(fetched_average_cost, 4)
+        calculated_sum_of_cost = round(calculated_sum_of_cost, 4)
+
+        detail_rows.append((
+            2, 44, doc_date, doc_no, customer_code, 1,
+            item['item_code'], item['item_name'], item['unit_code'], item_qty,
+            item_price_baht, item_sum_amount_baht, # price, sum_amount
+            item_price_lak, item_amount_lak, # price_2, sum_amount_2
+            fetched_average_cost, calculated_sum_of_cost, # average_cost, sum_of_cost
+            fetched_average_cost, calculated_sum_of_cost, # average_cost_1, sum_of_cost_1
+            item_price_baht, item_sum_amount_baht, # price_exclude_vat, sum_amount_exclude_vat
+            idx + 1, branch_code, wh_code, shelf_code, # line_number, branch, wh, shelf
+            2, # vat_type
+            doc_time, # doc_time, as on the header
+            doc_date, # doc_date_calc
+            doc_time, # doc_time_calc
+            user_code, # sale_code
+            user_code, # creator_code
+            create_datetime # create_datetime, as on the header
+        ))
+
+    detail_query = """
+    INSERT INTO ic_trans_detail(
+        trans_type,trans_flag,doc_date,doc_no,cust_code,inquiry_type,
+        item_code,item_name,unit_code,qty,
+        price,sum_amount,
+        price_2,sum_amount_2,
+        discount,discount_amount,
+        average_cost,sum_of_cost,
+        average_cost_1,sum_of_cost_1,
+        price_exclude_vat,sum_amount_exclude_vat,
+        line_number,branch_code,wh_code,shelf_code,stand_value,divide_value,calc_flag,set_ref_price,item_type,vat_type,doc_time,is_get_price,
+        doc_date_calc,doc_time_calc,
+        sale_code,sale_group, creator_code, create_datetime
+    ) VALUES %s
+    """
+    detail_template = """(
+        %s, %s, %s, %s, %s, %s,
+        %s, %s, %s, %s,
+        %s, %s, -- price, sum_amount (Baht)
+        %s, %s, -- price_2, sum_amount_2 (Kip)
+        '', 0,
+        %s, %s, -- average_cost, sum_of_cost
+        %s, %s, -- average_cost_1, sum_of_cost_1
+        %s, %s, -- price_exclude_vat, sum_amount_exclude_vat (Baht)
+        %s, %s, %s, %s, 1, 1, -1, 0, 0, %s, %s, 0,
+        %s, %s,
+        %s, '', %s, %s
+    )"""
+    # All lines go to the server in a single multi-row INSERT
+    if detail_rows:
+        execute_values(cur, detail_query, detail_rows, template=detail_template, page_size=len(detail_rows))
+
+    # --- Part 1.5: Insert into ic_trans_shipment ---
+    shipment_query = """
+    INSERT INTO ic_trans_shipment (
+        doc_no, doc_date, cust_code, create_date_time_now
+    ) VALUES (%s, %s, %s, %s)
+    """
+    cur.execute(shipment_query, (doc_no, doc_date, customer_code, create_datetime))
+
+    # --- Part 2: Add financial records in cb_trans and cb_trans_detail (New Logic) ---
+    
+    # The header was just written, so its values are reused instead of being read back
+    CB_TRANS_TYPE = 2
+    CB_TRANS_FLAG = 44
+    CB_PAY_TYPE = 1
+    CB_DOC_TYPE = 1
+    CURRENCY_CODE_LAK = '02'
+
+    total_amount_cb_lak = total_amount_lak # Total amount in Kip
+    total_amount_cb_baht = round(total_amount_cb_lak * exchange_rate_lak, 2)
+
+    cash_amount_baht = 0.0
+    tranfer_amount_val_baht = 0.0
+    card_amount_baht = 0.0
+
+    if payment_method == 'cash':
+        cash_amount_baht = total_amount_cb_baht
+    elif payment_method == 'transfer':
+        tranfer_amount_val_baht = total_amount_cb_baht
+    elif payment_method == 'card':
+        card_amount_baht = total_amount_cb_baht
+
+    sql_h = """
+    INSERT INTO cb_trans
+    (trans_type, trans_flag, doc_date, doc_no, total_amount, total_net_amount, tranfer_amount, total_amount_pay, doc_time, ap_ar_code, pay_type, doc_format_code, total_other_currency)
+    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+    """
+    cur.execute(sql_h, (
+        CB_TRANS_TYPE, CB_TRANS_FLAG, doc_date, doc_no,
+        total_amount_cb_baht, total_amount_cb_baht, tranfer_amount_val_baht, total_amount_cb_baht,
+        doc_time, customer_code, CB_PAY_TYPE, 'POS',
+        round(cash_amount_baht, 2) if payment_method == 'cash' else 0.0 # total_other_currency
+    ))
+
+    # --- Logic for payment method ---
+    cb_bank_code = None
+    cb_bank_branch = None
+    if payment_method == 'transfer':
+        cb_bank_code = 'BCEL001'
+        cb_bank_branch = 'BCEL01'
+    
+    # Conditional trans_number and doc_type for cb_trans_detail
+    cb_trans_detail_doc_type = CB_DOC_TYPE # Default to 1
+    cb_trans_detail_trans_number = doc_no # Default to doc_no
+    cb_trans_detail_sum_amount = total_amount_cb_baht # Always Baht equivalent
+
+    if payment_method == 'cash':
+        cb_trans_detail_doc_type = 19
+        cb_trans_detail_trans_number = '02'
+    elif payment_method == 'transfer':
+        cb_trans_detail_trans_number = '1010201' # As per user's instruction
+
+    sum_amount_2_calculated = round(exchange_rate_lak * total_amount_lak, 2) # sum_amount_2 is Baht, rounded
+
+    sql_detail = """
+    INSERT INTO cb_trans_detail
+    (trans_type, trans_flag, doc_date, doc_no, trans_number, bank_code, bank_branch, exchange_rate, amount, sum_amount, chq_due_date, doc_type, doc_time, currency_code, sum_amount_2)
+    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+    """
+    cur.execute(sql_detail, (
+        CB_TRANS_TYPE, CB_TRANS_FLAG, doc_date, doc_no,
+        cb_trans_detail_trans_number,
+        cb_bank_code,
+        cb_bank_branch,
+        exchange_rate_lak,
+        round(total_amount_cb_lak, 2), # amount (Kip), rounded
+        round(cb_trans_detail_sum_amount, 2), # sum_amount (Baht), rounded
+        doc_date,
+        cb_trans_detail_doc_type,
+        doc_time,
+        CURRENCY_CODE_LAK,
+        sum_amount_2_calculated # sum_amount_2 (Baht), already rounded
+    ))
+
+    stock_movements = bill_stock_movements(data)
+    notify_stock_movements(cur, stock_movements)
+    return stock_movements
 
 @app.route('/posbilling', methods=['POST'])
 def api_pos_billing():
-    """Process POS billing/transaction and create corresponding financial records."""
+    """Process POS billing/transaction and create corresponding financial records.
+
+    While the database link is down or slow the bill goes to the local
+    outbox instead (202 with 'queued': true) and is replayed later.
+
+    The bill number is allocated by the server and returned as doc_no.
+    With an Idempotency-Key header a retried request gets the first
+    request's response back instead of writing the bill twice.
+    """
     data = request.get_json()
     print(f"Received billing data: {data}")
 
+    idempotency_key = request.headers.get(idempotency.HEADER)
+    request_fingerprint = None
+    if idempotency_key is not None:
+        try:
+            idempotency.validate_key(idempotency_key)
+        except ValueError as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
+        request_fingerprint = idempotency.fingerprint(data)
+
+    try:
+        validate_bill(data)
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+
+    if not db_link.healthy:
+        return queue_bill(data, idempotency_key, request_fingerprint)
+
+    # Allocated before the connection is taken (see doc_numbers.py); usually from memory
+    try:
+        doc_no = doc_numbers.next('POS', bill_date(data))
+    except DB_LINK_ERRORS as e:
+        db_link.mark_down(e)
+        return queue_bill(data, idempotency_key, request_fingerprint)
+    except Exception as e:
+        print(f"Error allocating a bill number: {str(e)}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
     conn = get_connection()
     if not conn:
-        return jsonify({'success': False, 'error': 'Database connection failed'}), 500
+        doc_numbers.put_back('POS', [doc_no])
+        db_link.mark_down('no database connection')
+        return queue_bill(data, idempotency_key, request_fingerprint)
 
     cur = conn.cursor(cursor_factory=RealDictCursor)
     try:
         # Start transaction
         conn.autocommit = False
 
-        # --- Part 1: Insert into ic_trans and ic_trans_detail ---
-        doc_no = data.get('doc_no')
-        doc_date = data.get('doc_date')
-        customer_code = data.get('customer_code')
-        total_amount = data.get('total_amount', 0)
-        items = data.get('items', [])
-        
-        # Get user-specific data from the payload
-        user_code = data.get('user_code', 'SYSTEM')
-        wh_code = data.get('wh_code', '1301') # Use user's warehouse or default
-        shelf_code = data.get('shelf_code', '01') # Use user's shelf or default
-        branch_code = data.get('branch_code', '00') # Use user's branch or default
-        payment_method = data.get('payment_method', 'cash') # Get payment_method, default to 'cash'
-
-        # Fetch side_code and department_code from erp_user based on user_code
-        user_info_query = "SELECT side, department FROM erp_user WHERE code = %s LIMIT 1"
-        cur.execute(user_info_query, (user_code,))
-        user_info_result = cur.fetchone()
-        
-        side_code = user_info_result['side'] if user_info_result and user_info_result['side'] is not None else ''
-        department_code = user_info_result['department'] if user_info_result and user_info_result['department'] is not None else ''
-
-        # Extract additional fields for ic_trans from payload
-        remark = data.get('remark', '')
-
-        # Define constants for ic_trans
-        INQUIRY_TYPE_IC_TRANS = 1
-        VAT_TYPE_IC_TRANS = 2
-        VAT_RATE_IC_TRANS = 10
-        CURRENCY_CODE_IC_TRANS = '02' # LAK
-
-        # Fetch exchange rate for LAK (code '02')
-        exchange_rate_query = "SELECT COALESCE(exchange_rate_present, 0) FROM erp_currency WHERE code='02' LIMIT 1"
-        cur.execute(exchange_rate_query)
-        exchange_rate_result = cur.fetchone()
-        exchange_rate_lak = float(exchange_rate_result['coalesce']) if exchange_rate_result and exchange_rate_result['coalesce'] is not None else 0.0015673 # Default to example rate if not found
-
-        # Calculate total amounts in primary currency (Baht)
-        total_amount_lak = float(total_amount) # total_amount from payload is in LAK
-        total_amount_baht = total_amount_lak * exchange_rate_lak
-        total_value_baht = total_amount_baht # Assuming total_value and total_amount are the same for now
-
-        # Apply rounding to 2 decimal places for ic_trans monetary values
-        total_amount_lak = round(total_amount_lak, 2)
-        total_amount_baht = round(total_amount_baht, 2)
-        total_value_baht = round(total_value_baht, 2)
-
-        # --- ic_trans INSERT ---
-        trans_query = """
-        INSERT INTO ic_trans (
-            trans_type, trans_flag, doc_date, doc_no, doc_time,
-            branch_code, project_code, sale_code, doc_format_code,
-            cust_code, total_amount_2, creator_code, create_datetime,
-            side_code, department_code, inquiry_type, vat_type, vat_rate,
-            currency_code, exchange_rate, total_value, total_amount, remark, cashier_code,
-            total_value_2
-        ) VALUES (
-            2, 44, %s, %s, LEFT(CAST(CURRENT_TIME AS VARCHAR), 5),
-            %s, %s, %s, %s,
-            %s, %s, %s, CURRENT_TIMESTAMP,
-            %s, %s, %s, %s, %s,
-            %s, %s, %s, %s, %s, %s,
-            %s
-        )
-        """
-        cur.execute(trans_query, (
-            doc_date, doc_no,
-            branch_code, '', user_code, 'POS',
-            customer_code, total_amount_lak, user_code,
-            side_code, department_code, INQUIRY_TYPE_IC_TRANS, VAT_TYPE_IC_TRANS, VAT_RATE_IC_TRANS,
-            CURRENCY_CODE_IC_TRANS, exchange_rate_lak, total_value_baht, total_amount_baht, remark, user_code,
-            total_amount_lak
-        ))
+        if idempotency_key:
+            stored = idempotency.begin(cur, 'posbilling', idempotency_key, request_fingerprint)
+            if stored is not None:
+                conn.rollback()
+                doc_numbers.put_back('POS', [doc_no])
+                return idempotent_replay(stored)
 
-        # --- ic_trans_detail INSERT ---
-        for idx, item in enumerate(items):
-            item_price_lak = float(item['price'])
-            item_amount_lak = float(item['amount'])
-            item_price_baht = item_price_lak * exchange_rate_lak
-            item_sum_amount_baht = item_amount_lak * exchange_rate_lak
-
-            # Apply rounding to 2 decimal places for monetary values
-            item_price_lak = round(item_price_lak, 2)
-            item_amount_lak = round(item_amount_lak, 2)
-            item_price_baht = round(item_price_baht, 2)
-            item_sum_amount_baht = round(item_sum_amount_baht, 2)
-
-            # Fetch average_cost for the item
-            average_cost_query = "SELECT COALESCE(average_cost, 0) FROM ic_inventory WHERE code = %s LIMIT 1"
-            cur.execute(average_cost_query, (item['item_code'],))
-            average_cost_result = cur.fetchone()
-            fetched_average_cost = float(average_cost_result['coalesce']) if average_cost_result and average_cost_result['coalesce'] is not None else 0.0
-
-            item_qty = float(item['qty'])
-            calculated_sum_of_cost = fetched_average_cost * item_qty
-
-            # Apply rounding to 4 decimal places for cost values
-            fetched_average_cost = round(fetched_average_cost, 4)
-            calculated_sum_of_cost = round(calculated_sum_of_cost, 4)
-
-            detail_query = """
-            INSERT INTO ic_trans_detail(
-                trans_type,trans_flag,doc_date,doc_no,cust_code,inquiry_type,
-                item_code,item_name,unit_code,qty,
-                price,sum_amount,
-                price_2,sum_amount_2,
-                discount,discount_amount,
-                average_cost,sum_of_cost,
-                average_cost_1,sum_of_cost_1,
-                price_exclude_vat,sum_amount_exclude_vat,
-                line_number,branch_code,wh_code,shelf_code,stand_value,divide_value,calc_flag,set_ref_price,item_type,vat_type,doc_time,is_get_price,
-                doc_date_calc,doc_time_calc,
-                sale_code,sale_group, creator_code, create_datetime
-            ) VALUES (
-                %s, %s, %s, %s, %s, %s,
-                %s, %s, %s, %s,
-                %s, %s, -- price, sum_amount (Baht)
-                %s, %s, -- price_2, sum_amount_2 (Kip)
-                '', 0,
-                %s, %s, -- average_cost, sum_of_cost
-                %s, %s, -- average_cost_1, sum_of_cost_1
-                %s, %s, -- price_exclude_vat, sum_amount_exclude_vat (Baht)
-                                %s, %s, %s, %s, 1, 1, -1, 0, 0, %s, LEFT(CAST(CURRENT_TIME AS VARCHAR), 5), 0,
-                                %s, LEFT(CAST(CURRENT_TIME AS VARCHAR), 5),
-                                %s, '', %s, CURRENT_TIMESTAMP
-                            )
-                            """
-                
-            params = (
-                2, 44, doc_date, doc_no, customer_code, 1,
-                item['item_code'], item['item_name'], item['unit_code'], item_qty,
-                item_price_baht, item_sum_amount_baht, # price, sum_amount
-                item_price_lak, item_amount_lak, # price_2, sum_amount_2
-                fetched_average_cost, calculated_sum_of_cost, # average_cost, sum_of_cost
-                fetched_average_cost, calculated_sum_of_cost, # average_cost_1, sum_of_cost_1
-                item_price_baht, item_sum_amount_baht, # price_exclude_vat, sum_amount_exclude_vat
-                idx + 1, branch_code, wh_code, shelf_code, # line_number, branch, wh, shelf
-                2, # vat_type
-                doc_date, # doc_date_calc
-                user_code, # sale_code
-                user_code # creator_code
-            )
-            cur.execute(detail_query, params)
-
-        # --- Part 1.5: Insert into ic_trans_shipment ---
-        shipment_query = """
-        INSERT INTO ic_trans_shipment (
-            doc_no, doc_date, cust_code, create_date_time_now
-        ) VALUES (%s, %s, %s, CURRENT_TIMESTAMP)
-        """
-        cur.execute(shipment_query, (doc_no, doc_date, customer_code))
+        stock_movements = write_bill(cur, data, doc_no)
 
-        # --- Part 2: Add financial records in cb_trans and cb_trans_detail (New Logic) ---
-        
-        sql_head = """SELECT doc_no, doc_date, total_amount_2, doc_time, cust_code, doc_format_code,
-                           (SELECT COALESCE(exchange_rate_present, 0) FROM erp_currency WHERE code='02' LIMIT 1) as exchange_lak
-                           FROM ic_trans WHERE doc_no=%s"""
-        cur.execute(sql_head, (doc_no,))
-        bill_h = cur.fetchone()
-
-        if not bill_h:
-            raise Exception(f"Failed to retrieve ic_trans record for doc_no: {doc_no}")
-
-        CB_TRANS_TYPE = 2
-        CB_TRANS_FLAG = 44
-        CB_PAY_TYPE = 1
-        CB_DOC_TYPE = 1
-        CURRENCY_CODE_LAK = '02'
-
-        total_amount_cb_lak = bill_h["total_amount_2"] # Total amount in Kip
-        total_amount_cb_baht = round(total_amount_cb_lak * bill_h["exchange_lak"], 2)
-
-        cash_amount_baht = 0.0
-        tranfer_amount_val_baht = 0.0
-        card_amount_baht = 0.0
-
-        if payment_method == 'cash':
-            cash_amount_baht = total_amount_cb_baht
-        elif payment_method == 'transfer':
-            tranfer_amount_val_baht = total_amount_cb_baht
-        elif payment_method == 'card':
-            card_amount_baht = total_amount_cb_baht
-
-        sql_h = """
-        INSERT INTO cb_trans
-        (trans_type, trans_flag, doc_date, doc_no, total_amount, total_net_amount, tranfer_amount, total_amount_pay, doc_time, ap_ar_code, pay_type, doc_format_code, total_other_currency)
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-        """
-        cur.execute(sql_h, (
-            CB_TRANS_TYPE, CB_TRANS_FLAG, bill_h["doc_date"], bill_h["doc_no"],
-            total_amount_cb_baht, total_amount_cb_baht, tranfer_amount_val_baht, total_amount_cb_baht,
-            bill_h["doc_time"], bill_h["cust_code"], CB_PAY_TYPE, bill_h["doc_format_code"],
-            round(cash_amount_baht, 2) if payment_method == 'cash' else 0.0 # total_other_currency
-        ))
-
-        # --- Logic for payment method ---
-        cb_bank_code = None
-        cb_bank_branch = None
-        if payment_method == 'transfer':
-            cb_bank_code = 'BCEL001'
-            cb_bank_branch = 'BCEL01'
-        
-        # Conditional trans_number and doc_type for cb_trans_detail
-        cb_trans_detail_doc_type = CB_DOC_TYPE # Default to 1
-        cb_trans_detail_trans_number = doc_no # Default to doc_no
-        cb_trans_detail_sum_amount = total_amount_cb_baht # Always Baht equivalent
-
-        if payment_method == 'cash':
-            cb_trans_detail_doc_type = 19
-            cb_trans_detail_trans_number = '02'
-        elif payment_method == 'transfer':
-            cb_trans_detail_trans_number = '1010201' # As per user's instruction
-
-        sum_amount_2_calculated = round(bill_h["exchange_lak"] * bill_h["total_amount_2"], 2) # sum_amount_2 is Baht, rounded
-
-        sql_detail = """
-        INSERT INTO cb_trans_detail
-        (trans_type, trans_flag, doc_date, doc_no, trans_number, bank_code, bank_branch, exchange_rate, amount, sum_amount, chq_due_date, doc_type, doc_time, currency_code, sum_amount_2)
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-        """
-        cur.execute(sql_detail, (
-            CB_TRANS_TYPE, CB_TRANS_FLAG, bill_h["doc_date"], bill_h["doc_no"],
-            cb_trans_detail_trans_number,
-            cb_bank_code,
-            cb_bank_branch,
-            bill_h["exchange_lak"],
-            round(total_amount_cb_lak, 2), # amount (Kip), rounded
-            round(cb_trans_detail_sum_amount, 2), # sum_amount (Baht), rounded
-            bill_h["doc_date"],
-            cb_trans_detail_doc_type,
-            bill_h["doc_time"],
-            CURRENCY_CODE_LAK,
-            sum_amount_2_calculated # sum_amount_2 (Baht), already rounded
-        ))
+        body = bill_response_body(doc_no)
+        if idempotency_key:
+            idempotency.store_response(cur, 'posbilling', idempotency_key, 200, app.json.dumps(body))
 
         conn.commit()
+        stock_snapshots.apply_movements(stock_movements)
 
-        return jsonify({
-            'success': True,
-            'message': 'Transaction completed and financial records created successfully',
-            'doc_no': doc_no
-        }), 200
+        return jsonify(body), 200
+
+    except idempotency.KeyMismatch as e:
+        conn.rollback()
+        doc_numbers.put_back('POS', [doc_no])
+        return jsonify({'success': False, 'error': str(e)}), 422
+
+    except idempotency.KeyInUse as e:
+        conn.rollback()
+        doc_numbers.put_back('POS', [doc_no])
+        return jsonify({'success': False, 'error': str(e)}), 409
+
+    except DB_LINK_ERRORS as e:
+        # The link dropped mid-bill and the commit may have landed: the bill is queued under its
+        # number, and the replay skips it if that number (or its Idempotency-Key) is already written
+        try:
+            conn.rollback()
+        except Exception:
+            pass
+        print(f"Database link error while billing, queueing the bill: {str(e)}")
+        db_link.mark_down(e)
+        return queue_bill(data, idempotency_key, request_fingerprint, doc_no=doc_no)
 
     except Exception as e:
         conn.rollback()
+        doc_numbers.put_back('POS', [doc_no])
         print(f"Error processing transaction: {str(e)}")
         return jsonify({'success': False, 'error': str(e)}), 500
 
@@ -533,23 +1147,53 @@ def api_pos_billing():
         if cur:
             cur.close()
         if conn:
-            conn.close()
+            release_connection(conn)
 
-import uuid
 from werkzeug.utils import secure_filename
 from flask import send_from_directory
 
-UPLOAD_FOLDER = 'uploads/image/product'
+UPLOAD_FOLDER = image_store.UPLOAD_FOLDER
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 
+# Upload names are unique per content (or per upload for legacy files), so a URL never changes content
+IMAGE_CACHE_SECONDS = 31536000
+# Let a fronting server send the bytes: nginx internal location prefix, or Apache/lighttpd X-Sendfile
+IMAGE_ACCEL_REDIRECT_PREFIX = os.getenv('IMAGE_ACCEL_REDIRECT_PREFIX')
+app.use_x_sendfile = os.getenv('USE_X_SENDFILE', '0') == '1'
+
 @app.route('/uploads/image/product/<filename>')
 def uploaded_file(filename):
-    """Serves files from the nested product image directory."""
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    """Serves files from the nested product image directory with long-lived caching.
+
+    Conditional requests (If-None-Match/If-Modified-Since) get a 304 and Range
+    requests a 206 from Werkzeug; content-hashed files use their hash as ETag.
+    """
+    if IMAGE_ACCEL_REDIRECT_PREFIX:
+        path = os.path.join(app.config['UPLOAD_FOLDER'], secure_filename(filename))
+        if not os.path.isfile(path):
+            return jsonify({'success': False, 'error': 'File not found'}), 404
+        response = app.response_class()
+        response.headers['X-Accel-Redirect'] = IMAGE_ACCEL_REDIRECT_PREFIX.rstrip('/') + '/' + secure_filename(filename)
+    else:
+        stem = filename.split('.', 1)[0]
+        etag = stem if image_store.is_content_hash(stem.split('_', 1)[0]) else True
+        response = send_from_directory(
+            app.config['UPLOAD_FOLDER'], filename, max_age=IMAGE_CACHE_SECONDS, etag=etag, conditional=True
+        )
+    response.headers['Cache-Control'] = f'public, max-age={IMAGE_CACHE_SECONDS}, immutable'
+    return response
+
+def _image_urls(url):
+    """Original, thumbnail and medium URLs for a product image URL"""
+    return {
+        'url': url,
+        'thumb_url': image_store.derivative_url(url, 'thumb'),
+        'medium_url': image_store.derivative_url(url, 'medium'),
+    }
 
 @app.route('/product/upload-image', methods=['POST'])
 def upload_product_image():
-    """Handle image upload, save it with a name including item_code, and return the URL."""
+    """Store an uploaded image by content hash with its thumbnail/medium derivatives and return the URLs."""
     if 'file' not in request.files:
         return jsonify({'success': False, 'error': 'No file part'}), 400
     
@@ -557,26 +1201,22 @@ def upload_product_image():
         return jsonify({'success': False, 'error': 'No item_code provided'}), 400
 
     file = request.files['file']
-    item_code = request.form['item_code']
     
     if file.filename == '':
         return jsonify({'success': False, 'error': 'No selected file'}), 400
         
     if file:
-        # Ensure the upload directory exists
-        os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
-
-        # Create a secure filename
-        original_filename = secure_filename(file.filename)
-        # Create a new unique filename based on item_code and uuid
-        unique_filename = f"{item_code}_{uuid.uuid4().hex[:8]}_{original_filename}"
-        file_path = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
-        
         try:
-            file.save(file_path)
-            # Construct the URL for the uploaded file
-            file_url = f"{request.host_url}uploads/image/product/{unique_filename}"
-            return jsonify({'success': True, 'url': file_url}), 201
+            # The same photo uploaded again (for any item) maps to the same files
+            names = image_store.store_image(file.read(), secure_filename(file.filename), app.config['UPLOAD_FOLDER'])
+            base_url = f"{request.host_url}uploads/image/product/"
+            file_url = base_url + names['original']
+            return jsonify({
+                'success': True,
+                'url': file_url,
+                'thumb_url': base_url + names['thumb'] if 'thumb' in names else file_url,
+                'medium_url': base_url + names['medium'] if 'medium' in names else file_url,
+            }), 201
         except Exception as e:
             print(f"Error saving file: {e}")
             return jsonify({'success': False, 'error': 'Failed to save file on server'}), 500
@@ -641,8 +1281,10 @@ def update_product_image():
             cur.execute(insert_query, (next_roworder, item_code, new_image_url))
         
         conn.commit() # Commit transaction
+        stock_snapshots.set_field(item_code, 'url_image', new_image_url)
+        invalidate_image_history_counts()
 
-        return jsonify({'success': True, 'message': f'Image for {item_code} updated successfully.'}), 200
+        return jsonify({'success': True, 'message': f'Image for {item_code} updated successfully.', **_image_urls(new_image_url)}), 200
 
     except Exception as e:
         conn.rollback() # Rollback on error
@@ -653,7 +1295,7 @@ def update_product_image():
         if cur:
             cur.close()
         if conn:
-            conn.close()
+            release_connection(conn)
 
 @app.route('/product/image-history/<item_code>', methods=['GET'])
 def get_product_image_history(item_code):
@@ -683,41 +1325,80 @@ def get_product_image_history(item_code):
         if cur:
             cur.close()
         if conn:
-            conn.close()
+            release_connection(conn)
+
+# Keyset order of the audit screen and the per-product history, plus their indexes
+IMAGE_HISTORY_INDEXES = """
+    CREATE INDEX IF NOT EXISTS product_image_history_ts_id_idx
+        ON product_image_history (change_timestamp DESC, id DESC);
+    CREATE INDEX IF NOT EXISTS product_image_history_item_ts_idx
+        ON product_image_history (item_code, change_timestamp DESC);
+"""
+
+# (total_count, unique_product_count) per filter combination; cleared whenever history is written
+IMAGE_HISTORY_COUNT_TTL = 60
+_image_history_counts = {}
+_image_history_counts_lock = threading.Lock()
+
+def ensure_image_history_indexes():
+    conn = db_pool.getconn()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(IMAGE_HISTORY_INDEXES)
+        conn.commit()
+    finally:
+        db_pool.putconn(conn)
+
+def invalidate_image_history_counts():
+    with _image_history_counts_lock:
+        _image_history_counts.clear()
+
+def _cached_image_history_counts(filter_key):
+    with _image_history_counts_lock:
+        cached = _image_history_counts.get(filter_key)
+    if cached and time.monotonic() - cached[0] < IMAGE_HISTORY_COUNT_TTL:
+        return cached[1]
+    return None
+
+def _store_image_history_counts(filter_key, counts):
+    with _image_history_counts_lock:
+        if len(_image_history_counts) > 256:
+            _image_history_counts.clear()
+        _image_history_counts[filter_key] = (time.monotonic(), counts)
 
 @app.route('/product/image-history-all', methods=['GET'])
 def get_all_image_history():
-    """Get the image history for all products with pagination."""
-    conn = get_connection()
-    if not conn:
-        return jsonify({'success': False, 'error': 'Database connection failed'}), 500
-    
+    """Get the image history for all products, newest first.
+
+    Pages by keyset on (change_timestamp, id): pass the returned next_after
+    as `after` for the next page (offset still works for old clients).
+    """
     # Get pagination parameters
     limit = request.args.get('limit', 50, type=int)
     offset = request.args.get('offset', 0, type=int)
+    after = request.args.get('after')
     
     # Get filter parameters
     search_term = request.args.get('search', '')
     start_date = request.args.get('start_date', '')
     end_date = request.args.get('end_date', '')
+
+    if limit < 1:
+        return jsonify({'success': False, 'error': 'limit must be at least 1'}), 400
+    after_key = None
+    if after:
+        try:
+            after_timestamp, after_id = decode_cursor(after, str, int)
+            after_key = (datetime.fromisoformat(after_timestamp), after_id)
+        except (ValueError, TypeError) as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
+
+    conn = get_connection()
+    if not conn:
+        return jsonify({'success': False, 'error': 'Database connection failed'}), 500
     
     cur = conn.cursor(cursor_factory=RealDictCursor)
     try:
-        # Base query with product name join
-        query = """
-        SELECT 
-            h.id, 
-            h.item_code, 
-            h.old_url_image, 
-            h.new_url_image, 
-            h.changed_by, 
-            h.change_timestamp, 
-            h.action_type,
-            COALESCE(i.name_1, '') as item_name
-        FROM product_image_history h
-        LEFT JOIN ic_inventory i ON h.item_code = i.code
-        """
-        
         # Build WHERE clause
         where_clauses = []
         params = []
@@ -733,74 +1414,84 @@ def get_all_image_history():
         if end_date:
             where_clauses.append("h.change_timestamp <= %s")
             params.append(end_date)
-        
-        if where_clauses:
-            query += " WHERE " + " AND ".join(where_clauses)
-        
-        # Add ordering
-        query += " ORDER BY h.change_timestamp DESC"
-        
-        # Add pagination
-        query += " LIMIT %s OFFSET %s"
-        params.extend([limit, offset])
-        
-        cur.execute(query, params)
-        history_records = cur.fetchall()
-        
-        # Get total count for pagination
-        count_query = "SELECT COUNT(*) as count FROM product_image_history h"
-        
-        # Add join for count query if we have search terms that involve product name
-        if search_term:
-            count_query += " LEFT JOIN ic_inventory i ON h.item_code = i.code"
-        
-        count_params = []
-        
-        if where_clauses:
-            count_query += " WHERE " + " AND ".join(where_clauses)
-            count_params = params[:-2]  # Remove limit and offset params
-        
-        cur.execute(count_query, count_params)
-        total_count = cur.fetchone()['count']
-        
-        # Get unique product count
-        unique_count_query = "SELECT COUNT(DISTINCT item_code) as unique_count FROM product_image_history h"
-        unique_count_params = []
-        
-        if where_clauses:
-            # Remove the search term conditions that involve product name for the unique count
-            unique_where_clauses = []
-            unique_params = []
-            
-            for i, clause in enumerate(where_clauses):
-                if "name_1" not in clause:
-                    unique_where_clauses.append(clause)
-                    # Add corresponding params
-                    if "ILIKE" in clause:
-                        unique_params.extend([params[i*3], params[i*3+1]])  # For item_code and changed_by
-                    else:
-                        unique_params.append(params[len([c for c in where_clauses[:i] if "name_1" not in c]) * (2 if "ILIKE" in clause else 1)])
-            
-            if unique_where_clauses:
-                unique_count_query += " WHERE " + " AND ".join(unique_where_clauses)
-                unique_count_params = unique_params
-        
-        cur.execute(unique_count_query, unique_count_params)
-        unique_product_count = cur.fetchone()['unique_count']
+
+        where_sql = (" WHERE " + " AND ".join(where_clauses)) if where_clauses else ""
+
+        filtered = f"""
+        SELECT 
+            h.id, 
+            h.item_code, 
+            h.old_url_image, 
+            h.new_url_image, 
+            h.changed_by, 
+            h.change_timestamp, 
+            h.action_type,
+            COALESCE(i.name_1, '') as item_name
+        FROM product_image_history h
+        LEFT JOIN ic_inventory i ON h.item_code = i.code{where_sql}
+        """
+
+        page_sql = "SELECT * FROM filtered"
+        page_params = []
+        if after_key:
+            page_sql += " WHERE (change_timestamp, id) < (%s, %s)"
+            page_params.extend(after_key)
+        page_sql += " ORDER BY change_timestamp DESC, id DESC LIMIT %s"
+        page_params.append(limit)
+        if not after_key and offset:
+            page_sql += " OFFSET %s"
+            page_params.append(offset)
+
+        filter_key = (search_term, start_date, end_date)
+        counts = _cached_image_history_counts(filter_key)
+        if counts is None:
+            # Page and both counts in one round trip; the counts row is there even when the page is empty
+            cur.execute(f"""
+            WITH filtered AS ({filtered})
+            SELECT page.*, c.total_count, c.unique_product_count
+            FROM (SELECT COUNT(*) AS total_count, COUNT(DISTINCT item_code) AS unique_product_count
+                  FROM filtered) c
+            LEFT JOIN LATERAL ({page_sql}) page ON true
+            ORDER BY page.change_timestamp DESC, page.id DESC
+            """, params + page_params)
+            rows = cur.fetchall()
+            counts = (rows[0]['total_count'], rows[0]['unique_product_count'])
+            _store_image_history_counts(filter_key, counts)
+            history_records = []
+            for row in rows:
+                del row['total_count']
+                del row['unique_product_count']
+                if row['id'] is not None:
+                    history_records.append(row)
+        else:
+            cur.execute(f"WITH filtered AS ({filtered}) {page_sql}", params + page_params)
+            history_records = cur.fetchall()
+
+        next_after = None
+        if history_records and len(history_records) >= limit:
+            last = history_records[-1]
+            next_after = encode_cursor(last['change_timestamp'].isoformat(), last['id'])
         
         return jsonify({
             'success': True, 
             'history': history_records,
-            'total_count': total_count,
-            'unique_product_count': unique_product_count,
+            'total_count': counts[0],
+            'unique_product_count': counts[1],
             'limit': limit,
-            'offset': offset
+            'offset': offset,
+            'next_after': next_after
         }), 200
 
     except Exception as e:
         print(f"Error fetching global image history: {str(e)}")
         return jsonify({'success': False, 'error': str(e)}), 500
 
+    finally:
+        if cur:
+            cur.close()
+        if conn:
+            release_connection(conn)
+
 @app.route('/product/image-revert/<int:history_id>', methods=['POST'])
 def revert_product_image(history_id):
     """Revert a product image to a previous version."""
@@ -840,6 +1531,8 @@ def revert_product_image(history_id):
         cur.execute(update_query, (old_url_image, item_code))
 
         conn.commit() # Commit transaction
+        stock_snapshots.set_field(item_code, 'url_image', old_url_image)
+        invalidate_image_history_counts()
 
         return jsonify({'success': True, 'message': f'Image for {item_code} reverted successfully to history ID {history_id}.'}), 200
 
@@ -853,7 +1546,7 @@ def revert_product_image(history_id):
         if cur:
             cur.close()
         if conn:
-            conn.close()
+            release_connection(conn)
 
 @app.route('/api/sales-history-db', methods=['GET'])
 def api_sales_history_db():
@@ -866,10 +1559,14 @@ def api_sales_history_db():
     offset = request.args.get('offset', 0, type=int)
     selected_date = request.args.get('selectedDate', None)
     search_term = request.args.get('searchTerm', None)
+    # Later pages can pass includeTotal=0 and keep the count from the first page
+    include_total = request.args.get('includeTotal', '1') not in ('0', 'false')
 
     cur = conn.cursor(cursor_factory=RealDictCursor)
     try:
-        base_query = """
+        # The total comes from a window over the filtered rows, in the same round trip as the page
+        total_column = ",\n            COUNT(*) OVER () AS total_count" if include_total else ""
+        base_query = f"""
         SELECT
             it.doc_no,
             it.doc_date,
@@ -878,7 +1575,7 @@ def api_sales_history_db():
             it.total_amount_2,
             it.currency_code,
             ec.symbol AS currency_symbol,
-            ac.name_1 AS customer_name
+            ac.name_1 AS customer_name{total_column}
         FROM
             ic_trans it
         LEFT JOIN
@@ -903,35 +1600,45 @@ def api_sales_history_db():
         if where_clauses:
             base_query += " AND " + " AND ".join(where_clauses)
 
-        base_query += " ORDER BY it.doc_date DESC, it.doc_time DESC"
-
-        # Query for total count (without limit/offset)
-        count_query = f"SELECT COUNT(*) FROM ({base_query}) AS subquery"
-        cur.execute(count_query, params)
-        total_count = cur.fetchone()['count']
-
-        # Add limit and offset for fetching actual data
-        base_query += " LIMIT %s OFFSET %s"
+        base_query += " ORDER BY it.doc_date DESC, it.doc_time DESC, it.doc_no DESC LIMIT %s OFFSET %s"
         params.extend([limit, offset])
 
         cur.execute(base_query, params)
         result = cur.fetchall()
 
-        # For each transaction, fetch the product details
-        for transaction in result:
-            detail_query = """
+        total_count = None
+        if include_total:
+            if result:
+                total_count = result[0]['total_count']
+            elif offset > 0:
+                # Past the last row the window has nothing to count over
+                count_query = base_query.replace(total_column, "").rsplit(" ORDER BY ", 1)[0]
+                cur.execute(f"SELECT COUNT(*) FROM ({count_query}) AS subquery", params[:-2])
+                total_count = cur.fetchone()['count']
+            else:
+                total_count = 0
+            for transaction in result:
+                del transaction['total_count']
+
+        # Product details of every transaction on the page in one query
+        items_by_doc = {transaction['doc_no']: [] for transaction in result}
+        if items_by_doc:
+            cur.execute("""
             SELECT
+                doc_no,
                 item_code,
                 item_name,
                 unit_code,
                 qty,
                 price_2 as price
             FROM ic_trans_detail
-            WHERE doc_no = %s
-            ORDER BY line_number
-            """
-            cur.execute(detail_query, (transaction['doc_no'],))
-            transaction['items'] = cur.fetchall()
+            WHERE doc_no = ANY(%s)
+            ORDER BY doc_no, line_number
+            """, (list(items_by_doc),))
+            for item in cur.fetchall():
+                items_by_doc[item.pop('doc_no')].append(item)
+        for transaction in result:
+            transaction['items'] = items_by_doc[transaction['doc_no']]
 
         return jsonify({'list': result, 'totalCount': total_count}), 200
 
@@ -943,32 +1650,13 @@ def api_sales_history_db():
         if cur:
             cur.close()
         if conn:
-            conn.close()
-
-import json
-import time
+            release_connection(conn)
 
-# --- Bill Parking APIs (Local File Storage) ---
+# --- Bill Parking APIs (Local SQLite Storage) ---
+PARKED_BILLS_DB = os.getenv('PARKED_BILLS_DB', 'parked_bills.db')
 PARKED_BILLS_FILE = 'parked_bills.json'
 
-def _read_parked_bills():
-    """Helper function to read parked bills from the JSON file."""
-    try:
-        if os.path.exists(PARKED_BILLS_FILE):
-            with open(PARKED_BILLS_FILE, 'r') as f:
-                # Handle empty file case
-                content = f.read()
-                if not content:
-                    return []
-                return json.loads(content)
-        return []
-    except (IOError, json.JSONDecodeError):
-        return []
-
-def _write_parked_bills(bills):
-    """Helper function to write parked bills to the JSON file."""
-    with open(PARKED_BILLS_FILE, 'w') as f:
-        json.dump(bills, f, indent=4)
+parked_bills = ParkedBillStore(PARKED_BILLS_DB)
 
 @app.route('/park-bill', methods=['POST'])
 def park_bill():
@@ -982,35 +1670,28 @@ def park_bill():
     if not reference_name or not cart_data:
         return jsonify({'success': False, 'error': 'Reference name and cart data are required'}), 400
 
-    bills = _read_parked_bills()
-    
-    # Generate a unique ID (simple timestamp-based)
-    new_id = int(time.time() * 1000)
-
-    new_bill = {
-        'id': new_id,
-        'reference_name': reference_name,
-        'cart_data': cart_data,
-        'customer_code': customer_code,
-        'customer_search': customer_search, # Save display name
-        'created_at': time.strftime('%Y-%m-%d %H:%M:%S')
-    }
-    
-    bills.append(new_bill)
-    _write_parked_bills(bills)
-    
-    return jsonify({'success': True, 'message': 'Bill parked successfully'}), 201
+    new_id = parked_bills.add(
+        reference_name,
+        cart_data,
+        customer_code=customer_code,
+        customer_search=customer_search,
+        terminal_id=data.get('terminal_id'),
+        user_code=data.get('user_code'),
+    )
+
+    return jsonify({'success': True, 'message': 'Bill parked successfully', 'id': new_id}), 201
 
 @app.route('/parked-bills', methods=['GET'])
 def get_parked_bills():
-    """Get a list of all parked bills."""
-    bills = _read_parked_bills()
-    # Sort by most recent first
-    sorted_bills = sorted(bills, key=lambda x: x.get('id', 0), reverse=True)
-    
+    """Get a list of parked bills, optionally only those of one terminal and/or user."""
+    bills = parked_bills.list(
+        terminal_id=request.args.get('terminal_id'),
+        user_code=request.args.get('user_code'),
+    )
+
     # Prepare data for display
     display_list = []
-    for bill in sorted_bills:
+    for bill in bills:
         try:
             created_time = time.strptime(bill['created_at'], '%Y-%m-%d %H:%M:%S')
             time_str = time.strftime('%H:%M:%S', created_time)
@@ -1023,7 +1704,9 @@ def get_parked_bills():
             'time': time_str,
             'cart_data': bill['cart_data'],
             'customer_code': bill.get('customer_code'),
-            'customer_search': bill.get('customer_search')
+            'customer_search': bill.get('customer_search'),
+            'terminal_id': bill.get('terminal_id'),
+            'user_code': bill.get('user_code')
         })
 
     return jsonify({'success': True, 'list': display_list}), 200
@@ -1031,20 +1714,58 @@ def get_parked_bills():
 @app.route('/parked-bills/<int:bill_id>', methods=['DELETE'])
 def delete_parked_bill(bill_id):
     """Delete a parked bill after it has been recalled."""
-    bills = _read_parked_bills()
-    
-    bill_found = any(bill['id'] == bill_id for bill in bills)
-    if not bill_found:
+    if not parked_bills.delete(bill_id):
         return jsonify({'success': False, 'error': 'Bill not found'}), 404
-        
-    new_bills = [bill for bill in bills if bill['id'] != bill_id]
-    _write_parked_bills(new_bills)
     
     return jsonify({'success': True, 'message': 'Parked bill deleted'}), 200
 
+def start_background_services():
+    """Warm the connection pool and start the cache maintenance threads"""
+    try:
+        opened = db_pool.prewarm()
+        print(f"Database connection pool warmed up with {opened} connections")
+    except Exception as e:
+        print(f"Warning: Could not pre-warm database connection pool: {e}")
+
+    stock_snapshots.start_refresh_thread(_load_stock_snapshot)
+    threading.Thread(target=_catalog_refresh_loop, name="catalog-index-refresh", daemon=True).start()
+    threading.Thread(target=_customer_refresh_loop, name="customer-index-refresh", daemon=True).start()
+    threading.Thread(target=_price_refresh_loop, name="price-cache-refresh", daemon=True).start()
+    reference_data.start_refresh_thread()
+    session_context.start_refresh_thread()
+    threading.Thread(target=_outbox_loop, name="sales-outbox", daemon=True).start()
+    stock_cache.start_movement_listener(
+        stock_snapshots, lambda: psycopg2.connect(**DATABASE_CONFIG, **KEEPALIVE_OPTIONS)
+    )
+    try:
+        ensure_image_history_indexes()
+    except Exception as e:
+        print(f"Warning: Could not create image history indexes: {e}")
+
+    try:
+        ensure_idempotency_table()
+    except Exception as e:
+        print(f"Warning: Could not create idempotency key table: {e}")
+
+    # Hand unused reserved bill numbers back so a restart does not leave a gap
+    atexit.register(doc_numbers.release)
+
+    try:
+        imported = parked_bills.import_json(PARKED_BILLS_FILE)
+        if imported:
+            print(f"Imported {imported} parked bills from {PARKED_BILLS_FILE}")
+    except Exception as e:
+        print(f"Warning: Could not import parked bills: {e}")
 
 # The @app.before_request and @app.after_request for CORS have been removed 
 # to rely solely on the Flask-Cors extension, which is already configured.
 
+def is_reloader_parent():
+    """True in the process the debug reloader uses only to watch files; it serves no requests"""
+    return app.debug and os.environ.get('WERKZEUG_RUN_MAIN') is None
+
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000, debug=True)
+    app.debug = os.getenv('FLASK_DEBUG', '1').lower() not in ('0', 'false', 'no')
+    if not is_reloader_parent():
+        start_background_services()
+    app.run(host='0.0.0.0', port=5000, debug=app.debug)
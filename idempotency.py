@@ -0,0 +1,152 @@
+"""Idempotency-Key support for endpoints that write documents.
+
+A client that timed out on a POST cannot tell whether the document was
+written. With an Idempotency-Key header it can simply send the request
+again: the key, a fingerprint of the request body and the final response
+are stored in pos_idempotency_key in the same transaction as the
+document. A repeat of the key gets the stored response back instead of
+a second document, and a repeat with a different body is refused.
+
+A request claims its key with one INSERT ... ON CONFLICT DO NOTHING, and
+only a request whose key already exists reads the stored response, so a
+first request costs two statements (the claim and store_response()).
+Because the key row is inserted before the document is written, two
+concurrent requests with the same key cannot both write it: the second
+insert waits on the primary key until the first commits, then finds the
+key taken and answers from the stored response. Responses of failed
+requests are never stored, since their transaction was rolled back, so a
+retry after an error runs again. Keys expire after IDEMPOTENCY_TTL_HOURS;
+an expired key is taken over by the claim, and expired rows are deleted
+at most once per PURGE_INTERVAL.
+"""
+import hashlib
+import json
+import os
+import time
+
+HEADER = "Idempotency-Key"
+# Set on responses answered from the stored result
+REPLAYED_HEADER = "Idempotent-Replayed"
+
+TTL_HOURS = int(os.getenv("IDEMPOTENCY_TTL_HOURS", 24))
+MAX_KEY_LENGTH = 255
+# Seconds between deletions of expired keys (per process)
+PURGE_INTERVAL = 3600
+
+DDL = """
+    CREATE TABLE IF NOT EXISTS pos_idempotency_key (
+        scope varchar(32) NOT NULL,
+        key varchar(255) NOT NULL,
+        fingerprint char(64) NOT NULL,
+        status_code integer,
+        response text,
+        created_at timestamp NOT NULL DEFAULT now(),
+        PRIMARY KEY (scope, key)
+    );
+    CREATE INDEX IF NOT EXISTS pos_idempotency_key_created_idx ON pos_idempotency_key (created_at);
+"""
+
+_last_purge = 0.0
+
+
+class KeyInUse(Exception):
+    """A request with the same key is still being processed."""
+
+
+class KeyMismatch(Exception):
+    """The key was already used with a different request body."""
+
+
+def fingerprint(payload):
+    """SHA-256 of the request body with keys sorted, so key order does not matter."""
+    text = json.dumps(payload, sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str)
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def validate_key(key):
+    if not key or len(key) > MAX_KEY_LENGTH:
+        raise ValueError(f"{HEADER} must be 1 to {MAX_KEY_LENGTH} characters")
+    return key
+
+
+def ensure_table(cur):
+    cur.execute(DDL)
+
+
+def lookup(cur, scope, key, request_fingerprint):
+    """(status_code, response text) stored for key, or None when it is new or expired.
+
+    Raises KeyMismatch if the key was used for a different body and KeyInUse
+    if its first request has not finished.
+    """
+    cur.execute(
+        """
+        SELECT fingerprint, status_code, response
+        FROM pos_idempotency_key
+        WHERE scope = %s AND key = %s AND created_at > now() - %s * interval '1 hour'
+        """,
+        (scope, key, TTL_HOURS),
+    )
+    row = cur.fetchone()
+    if row is None:
+        return None
+    if isinstance(row, dict):  # RealDictCursor
+        row = (row["fingerprint"], row["status_code"], row["response"])
+    stored_fingerprint, status_code, response = row
+    if stored_fingerprint != request_fingerprint:
+        raise KeyMismatch(f"{HEADER} {key} was already used with a different request")
+    if status_code is None:
+        raise KeyInUse(f"A request with {HEADER} {key} is still in progress")
+    return status_code, response
+
+
+def purge_expired(cur):
+    """Delete expired keys, at most once per PURGE_INTERVAL per process."""
+    global _last_purge
+    if time.time() - _last_purge > PURGE_INTERVAL:
+        cur.execute("DELETE FROM pos_idempotency_key WHERE created_at <= now() - %s * interval '1 hour'", (TTL_HOURS,))
+        _last_purge = time.time()
+
+
+def claim(cur, scope, key, request_fingerprint):
+    """Insert the key for this transaction; returns False if it is already taken.
+
+    An expired row for the key is taken over. If a concurrent request holds
+    the key, this waits until that request's transaction ends.
+    """
+    cur.execute(
+        """
+        INSERT INTO pos_idempotency_key (scope, key, fingerprint) VALUES (%s, %s, %s)
+        ON CONFLICT (scope, key) DO UPDATE
+            SET fingerprint = EXCLUDED.fingerprint, status_code = NULL, response = NULL, created_at = now()
+            WHERE pos_idempotency_key.created_at <= now() - %s * interval '1 hour'
+        RETURNING 1
+        """,
+        (scope, key, request_fingerprint, TTL_HOURS),
+    )
+    return cur.fetchone() is not None
+
+
+def begin(cur, scope, key, request_fingerprint):
+    """claim() the key on cur's transaction, or find the response stored for it.
+
+    Returns the stored (status_code, response text) when the request is a
+    repeat (the caller rolls back and answers with it), or None when the
+    key is now claimed and the request should be processed. Raises
+    KeyMismatch or KeyInUse like lookup().
+    """
+    purge_expired(cur)
+    if claim(cur, scope, key, request_fingerprint):
+        return None
+    stored = lookup(cur, scope, key, request_fingerprint)
+    if stored is None:
+        raise KeyInUse(f"A request with {HEADER} {key} was processed concurrently")
+    return stored
+
+
+def store_response(cur, scope, key, status_code, response_text):
+    """Record the final response; committed together with the document."""
+    cur.execute(
+        "UPDATE pos_idempotency_key SET status_code = %s, response = %s WHERE scope = %s AND key = %s",
+        (status_code, response_text, scope, key),
+    )
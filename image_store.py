@@ -0,0 +1,138 @@
+"""Content-addressed product image storage with resized derivatives.
+
+Uploads are stored as {sha256}.{ext}, so uploading the same photo twice
+keeps one file. Next to the original, a small thumbnail for the POS grid
+and a medium image for the check price screen are written as WebP (JPEG
+when this Pillow build cannot write WebP). Phone photos are several MB;
+a thumbnail is a few KB.
+
+Pillow is optional: without it uploads are still stored and deduplicated,
+and derivative_url() falls back to the original URL.
+"""
+import hashlib
+import io
+import os
+import re
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow not installed: originals only
+    Image = None
+
+UPLOAD_FOLDER = os.getenv(
+    "PRODUCT_IMAGE_FOLDER",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "uploads", "image", "product"),
+)
+
+# Derivative name -> longest side in pixels
+SIZES = {
+    "thumb": 240,
+    "medium": 800,
+}
+QUALITY = 80
+
+_HASHED_NAME = re.compile(r"^([0-9a-f]{64})\.[A-Za-z0-9]+$")
+_ALLOWED_EXTENSIONS = {"jpg", "jpeg", "png", "webp", "gif", "bmp"}
+
+# Derivative files never change once written, so a positive lookup is cached for good
+_known_files = set()
+
+
+def _derivative_format():
+    if Image is not None:
+        Image.init()  # Image.SAVE is only filled once the format plugins are loaded
+    if Image is not None and "WEBP" in Image.SAVE:
+        return "WEBP", "webp"
+    return "JPEG", "jpg"
+
+
+def _file_exists(path):
+    if path in _known_files:
+        return True
+    if os.path.exists(path):
+        _known_files.add(path)
+        return True
+    return False
+
+
+def is_content_hash(value):
+    return _HASHED_NAME.match(f"{value}.x") is not None
+
+
+def derivative_name(content_hash, size):
+    return f"{content_hash}_{size}.{_derivative_format()[1]}"
+
+
+def _write_atomic(path, data):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def _make_derivatives(data, content_hash, folder):
+    if Image is None:
+        return {}
+    fmt, _ = _derivative_format()
+    names = {}
+    with Image.open(io.BytesIO(data)) as source:
+        image = ImageOps.exif_transpose(source)
+        if fmt == "JPEG":
+            if image.mode != "RGB":
+                image = image.convert("RGB")
+        elif image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA" if "A" in image.mode or "transparency" in image.info else "RGB")
+        for size, max_side in SIZES.items():
+            name = derivative_name(content_hash, size)
+            path = os.path.join(folder, name)
+            if not _file_exists(path):
+                resized = image.copy()
+                resized.thumbnail((max_side, max_side))
+                buffer = io.BytesIO()
+                resized.save(buffer, fmt, quality=QUALITY)
+                _write_atomic(path, buffer.getvalue())
+            names[size] = name
+    return names
+
+
+def store_image(data, original_filename, folder=UPLOAD_FOLDER):
+    """Store uploaded bytes by content hash and write the derivatives.
+
+    Returns {'original': filename, 'thumb': filename, 'medium': filename};
+    derivative keys are missing when they could not be produced.
+    """
+    os.makedirs(folder, exist_ok=True)
+    content_hash = hashlib.sha256(data).hexdigest()
+    extension = original_filename.rsplit(".", 1)[-1].lower() if "." in original_filename else ""
+    if extension not in _ALLOWED_EXTENSIONS:
+        extension = "jpg"
+
+    original = f"{content_hash}.{extension}"
+    original_path = os.path.join(folder, original)
+    if not _file_exists(original_path):
+        _write_atomic(original_path, data)
+
+    names = {"original": original}
+    try:
+        names.update(_make_derivatives(data, content_hash, folder))
+    except Exception as e:
+        print(f"Warning: Could not create image derivatives for {original}: {e}")
+    return names
+
+
+def derivative_url(url, size, folder=UPLOAD_FOLDER):
+    """URL of the `size` derivative of an uploaded image, or `url` itself.
+
+    Only content-addressed uploads have derivatives; external URLs and
+    legacy uploads are returned unchanged.
+    """
+    if not url:
+        return url
+    base, _, filename = url.rpartition("/")
+    match = _HASHED_NAME.match(filename)
+    if match is None:
+        return url
+    name = derivative_name(match.group(1), size)
+    if not _file_exists(os.path.join(folder, name)):
+        return url
+    return f"{base}/{name}"
@@ -0,0 +1,34 @@
+"""Opaque cursor tokens for keyset pagination.
+
+A cursor is the sort key of the last row of a page, e.g. (ic_name, ic_code).
+Clients pass it back unchanged as `after` to get the next page, so the
+server seeks straight to that key instead of skipping OFFSET rows.
+"""
+import base64
+import json
+
+
+def encode_cursor(*values):
+    """Encode sort-key values (JSON-serializable) as a URL-safe token."""
+    raw = json.dumps(list(values), ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(token, *types):
+    """Decode a token into a tuple of values of the given types; raises ValueError if malformed.
+
+    decode_cursor(token, str, int) accepts only a [str, int] cursor, so a
+    tampered token cannot reach comparisons or queries with the wrong types.
+    """
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+        values = json.loads(raw.decode("utf-8"))
+    except (ValueError, TypeError) as e:
+        raise ValueError(f"Invalid cursor: {e}") from e
+    if not isinstance(values, list) or len(values) != len(types):
+        raise ValueError("Invalid cursor")
+    for value, expected in zip(values, types):
+        # JSON true/false decode to bool, which isinstance() counts as int
+        if isinstance(value, bool) or not isinstance(value, expected):
+            raise ValueError("Invalid cursor")
+    return tuple(values)
@@ -0,0 +1,118 @@
+"""Parked bill store backed by SQLite.
+
+Replaces parked_bills.json, which was read, parsed and rewritten in full on
+every park/list/delete and could lose writes when two terminals parked at
+the same time. SQLite in WAL mode gives indexed inserts and deletes, safe
+concurrent writers and readers that never block on a writer.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS parked_bills (
+        id INTEGER PRIMARY KEY,
+        reference_name TEXT NOT NULL,
+        cart_data TEXT NOT NULL,
+        customer_code TEXT,
+        customer_search TEXT,
+        terminal_id TEXT,
+        user_code TEXT,
+        created_at TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS parked_bills_terminal_idx ON parked_bills (terminal_id, id);
+    CREATE INDEX IF NOT EXISTS parked_bills_user_idx ON parked_bills (user_code, id);
+"""
+
+_COLUMNS = "id, reference_name, cart_data, customer_code, customer_search, terminal_id, user_code, created_at"
+
+
+class ParkedBillStore:
+    """Parked bills in one SQLite file, one connection per thread."""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._init_lock = threading.Lock()
+        self._ready = False
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        if not self._ready:
+            with self._init_lock:
+                if not self._ready:
+                    conn.executescript(SCHEMA)
+                    self._ready = True
+        return conn
+
+    def add(self, reference_name, cart_data, customer_code=None, customer_search=None,
+            terminal_id=None, user_code=None, bill_id=None, created_at=None):
+        """Insert a parked bill and return its id."""
+        conn = self._connect()
+        cur = conn.execute(
+            f"INSERT INTO parked_bills ({_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (bill_id, reference_name, json.dumps(cart_data, ensure_ascii=False), customer_code,
+             customer_search, terminal_id, user_code, created_at or time.strftime('%Y-%m-%d %H:%M:%S')),
+        )
+        return cur.lastrowid
+
+    def list(self, terminal_id=None, user_code=None):
+        """Parked bills, most recent first, optionally for one terminal and/or user."""
+        where = []
+        params = []
+        if terminal_id:
+            where.append("terminal_id = ?")
+            params.append(terminal_id)
+        if user_code:
+            where.append("user_code = ?")
+            params.append(user_code)
+        query = f"SELECT {_COLUMNS} FROM parked_bills"
+        if where:
+            query += " WHERE " + " AND ".join(where)
+        query += " ORDER BY id DESC"
+        bills = []
+        for row in self._connect().execute(query, params):
+            bill = dict(row)
+            bill["cart_data"] = json.loads(bill["cart_data"])
+            bills.append(bill)
+        return bills
+
+    def delete(self, bill_id):
+        """Delete a parked bill; returns False if it did not exist."""
+        return self._connect().execute("DELETE FROM parked_bills WHERE id = ?", (bill_id,)).rowcount > 0
+
+    def import_json(self, json_path):
+        """One-time import of a legacy parked_bills.json, which is renamed afterwards."""
+        if not os.path.exists(json_path):
+            return 0
+        try:
+            with open(json_path, 'r') as f:
+                content = f.read()
+            bills = json.loads(content) if content else []
+        except (IOError, ValueError) as e:
+            print(f"Warning: Could not import {json_path}: {e}")
+            return 0
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for bill in bills:
+                conn.execute(
+                    f"INSERT OR IGNORE INTO parked_bills ({_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (bill.get('id'), bill.get('reference_name') or '', json.dumps(bill.get('cart_data'), ensure_ascii=False),
+                     bill.get('customer_code'), bill.get('customer_search'), bill.get('terminal_id'),
+                     bill.get('user_code'), bill.get('created_at') or time.strftime('%Y-%m-%d %H:%M:%S')),
+                )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        os.replace(json_path, json_path + '.imported')
+        return len(bills)
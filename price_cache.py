@@ -0,0 +1,148 @@
+"""Effective sale price cache for ic_inventory_price.
+
+Instead of one correlated subquery per product row, every price row that is
+valid today or later is bulk-loaded in one query and resolved in memory to
+the effective price per (ic_code, unit_code, currency_code, cust_group_1):
+the row with the highest roworder whose from_date..to_date covers today.
+
+The resolved prices only change when a from_date or to_date boundary is
+crossed, so the cache expires exactly at the next boundary. A max age also
+applies so price edits made in SML are picked up.
+"""
+import os
+import threading
+import time
+from datetime import date, datetime, timedelta
+
+# Every price row that can be effective today or later
+PRICE_QUERY = """
+    SELECT ic_code, unit_code, currency_code, cust_group_1, sale_price1, from_date, to_date, roworder
+    FROM ic_inventory_price
+    WHERE to_date >= current_date
+"""
+
+# Seconds before prices are reloaded even if no date boundary was crossed
+MAX_AGE = int(os.getenv("PRICE_CACHE_MAX_AGE_SECONDS", 300))
+
+# Seconds to wait before retrying a failed reload while stale prices are served
+RETRY_SECONDS = 30
+
+
+def _as_date(value):
+    if isinstance(value, datetime):
+        return value.date()
+    return value
+
+
+class PriceCache:
+    """Resolved effective prices, valid until the next from_date/to_date boundary."""
+
+    def __init__(self, max_age=MAX_AGE):
+        self.max_age = max_age
+        self._prices = {}
+        self._resolved_for = None   # date the prices were resolved for
+        self._expires_on = None     # first date on which the resolution changes
+        self._loaded_at = 0.0
+        self._retry_after = 0.0
+        self._last_error = None
+        self._lock = threading.Lock()
+        self._stats = {"loads": 0, "load_errors": 0, "rows": 0}
+
+    @property
+    def loaded(self):
+        return self._resolved_for is not None
+
+    def is_stale(self, today=None):
+        today = today or date.today()
+        if self._resolved_for is None or today != self._resolved_for:
+            return True
+        if self._expires_on is not None and today >= self._expires_on:
+            return True
+        return time.monotonic() - self._loaded_at > self.max_age
+
+    def load(self, rows, today=None):
+        """Resolve prices for today from PRICE_QUERY rows."""
+        today = today or date.today()
+        best = {}
+        boundaries = []
+        for row in rows:
+            from_date = _as_date(row["from_date"])
+            to_date = _as_date(row["to_date"])
+            if from_date is None or to_date is None:
+                continue
+            if from_date > today:
+                boundaries.append(from_date)
+                continue
+            if to_date < today:
+                continue
+            boundaries.append(to_date + timedelta(days=1))
+            key = (row["ic_code"], row["unit_code"], row["currency_code"], row["cust_group_1"])
+            current = best.get(key)
+            if current is None or row["roworder"] > current[0]:
+                best[key] = (row["roworder"], row["sale_price1"])
+
+        self._prices = {key: price for key, (_, price) in best.items()}
+        self._resolved_for = today
+        self._expires_on = min(boundaries) if boundaries else None
+        self._loaded_at = time.monotonic()
+        self._stats["loads"] += 1
+        self._stats["rows"] = len(rows)
+
+    def reload_due(self):
+        """Whether prices are stale and no failed reload is waiting out its retry delay.
+
+        Raises while nothing was ever loaded and the retry delay runs, so
+        callers fail fast instead of all querying a database that is down.
+        """
+        if not self.is_stale():
+            return False
+        if time.monotonic() < self._retry_after:
+            if not self.loaded:
+                raise RuntimeError(f"Prices unavailable, last reload failed: {self._last_error}")
+            return False
+        return True
+
+    def reload_failed(self, error):
+        """Record a failed reload; no reload is attempted for RETRY_SECONDS.
+
+        Re-raises when nothing was loaded yet; otherwise the previous prices
+        keep being served.
+        """
+        self._stats["load_errors"] += 1
+        self._last_error = str(error)
+        self._retry_after = time.monotonic() + RETRY_SECONDS
+        if not self.loaded:
+            raise error
+        print(f"Warning: Could not reload prices, serving prices resolved for {self._resolved_for}: {error}")
+
+    def ensure_fresh(self, loader):
+        """Reload with loader() -> rows if stale; concurrent callers share one load.
+
+        If a reload fails, no reload is tried for RETRY_SECONDS; the previous
+        prices keep being served if there are any.
+        """
+        if not self.reload_due():
+            return
+        with self._lock:
+            if not self.reload_due():
+                return
+            try:
+                rows = loader()
+            except Exception as e:
+                self.reload_failed(e)
+                return
+            self.load(rows)
+
+    def price(self, ic_code, unit_code, currency_code="02", cust_group="101"):
+        """Effective sale_price1, or None when no price row covers today."""
+        return self._prices.get((ic_code, unit_code, currency_code, cust_group))
+
+    def stats(self):
+        stats = dict(self._stats)
+        stats.update({
+            "prices": len(self._prices),
+            "resolved_for": self._resolved_for.isoformat() if self._resolved_for else None,
+            "expires_on": self._expires_on.isoformat() if self._expires_on else None,
+            "age_seconds": round(time.monotonic() - self._loaded_at, 1) if self._loaded_at else None,
+        })
+        return stats
@@ -0,0 +1,150 @@
+"""Versioned in-memory cache of reference data shared by both services.
+
+Warehouses, shelves, customers and units change a few times a month but are
+requested on every page mount. Each dataset is loaded once, reloaded in the
+background every REFRESH_INTERVAL seconds (or right away through
+invalidate()), and carries a digest of its content. Responses send that
+digest as the ETag, so a client revalidating unchanged data gets a
+304 Not Modified without a single query.
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+
+from psycopg2.extras import RealDictCursor
+
+DATASETS = {
+    "warehouses": "SELECT code, name_1 AS name FROM ic_warehouse ORDER BY code",
+    "shelves": "SELECT whcode, code, name_1 AS name FROM ic_shelf ORDER BY whcode, code",
+    "customers": "SELECT code, name_1 AS name FROM ar_customer ORDER BY name_1",
+    "units": """
+        SELECT DISTINCT unit_code_1 AS code
+        FROM ic_master
+        WHERE unit_code_1 IS NOT NULL AND unit_code_1 <> ''
+        ORDER BY unit_code_1
+    """,
+}
+
+# Seconds between background reloads of every dataset
+REFRESH_INTERVAL = int(os.getenv("REFERENCE_DATA_REFRESH_SECONDS", 300))
+
+
+class Dataset:
+    """One loaded dataset: rows, a content digest and memoized derived views."""
+
+    def __init__(self, name, rows, version):
+        self.name = name
+        self.rows = rows
+        self.version = version
+        self.loaded_at = time.time()
+        self.digest = hashlib.sha1(
+            json.dumps(rows, default=str, sort_keys=True, ensure_ascii=False).encode("utf-8")
+        ).hexdigest()[:16]
+        self._views = {}
+
+    def view(self, key, build):
+        """build(rows) computed once per dataset version, e.g. shelves of one warehouse."""
+        views = self._views
+        if key not in views:
+            views[key] = build(self.rows)
+        return views[key]
+
+    def etag(self, variant=""):
+        tag = f"{self.name}-{self.digest}"
+        if variant:
+            tag += "-" + hashlib.sha1(str(variant).encode("utf-8")).hexdigest()[:8]
+        return f'"{tag}"'
+
+
+def etag_matches(if_none_match, etag):
+    """True if an If-None-Match header value matches etag (weak comparison)."""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    candidates = [value.strip() for value in if_none_match.split(",")]
+    return etag in candidates or f"W/{etag}" in candidates
+
+
+class ReferenceDataCache:
+    """Datasets loaded from the database through a pool with getconn()/putconn()."""
+
+    def __init__(self, pool, datasets=DATASETS, refresh_interval=REFRESH_INTERVAL):
+        self.pool = pool
+        self.datasets = dict(datasets)
+        self.refresh_interval = refresh_interval
+        self._loaded = {}
+        self._versions = {}
+        self._load_lock = threading.Lock()
+        self._refresh_thread = None
+        self._stats = {"hits": 0, "loads": 0, "load_errors": 0, "changes": 0}
+
+    def _fetch(self, name):
+        conn = self.pool.getconn()
+        try:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute(self.datasets[name])
+                return [dict(row) for row in cur.fetchall()]
+        finally:
+            self.pool.putconn(conn)
+
+    def refresh(self, name):
+        """Reload one dataset; the version only moves when the content changed."""
+        try:
+            rows = self._fetch(name)
+        except Exception:
+            self._stats["load_errors"] += 1
+            raise
+        self._stats["loads"] += 1
+        current = self._loaded.get(name)
+        dataset = Dataset(name, rows, self._versions.get(name, 0) + 1)
+        if current is not None and current.digest == dataset.digest:
+            return current
+        self._versions[name] = dataset.version
+        self._loaded[name] = dataset
+        if current is not None:
+            self._stats["changes"] += 1
+        return dataset
+
+    def get(self, name):
+        """The dataset, loading it on first use."""
+        dataset = self._loaded.get(name)
+        if dataset is not None:
+            self._stats["hits"] += 1
+            return dataset
+        with self._load_lock:
+            dataset = self._loaded.get(name)
+            if dataset is None:
+                dataset = self.refresh(name)
+            return dataset
+
+    def invalidate(self, name=None):
+        """Reload one dataset (or all loaded ones) now, e.g. after editing master data."""
+        names = [name] if name else list(self._loaded)
+        return {n: self.refresh(n).version for n in names}
+
+    def start_refresh_thread(self):
+        if self._refresh_thread is not None:
+            return
+
+        def refresh_loop():
+            while True:
+                time.sleep(self.refresh_interval)
+                for name in list(self._loaded):
+                    try:
+                        self.refresh(name)
+                    except Exception as e:
+                        print(f"Error refreshing reference data {name}: {e}")
+
+        self._refresh_thread = threading.Thread(target=refresh_loop, name="reference-data-refresh", daemon=True)
+        self._refresh_thread.start()
+
+    def stats(self):
+        stats = dict(self._stats)
+        stats["datasets"] = {
+            name: {"version": d.version, "rows": len(d.rows), "age_seconds": round(time.time() - d.loaded_at, 1)}
+            for name, d in self._loaded.items()
+        }
+        return stats
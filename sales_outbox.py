@@ -0,0 +1,252 @@
+"""Local outbox for POS bills written while the database link is down or slow.
+
+The database is on a remote host, so a dropped or congested WAN link used to
+stop checkout. When the link is unhealthy, /posbilling stores the bill in
+this SQLite file (WAL mode) and answers at local speed. The bills are
+replayed to PostgreSQL in the order they were taken once the link recovers.
+Only link failures keep a bill queued: a bill the database rejects is set
+aside as failed right away, for manual review, so it never holds up the
+bills behind it or online billing.
+
+A bill taken offline has no bill number yet: the till gets a provisional
+reference (OFF-...) to print, and the bill is numbered when it is replayed,
+in the month of its doc_date. Numbers are therefore never used up by sales
+that may not happen, and an offline bill can never end up with another
+month's prefix. The number each bill got is kept with it (sent_doc_no).
+
+LinkMonitor decides whether the link is usable: a periodic `SELECT 1`
+that fails or takes longer than the latency budget marks it down.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+# Bills sent per replay transaction
+BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", 50))
+# A probe slower than this marks the link down, so checkout does not wait on it
+LATENCY_BUDGET_MS = int(os.getenv("OUTBOX_LATENCY_BUDGET_MS", 1500))
+PROBE_INTERVAL = int(os.getenv("OUTBOX_PROBE_SECONDS", 5))
+# Prefix of the provisional reference of a bill queued without a bill number
+PROVISIONAL_PREFIX = "OFF-"
+# Sent bills are kept this long for troubleshooting
+SENT_RETENTION_SECONDS = 7 * 24 * 3600
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS outbox (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        doc_no TEXT NOT NULL UNIQUE,
+        -- A retried request finds the bill its first attempt queued
+        idempotency_key TEXT UNIQUE,
+        payload TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pending',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        last_error TEXT,
+        created_at REAL NOT NULL,
+        sent_at REAL,
+        sent_doc_no TEXT
+    );
+    CREATE INDEX IF NOT EXISTS outbox_status_idx ON outbox (status, seq);
+"""
+
+
+def new_reference():
+    """Provisional reference for a bill queued before it has a number."""
+    return f"{PROVISIONAL_PREFIX}{time.strftime('%y%m%d')}-{uuid.uuid4().hex[:8].upper()}"
+
+
+def is_provisional(doc_no):
+    return str(doc_no).startswith(PROVISIONAL_PREFIX)
+
+
+class OutboxEntry:
+    __slots__ = ("seq", "doc_no", "payload", "attempts", "created_at")
+
+    def __init__(self, seq, doc_no, payload, attempts, created_at):
+        self.seq = seq
+        self.doc_no = doc_no
+        self.payload = payload
+        self.attempts = attempts
+        self.created_at = created_at  # when the bill was queued, i.e. when the sale was made
+
+
+class SalesOutbox:
+    """Queued bills in one SQLite file, one connection per thread."""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._init_lock = threading.Lock()
+        self._ready = False
+        self._pending = None  # cached count of pending bills; None until first counted
+        self._stats = {"queued": 0, "sent": 0, "failed_attempts": 0, "last_replay_at": None, "last_error": None}
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            # A queued bill is the only copy of a sale, so it must survive a power cut
+            conn.execute("PRAGMA synchronous=FULL")
+            self._local.conn = conn
+        if not self._ready:
+            with self._init_lock:
+                if not self._ready:
+                    conn.executescript(SCHEMA)
+                    self._ready = True
+        return conn
+
+    def enqueue(self, doc_no, payload, idempotency_key=None):
+        """Queue a bill. Returns False if a bill with this doc_no or Idempotency-Key is already queued."""
+        cur = self._connect().execute(
+            "INSERT OR IGNORE INTO outbox (doc_no, idempotency_key, payload, created_at) VALUES (?, ?, ?, ?)",
+            (doc_no, idempotency_key, json.dumps(payload, ensure_ascii=False), time.time()),
+        )
+        if cur.rowcount == 0:
+            return False
+        self._stats["queued"] += 1
+        self._pending = None
+        return True
+
+    def find(self, idempotency_key):
+        """The bill queued (or sent) under idempotency_key, as a dict, or None."""
+        row = self._connect().execute(
+            "SELECT doc_no, sent_doc_no, status, payload FROM outbox WHERE idempotency_key = ?",
+            (idempotency_key,),
+        ).fetchone()
+        if row is None:
+            return None
+        return dict(row, payload=json.loads(row["payload"]))
+
+    def depth(self):
+        """Number of bills waiting to be sent."""
+        pending = self._pending
+        if pending is None:
+            pending = self._connect().execute("SELECT COUNT(*) FROM outbox WHERE status = 'pending'").fetchone()[0]
+            self._pending = pending
+        return pending
+
+    def pending(self, limit=BATCH_SIZE):
+        """The oldest `limit` pending bills, in the order they were taken."""
+        rows = self._connect().execute(
+            "SELECT seq, doc_no, payload, attempts, created_at FROM outbox WHERE status = 'pending' ORDER BY seq LIMIT ?",
+            (limit,),
+        )
+        return [
+            OutboxEntry(row["seq"], row["doc_no"], json.loads(row["payload"]), row["attempts"], row["created_at"])
+            for row in rows
+        ]
+
+    def mark_sent(self, sent):
+        """Record sent bills; `sent` maps seq to the bill number written (None if unknown)."""
+        if not sent:
+            return
+        now = time.time()
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany(
+                "UPDATE outbox SET status = 'sent', sent_at = ?, sent_doc_no = ? WHERE seq = ?",
+                [(now, doc_no, seq) for seq, doc_no in sent.items()],
+            )
+            conn.execute("DELETE FROM outbox WHERE status = 'sent' AND sent_at < ?", (now - SENT_RETENTION_SECONDS,))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        self._stats["sent"] += len(sent)
+        self._stats["last_replay_at"] = now
+        self._pending = None
+
+    def mark_failed(self, seq, error):
+        """Set aside a bill the database rejected, so later bills can go."""
+        self._connect().execute(
+            "UPDATE outbox SET attempts = attempts + 1, last_error = ?, status = 'failed' WHERE seq = ?",
+            (str(error), seq),
+        )
+        self._stats["failed_attempts"] += 1
+        self._stats["last_error"] = str(error)
+        self._pending = None
+
+    def failed(self):
+        """Bills the database rejected, for manual review."""
+        rows = self._connect().execute(
+            "SELECT seq, doc_no, attempts, last_error, created_at FROM outbox WHERE status = 'failed' ORDER BY seq"
+        )
+        return [dict(row) for row in rows]
+
+    def retry_failed(self):
+        """Put set-aside bills back in the queue; returns how many."""
+        cur = self._connect().execute("UPDATE outbox SET status = 'pending' WHERE status = 'failed'")
+        self._pending = None
+        return cur.rowcount
+
+    def stats(self):
+        conn = self._connect()
+        counts = dict(conn.execute("SELECT status, COUNT(*) FROM outbox GROUP BY status").fetchall())
+        oldest = conn.execute("SELECT MIN(created_at) FROM outbox WHERE status = 'pending'").fetchone()[0]
+        stats = dict(self._stats)
+        stats.update({
+            "pending": counts.get("pending", 0),
+            "failed": counts.get("failed", 0),
+            "sent_kept": counts.get("sent", 0),
+            # How far the database is behind the tills
+            "lag_seconds": round(time.time() - oldest, 1) if oldest else 0,
+        })
+        return stats
+
+
+class LinkMonitor:
+    """Tracks whether the database link is fast enough to bill online."""
+
+    def __init__(self, pool, latency_budget_ms=LATENCY_BUDGET_MS):
+        self.pool = pool
+        self.latency_budget_ms = latency_budget_ms
+        self.healthy = True
+        self.last_rtt_ms = None
+        self.down_since = None
+        self.last_error = None
+
+    def probe(self):
+        """Time a `SELECT 1`; returns whether the link is healthy."""
+        started = time.monotonic()
+        try:
+            conn = self.pool.getconn()
+            try:
+                with conn.cursor() as cur:
+                    cur.execute("SELECT 1")
+                    cur.fetchone()
+                conn.rollback()
+            finally:
+                self.pool.putconn(conn)
+        except Exception as e:
+            self.mark_down(e)
+            return False
+        self.last_rtt_ms = round((time.monotonic() - started) * 1000, 1)
+        if self.last_rtt_ms > self.latency_budget_ms:
+            self.mark_down(f"round trip {self.last_rtt_ms} ms over the {self.latency_budget_ms} ms budget")
+            return False
+        if not self.healthy:
+            print(f"Database link recovered after {round(time.time() - self.down_since)}s")
+        self.healthy = True
+        self.down_since = None
+        return True
+
+    def mark_down(self, error):
+        if self.healthy:
+            print(f"Database link down, billing to the local outbox: {error}")
+            self.down_since = time.time()
+        self.healthy = False
+        self.last_error = str(error)
+
+    def stats(self):
+        return {
+            "healthy": self.healthy,
+            "last_rtt_ms": self.last_rtt_ms,
+            "latency_budget_ms": self.latency_budget_ms,
+            "down_seconds": round(time.time() - self.down_since, 1) if self.down_since else 0,
+            "last_error": self.last_error,
+        }
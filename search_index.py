@@ -0,0 +1,260 @@
+"""In-process n-gram search index over codes, names and barcodes.
+
+Lao is written without spaces between words, so word or prefix indexes miss
+most matches. Every field is cut into overlapping character trigrams
+instead; a query is answered by intersecting the posting sets of its own
+trigrams and verifying the few candidates with a substring check, which
+gives the same results as `ILIKE '%term%'` without scanning every item.
+"""
+import bisect
+import threading
+import unicodedata
+
+# Match ranks, best first
+RANK_EXACT_CODE = 0      # code or barcode equals the query (scanner hits)
+RANK_CODE_PREFIX = 1     # code or barcode starts with the query
+RANK_NAME_PREFIX = 2     # name starts with the query
+RANK_SUBSTRING = 3       # query appears anywhere in code, name or barcode
+
+
+def normalize(text):
+    """NFC, case-folded and without whitespace, so 'ນ້ຳ ດື່ມ' matches 'ນ້ຳດື່ມ'."""
+    if not text:
+        return ""
+    return "".join(unicodedata.normalize("NFC", str(text)).casefold().split())
+
+
+class NgramIndex:
+    """Trigram index keyed by item code.
+
+    Documents are (name, barcodes) per code; name may also be a tuple of
+    names (e.g. Lao and English), each of which ranks as a name prefix. sync() diffs a full catalog load
+    against the index and only re-indexes the items that changed. Sorted
+    code/barcode and name lists answer the prefix ranks with a binary search.
+    """
+
+    def __init__(self, gram_size=3):
+        self.gram_size = gram_size
+        self.loaded = False
+        self._docs = {}       # code -> (source, blob, code_keys, name_norms)
+        self._postings = {}   # gram -> set of codes
+        self._exact = {}      # normalized code/barcode -> set of codes
+        self._code_keys = []  # sorted (normalized code/barcode, code)
+        self._name_keys = []  # sorted (normalized name, code)
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._docs)
+
+    def __contains__(self, code):
+        return code in self._docs
+
+    def _grams(self, text):
+        n = self.gram_size
+        if len(text) <= n:
+            return {text} if text else set()
+        return {text[i:i + n] for i in range(len(text) - n + 1)}
+
+    def _doc_grams(self, code_keys, name_norms):
+        grams = set()
+        for key in code_keys + name_norms:
+            grams |= self._grams(key)
+        return grams
+
+    def _unindex(self, code):
+        _, _, code_keys, name_norms = self._docs.pop(code)
+        for gram in self._doc_grams(code_keys, name_norms):
+            postings = self._postings.get(gram)
+            if postings is not None:
+                postings.discard(code)
+                if not postings:
+                    del self._postings[gram]
+        for key in code_keys:
+            codes = self._exact.get(key)
+            if codes is not None:
+                codes.discard(code)
+                if not codes:
+                    del self._exact[key]
+            _remove_sorted(self._code_keys, (key, code))
+        for name_norm in name_norms:
+            _remove_sorted(self._name_keys, (name_norm, code))
+
+    def upsert(self, code, name, barcodes=()):
+        """Add or re-index one item. Returns False if nothing changed."""
+        source = _source(name, barcodes)
+        with self._lock:
+            old = self._docs.get(code)
+            if old is not None and old[0] == source:
+                return False
+            if old is not None:
+                self._unindex(code)
+
+            code_keys, name_norms = _keys(code, source)
+            self._docs[code] = (source, "\x00".join(code_keys + name_norms), code_keys, name_norms)
+
+            for gram in self._doc_grams(code_keys, name_norms):
+                self._postings.setdefault(gram, set()).add(code)
+            for key in code_keys:
+                self._exact.setdefault(key, set()).add(code)
+                bisect.insort(self._code_keys, (key, code))
+            for name_norm in name_norms:
+                bisect.insort(self._name_keys, (name_norm, code))
+            return True
+
+    def remove(self, code):
+        with self._lock:
+            if code not in self._docs:
+                return False
+            self._unindex(code)
+            return True
+
+    def sync(self, docs):
+        """Bring the index in line with a full catalog {code: (name, barcodes)}.
+
+        Returns (changed, removed) counts.
+        """
+        changed = removed = 0
+        with self._lock:
+            if not self._docs:
+                return self._bulk_load(docs), 0
+            for code in [code for code in self._docs if code not in docs]:
+                removed += self.remove(code)
+            for code, (name, barcodes) in docs.items():
+                changed += self.upsert(code, name, barcodes)
+            self.loaded = True
+        return changed, removed
+
+    def _bulk_load(self, docs):
+        # First load: append everything, then sort once instead of insort per item
+        code_keys_list, name_keys_list = [], []
+        for code, (name, barcodes) in docs.items():
+            source = _source(name, barcodes)
+            code_keys, name_norms = _keys(code, source)
+            self._docs[code] = (source, "\x00".join(code_keys + name_norms), code_keys, name_norms)
+            for gram in self._doc_grams(code_keys, name_norms):
+                self._postings.setdefault(gram, set()).add(code)
+            for key in code_keys:
+                self._exact.setdefault(key, set()).add(code)
+                code_keys_list.append((key, code))
+            name_keys_list.extend((name_norm, code) for name_norm in name_norms)
+        self._code_keys = sorted(code_keys_list)
+        self._name_keys = sorted(name_keys_list)
+        self.loaded = True
+        return len(docs)
+
+    def _candidates(self, query):
+        if len(query) < self.gram_size:
+            # Too short to have a trigram; a substring check per item is still fast
+            return self._docs.keys()
+        posting_sets = []
+        for gram in self._grams(query):
+            postings = self._postings.get(gram)
+            if not postings:
+                return ()
+            posting_sets.append(postings)
+        posting_sets.sort(key=len)
+        candidates = set(posting_sets[0])
+        for postings in posting_sets[1:]:
+            candidates &= postings
+            if not candidates:
+                break
+        return candidates
+
+    def search(self, query):
+        """Every matching code mapped to its rank (lower is better)."""
+        query = normalize(query).replace("\x00", "")
+        if not query:
+            return {}
+        with self._lock:
+            docs = self._docs
+            ranks = {code: RANK_SUBSTRING for code in self._candidates(query) if query in docs[code][1]}
+            if not ranks:
+                return ranks
+            for _, code in _prefix_range(self._name_keys, query):
+                ranks[code] = RANK_NAME_PREFIX
+            for _, code in _prefix_range(self._code_keys, query):
+                ranks[code] = RANK_CODE_PREFIX
+            for code in self._exact.get(query, ()):
+                ranks[code] = RANK_EXACT_CODE
+            return ranks
+
+    def stats(self):
+        with self._lock:
+            return {
+                "items": len(self._docs),
+                "grams": len(self._postings),
+                "postings": sum(len(p) for p in self._postings.values()),
+                "loaded": self.loaded,
+            }
+
+
+def _source(name, barcodes):
+    names = (name,) if not isinstance(name, tuple) else name
+    return (tuple(n or "" for n in names), tuple(sorted(b for b in barcodes if b)))
+
+
+def _keys(code, source):
+    """Normalized (code and barcode keys, name keys) of a document source."""
+    names, barcodes = source
+    code_keys = tuple(dict.fromkeys(k for k in [normalize(code)] + [normalize(b) for b in barcodes] if k))
+    name_norms = tuple(dict.fromkeys(normalize(n) for n in names))
+    return code_keys, name_norms
+
+
+def _prefix_range(sorted_keys, prefix):
+    index = bisect.bisect_left(sorted_keys, (prefix,))
+    while index < len(sorted_keys) and sorted_keys[index][0].startswith(prefix):
+        yield sorted_keys[index]
+        index += 1
+
+
+def _remove_sorted(sorted_keys, key):
+    index = bisect.bisect_left(sorted_keys, key)
+    if index < len(sorted_keys) and sorted_keys[index] == key:
+        del sorted_keys[index]
+
+
+class BarcodeIndex:
+    """Exact barcode -> (ic_code, unit_code) hash lookups for scanner input.
+
+    load() builds new dicts and swaps them in, so lookups never block.
+    """
+
+    def __init__(self):
+        self.loaded = False
+        self._by_barcode = {}
+        self._first_by_code = {}
+
+    def load(self, barcode_rows):
+        """Rebuild from (ic_code, barcode, unit_code) rows."""
+        by_barcode = {}
+        first_by_code = {}
+        for row in barcode_rows:
+            ic_code, barcode, unit_code = row[0], row[1], row[2]
+            if not barcode:
+                continue
+            by_barcode.setdefault(barcode.strip(), (ic_code, unit_code))
+            first_by_code.setdefault(ic_code, barcode)
+        self._by_barcode = by_barcode
+        self._first_by_code = first_by_code
+        self.loaded = True
+
+    def lookup(self, barcode):
+        """(ic_code, unit_code) for an exact barcode, or None."""
+        return self._by_barcode.get(barcode.strip())
+
+    def first_barcode(self, ic_code):
+        return self._first_by_code.get(ic_code)
+
+    def __len__(self):
+        return len(self._by_barcode)
+
+
+def build_catalog_docs(item_rows, barcode_rows):
+    """{code: (name, [barcodes])} from (code, name_1) and (ic_code, barcode, ...) rows."""
+    docs = {row[0]: (row[1], []) for row in item_rows}
+    for row in barcode_rows:
+        ic_code, barcode = row[0], row[1]
+        if ic_code in docs and barcode:
+            docs[ic_code][1].append(barcode)
+    return docs
@@ -0,0 +1,135 @@
+"""Cached context a checkout needs: user profiles and currency exchange rates.
+
+Writing a bill needs the cashier's side/department from erp_user and the
+LAK rate from erp_currency. Both change rarely, so they are kept in
+memory: every user profile is loaded at startup, a profile is reloaded when
+its user logs in, and exchange rates are reloaded in the background every
+CURRENCY_RATE_TTL seconds or right away through invalidate_rates(). A
+checkout then reads them from memory only; on a cache miss it passes its own
+cursor, so a checkout that already holds a pooled connection never waits
+for a second one.
+"""
+import os
+import threading
+import time
+
+from psycopg2.extras import RealDictCursor
+
+# Seconds before cached profiles / exchange rates are reloaded
+USER_PROFILE_TTL = int(os.getenv("USER_PROFILE_TTL_SECONDS", 3600))
+CURRENCY_RATE_TTL = int(os.getenv("CURRENCY_RATE_TTL_SECONDS", 300))
+
+USER_PROFILE_QUERY = "SELECT code, name_1, side, department, ic_wht, ic_shelf FROM erp_user"
+CURRENCY_RATE_QUERY = "SELECT code, COALESCE(exchange_rate_present, 0) AS rate FROM erp_currency"
+
+
+class SessionContext:
+    """User profiles and exchange rates loaded through a pool with getconn()/putconn()."""
+
+    def __init__(self, pool, user_ttl=USER_PROFILE_TTL, rate_ttl=CURRENCY_RATE_TTL):
+        self.pool = pool
+        self.user_ttl = user_ttl
+        self.rate_ttl = rate_ttl
+        self._users = {}
+        self._users_loaded_at = 0
+        self._unknown_users = set()
+        self._rates = {}
+        self._rates_expire_at = 0
+        self._lock = threading.Lock()
+        self._refresh_thread = None
+        self._stats = {"user_hits": 0, "user_loads": 0, "rate_hits": 0, "rate_loads": 0}
+
+    def _query(self, query, params=None, cur=None):
+        """Rows as dicts, on `cur` (a RealDictCursor) if given, else on a pooled connection."""
+        if cur is not None:
+            cur.execute(query, params)
+            return [dict(row) for row in cur.fetchall()]
+        conn = self.pool.getconn()
+        try:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute(query, params)
+                return [dict(row) for row in cur.fetchall()]
+        finally:
+            self.pool.putconn(conn)
+
+    def load_users(self):
+        """Reload every erp_user profile."""
+        users = {row["code"]: row for row in self._query(USER_PROFILE_QUERY)}
+        with self._lock:
+            self._users = users
+            self._users_loaded_at = time.time()
+            self._unknown_users = set()
+        self._stats["user_loads"] += 1
+        return len(users)
+
+    def refresh_user(self, code, cur=None):
+        """Reload one profile, e.g. at login. Returns it, or None for an unknown user."""
+        rows = self._query(USER_PROFILE_QUERY + " WHERE code = %s LIMIT 1", (code,), cur)
+        profile = rows[0] if rows else None
+        with self._lock:
+            if profile is None:
+                self._users.pop(code, None)
+                self._unknown_users.add(code)
+            else:
+                self._users[code] = profile
+                self._unknown_users.discard(code)
+        self._stats["user_loads"] += 1
+        return profile
+
+    def user(self, code, cur=None):
+        """Cached profile of `code`; an unknown code is looked up once (on `cur` if given), then None."""
+        profile = self._users.get(code)
+        if profile is not None:
+            self._stats["user_hits"] += 1
+            return profile
+        # Not known at the last full load (a new user, or e.g. SYSTEM): looked up once until the next load
+        if code in self._unknown_users:
+            return None
+        return self.refresh_user(code, cur)
+
+    def load_rates(self, cur=None):
+        """Reload every currency's exchange rate."""
+        rates = {row["code"]: float(row["rate"]) for row in self._query(CURRENCY_RATE_QUERY, cur=cur)}
+        with self._lock:
+            self._rates = rates
+            self._rates_expire_at = time.time() + self.rate_ttl
+        self._stats["rate_loads"] += 1
+        return rates
+
+    def exchange_rate(self, currency_code, default=None, cur=None):
+        """Rate of `currency_code`, reloading the rates (on `cur` if given) only when they expired."""
+        if time.time() >= self._rates_expire_at:
+            self.load_rates(cur)
+        else:
+            self._stats["rate_hits"] += 1
+        return self._rates.get(currency_code, default)
+
+    def invalidate_rates(self):
+        """Reload exchange rates now, e.g. after the daily rate was entered."""
+        return self.load_rates()
+
+    def start_refresh_thread(self):
+        if self._refresh_thread is not None:
+            return
+
+        def refresh_loop():
+            while True:
+                try:
+                    if time.time() - self._users_loaded_at >= self.user_ttl:
+                        self.load_users()
+                    # Reload ahead of expiry so a checkout never waits for it
+                    if time.time() >= self._rates_expire_at - self.rate_ttl / 2:
+                        self.load_rates()
+                except Exception as e:
+                    print(f"Error refreshing session context: {e}")
+                time.sleep(max(1, min(self.rate_ttl, self.user_ttl) / 4))
+
+        self._refresh_thread = threading.Thread(target=refresh_loop, name="session-context-refresh", daemon=True)
+        self._refresh_thread.start()
+
+    def stats(self):
+        stats = dict(self._stats)
+        stats["users"] = len(self._users)
+        stats["rates"] = dict(self._rates)
+        stats["rates_expire_in"] = round(self._rates_expire_at - time.time(), 1)
+        return stats
@@ -145,7 +145,7 @@ const CheckPricePage = () => {
           item_name: product.item_name,
           price: parseFloat(product.price) || 0,
           unit_code: product.unit_code,
-          url_image: product.url_image || '',
+          url_image: product.url_image_medium || product.url_image || '',
           stock_quantity: parseInt(product.stock_quantity, 10) || 0,
           barcode: product.barcode || ''
         });
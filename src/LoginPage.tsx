@@ -26,6 +26,14 @@ function LoginPage() {
 
       if (response.ok) {
         localStorage.setItem('loggedInUser', JSON.stringify(data.user));
+        // Let the billing server cache this user's profile now instead of at the first checkout
+        fetch(`${import.meta.env.VITE_FLASK_API_URL}/session`, {
+          method: 'POST',
+          headers: {
+            'Content-Type': 'application/json',
+          },
+          body: JSON.stringify({ user_code: data.user.code }),
+        }).catch((err) => console.error('Session warm-up error:', err));
         navigate('/'); // Redirect to home page on successful login
       } else {
         setError(data.message || 'ເຂົ້າສູ່ລະບົບບໍ່ສຳເລັດ');
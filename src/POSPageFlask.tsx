@@ -3,12 +3,12 @@ import { Container, Row, Col, Card, Button, ListGroup, Form, Spinner, Alert, Nav
 import NavigationBar from './NavigationBar';
 import { useNavigate } from 'react-router-dom';
 import './POSPage.css';
+import { idempotentPost, newIdempotencyKey } from './idempotentPost';
 
 const ITEMS_PER_PAGE = 30;
 
 const DEFAULT_CUSTOMER_CODE = '01-0239';
 const DEFAULT_CUSTOMER_NAME = 'ລູກຄ້າທີ່ຮ້ານ';
-const WALK_IN_CUSTOMER_IDS = ['2012344321', '01-2125', '01-2127', '01-2126', '01-0239'];
 
 // Interface for Product and CartItem
 interface Product {
@@ -35,6 +35,7 @@ interface Category {
 interface Customer {
   code: string;
   name: string;
+  walk_in?: boolean;
 }
 
 // Helper function to safely format numbers
@@ -52,6 +53,7 @@ const POSPageFlask = () => {
   const [loadingMore, setLoadingMore] = useState<boolean>(false);
   const [error, setError] = useState<string | null>(null);
   const [offset, setOffset] = useState<number>(0);
+  const nextAfter = useRef<string | null>(null); // keyset cursor returned by /product
   const [hasMore, setHasMore] = useState<boolean>(true);
   
   const [searchTerm, setSearchTerm] = useState('');
@@ -103,6 +105,8 @@ const POSPageFlask = () => {
   const [selectedCategory, setSelectedCategory] = useState<string>('All');
   const [categoriesError, setCategoriesError] = useState<string | null>(null);
   const [customers, setCustomers] = useState<Customer[]>([]);
+  const [customerResults, setCustomerResults] = useState<Customer[]>([]);
+  const customerSearchTimeout = useRef<ReturnType<typeof setTimeout> | null>(null);
   const [selectedCustomer, setSelectedCustomer] = useState<string>(DEFAULT_CUSTOMER_CODE);
   const [warehouses, setWarehouses] = useState<any[]>([]);
   const [locations, setLocations] = useState<any[]>([]);
@@ -157,31 +161,16 @@ const POSPageFlask = () => {
     fetchWarehouses();
   }, []);
 
-  // Fetch customers
+  // Fetch walk-in customers (the server lists them in display order, default first)
   useEffect(() => {
     const fetchCustomers = async () => {
       try {
-        const response = await fetch(`${import.meta.env.VITE_FLASK_API_URL}/customer`);
+        const response = await fetch(`${import.meta.env.VITE_FLASK_API_URL}/customer/search`);
         if (!response.ok) {
           throw new Error(`HTTP error! status: ${response.status}`);
         }
         const data = await response.json();
-        let fetchedCustomers: Customer[] = data.list;
-
-        const walkInCustomers = fetchedCustomers.filter(c => WALK_IN_CUSTOMER_IDS.includes(c.code));
-        const otherCustomers = fetchedCustomers.filter(c => !WALK_IN_CUSTOMER_IDS.includes(c.code));
-
-        // Ensure DEFAULT_CUSTOMER_CODE is first among walk-in customers
-        walkInCustomers.sort((a, b) => {
-          if (a.code === DEFAULT_CUSTOMER_CODE) return -1;
-          if (b.code === DEFAULT_CUSTOMER_CODE) return 1;
-          return 0;
-        });
-
-        // Combine them: walk-in customers first, then others
-        const sortedCustomers = [...walkInCustomers, ...otherCustomers];
-
-        setCustomers(sortedCustomers);
+        setCustomers(data.list);
       } catch (e: any) {
         console.error("Failed to fetch customers:", e);
       }
@@ -190,6 +179,35 @@ const POSPageFlask = () => {
     fetchCustomers();
   }, []);
 
+  // Search other customers on the server (debounced)
+  useEffect(() => {
+    if (isWalkInMode) {
+      return;
+    }
+    if (customerSearchTimeout.current) {
+      clearTimeout(customerSearchTimeout.current);
+    }
+    customerSearchTimeout.current = setTimeout(async () => {
+      try {
+        const params = new URLSearchParams({ q: customerSearch.trim(), limit: '50', walk_in: '0' });
+        const response = await fetch(`${import.meta.env.VITE_FLASK_API_URL}/customer/search?${params.toString()}`);
+        if (!response.ok) {
+          throw new Error(`HTTP error! status: ${response.status}`);
+        }
+        const data = await response.json();
+        setCustomerResults(data.list);
+      } catch (e: any) {
+        console.error("Failed to search customers:", e);
+      }
+    }, 300);
+
+    return () => {
+      if (customerSearchTimeout.current) {
+        clearTimeout(customerSearchTimeout.current);
+      }
+    };
+  }, [customerSearch, isWalkInMode]);
+
   // Fetch locations when warehouse changes
   useEffect(() => {
     const fetchLocations = async () => {
@@ -237,6 +255,10 @@ const POSPageFlask = () => {
         params.append('category', selectedCategory);
       }
 
+      if (currentOffset > 0 && nextAfter.current) {
+        params.append('after', nextAfter.current);
+      }
+
       const response = await fetch(`${import.meta.env.VITE_FLASK_API_URL}/product?${params.toString()}`);
       if (!response.ok) {
         throw new Error(`HTTP error! status: ${response.status}`);
@@ -248,13 +270,14 @@ const POSPageFlask = () => {
         item_name: p.item_name,
         price: parseFloat(p.price) || 0,
         image: p.image,
-        url_image: p.url_image || '',
+        url_image: p.url_thumb || p.url_image || '',
         stock_quantity: parseInt(p.stock_quantity, 10) || 0,
         unit_code: p.unit_code,
         qty: 1
       }));
 
       setProducts(prev => currentOffset === 0 ? formattedProducts : [...prev, ...formattedProducts]);
+      nextAfter.current = data.next_after || null;
       setHasMore(data.list.length === ITEMS_PER_PAGE);
       setOffset(currentOffset + ITEMS_PER_PAGE);
 
@@ -358,17 +381,6 @@ const POSPageFlask = () => {
 
     setIsBilling(true);
     try {
-      const docNoResponse = await fetch(`${import.meta.env.VITE_FLASK_API_URL}/docno`);
-      if (!docNoResponse.ok) {
-        throw new Error('Failed to fetch document number.');
-      }
-      const docNoData = await docNoResponse.json();
-      const docNo = docNoData.docno;
-
-      if (!docNo) {
-        throw new Error('Invalid document number received from backend.');
-      }
-
       const loggedInUser = JSON.parse(localStorage.getItem('loggedInUser') || '{}');
       const userCode = loggedInUser.code || 'SYSTEM';
       const userWhCode = loggedInUser.ic_wht || selectedWarehouse;
@@ -376,7 +388,6 @@ const POSPageFlask = () => {
       const userBranchCode = loggedInUser.ic_branch || '00';
 
       const billingData = {
-        doc_no: docNo,
         doc_date: new Date().toISOString().split('T')[0],
         customer_code: selectedCustomer,
         total_amount: total,
@@ -391,13 +402,11 @@ const POSPageFlask = () => {
         branch_code: userBranchCode,
       };
 
-      const billingResponse = await fetch(`${import.meta.env.VITE_FLASK_API_URL}/posbilling`, {
-        method: 'POST',
-        headers: {
-          'Content-Type': 'application/json',
-        },
-        body: JSON.stringify(billingData),
-      });
+      // The bill number is assigned by the server when the bill is written and comes back as
+      // doc_no; the key identifies this checkout, so retries of it can never post it twice
+      const billingResponse = await idempotentPost(
+        `${import.meta.env.VITE_FLASK_API_URL}/posbilling`, billingData, newIdempotencyKey('posbilling')
+      );
 
       if (!billingResponse.ok) {
         const errorData = await billingResponse.json();
@@ -429,7 +438,12 @@ const POSPageFlask = () => {
       const savedReceipts = JSON.parse(localStorage.getItem('posReceiptsFlask') || '[]');
       localStorage.setItem('posReceiptsFlask', JSON.stringify([newReceipt, ...savedReceipts]));
 
-      showCustomToast(`ບິນໄດ້ຖືກບັນທຶກສຳເລັດ! ເລກບິນ: ${result.doc_no}`);
+      if (result.queued) {
+        // Saved on the POS server while the database is unreachable; it is sent automatically later
+        showCustomToast(`ບິນຖືກບັນທຶກໄວ້ໃນເຄື່ອງ ແລະ ຈະສົ່ງເມື່ອເຊື່ອມຕໍ່ໄດ້. ເລກບິນ: ${result.doc_no}`, 'warning');
+      } else {
+        showCustomToast(`ບິນໄດ້ຖືກບັນທຶກສຳເລັດ! ເລກບິນ: ${result.doc_no}`);
+      }
       
       setCart([]);
       setAmountReceived(0);
@@ -732,7 +746,7 @@ const POSPageFlask = () => {
                         className="flex-grow-1"
                       >
                         {customers
-                          .filter(c => WALK_IN_CUSTOMER_IDS.includes(c.code))
+                          .filter(c => c.walk_in)
                           .map(customer => (
                             <option key={customer.code} value={customer.code}>
                               {customer.name} ({customer.code})
@@ -781,19 +795,15 @@ const POSPageFlask = () => {
                   </div>
                   {!isWalkInMode && isCustomerDropdownOpen && (
                     <div className="customer-search-results">
-                      {customers
-                        .filter(c =>
-                          !WALK_IN_CUSTOMER_IDS.includes(c.code) && // Exclude walk-in customers from search results
-                          (c.name.toLowerCase().includes(customerSearch.toLowerCase()) ||
-                           c.code.toLowerCase().includes(customerSearch.toLowerCase()))
-                        )
-                        .slice(0, 50)
+                      {customerResults
                         .map(customer => (
                           <div
                             key={customer.code}
                             className="customer-search-item"
                             onClick={() => {
                               setSelectedCustomer(customer.code);
+                              // Keep the chosen customer so the receipt can show its name
+                              setCustomers(prev => prev.some(c => c.code === customer.code) ? prev : [...prev, customer]);
                               setCustomerSearch(`${customer.name} (${customer.code})`);
                               setIsCustomerDropdownOpen(false);
                             }}
@@ -3,6 +3,7 @@ import { Container, Row, Col, Table, Button, Form } from 'react-bootstrap';
 import { useNavigate, useLocation } from 'react-router-dom';
 import 'bootstrap/dist/css/bootstrap.min.css';
 import NavigationBar from './NavigationBar';
+import { idempotentPost, newIdempotencyKey } from './idempotentPost';
 import DatePicker from 'react-datepicker';
 import 'react-datepicker/dist/react-datepicker.css';
 
@@ -316,16 +317,7 @@ function RestockRequest() {
     }
 
     try {
-      // Generate transfer number from backend
-      const transferNoResponse = await fetch(`${import.meta.env.VITE_FASTAPI_URL}/api/generate-transfer-no`);
-      if (!transferNoResponse.ok) {
-        throw new Error('Failed to generate transfer number');
-      }
-      const transferNoData = await transferNoResponse.json();
-      const transferNo = transferNoData.transfer_no;
-
       const transferPayload = {
-        transfer_no: transferNo,
         creator: creatorCode,
         wh_from: sourceWarehouse,
         location_from: sourceLocation,
@@ -340,20 +332,19 @@ function RestockRequest() {
         })),
       };
 
-      const response = await fetch(`${import.meta.env.VITE_FASTAPI_URL}/api/transfers`, {
-        method: 'POST',
-        headers: {
-          'Content-Type': 'application/json',
-        },
-        body: JSON.stringify(transferPayload),
-      });
+      // The server assigns the transfer number when it writes the transfer; the key identifies
+      // this request, so retries of it can never create a second transfer
+      const response = await idempotentPost(
+        `${import.meta.env.VITE_FASTAPI_URL}/api/transfers`, transferPayload, newIdempotencyKey('transfer')
+      );
 
       if (!response.ok) {
         const errorData = await response.json();
         throw new Error(errorData.error || 'Failed to create transfer in database.');
       }
 
-      alert('ສ້າງໃບໂອນສຳເລັດ!');
+      const created = await response.json();
+      alert(`ສ້າງໃບໂອນສຳເລັດ! ${created.transfer_no}`);
       setRestockItems([]);
       navigate('/transfers');
 
@@ -67,6 +67,10 @@ const SalesHistoryPage = () => {
         offset: currentOffset.toString(),
       });
 
+      if (currentOffset > 0) {
+        // Total was returned with the first page
+        params.append('includeTotal', '0');
+      }
       if (dateFilter) {
         params.append('selectedDate', dateFilter);
       }
@@ -80,7 +84,7 @@ const SalesHistoryPage = () => {
       }
       const data = await response.json();
       const newSales: SalesHistoryItem[] = data.list;
-      const newTotalCount: number = data.totalCount;
+      const newTotalCount: number = data.totalCount ?? totalCount;
 
       setSalesHistory(prevSales => 
         currentOffset === 0 ? newSales : [...prevSales, ...newSales]
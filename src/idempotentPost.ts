@@ -0,0 +1,47 @@
+// POST with an Idempotency-Key header. A request that timed out or dropped is sent
+// again with the same key; the server answers a repeat with the first response
+// instead of writing the document twice, so retrying is always safe.
+// A new key per document. crypto.randomUUID is only available on https pages and
+// localhost, and tills reach the server over plain http on the shop network.
+export function newIdempotencyKey(prefix: string): string {
+  const random = typeof crypto !== 'undefined' && typeof crypto.randomUUID === 'function'
+    ? crypto.randomUUID()
+    : `${Date.now().toString(36)}-${Math.random().toString(36).slice(2)}${Math.random().toString(36).slice(2)}`;
+  return `${prefix}-${random}`;
+}
+
+export async function idempotentPost(
+  url: string,
+  body: unknown,
+  idempotencyKey: string,
+  { attempts = 3, timeoutMs = 10000 } = {}
+): Promise<Response> {
+  let lastError: unknown = null;
+  for (let attempt = 1; attempt <= attempts; attempt++) {
+    const controller = new AbortController();
+    const timer = setTimeout(() => controller.abort(), timeoutMs);
+    try {
+      const response = await fetch(url, {
+        method: 'POST',
+        headers: {
+          'Content-Type': 'application/json',
+          'Idempotency-Key': idempotencyKey,
+        },
+        body: JSON.stringify(body),
+        signal: controller.signal,
+      });
+      // 409: the first attempt is still being written; ask again shortly
+      if (response.status !== 409 || attempt === attempts) {
+        return response;
+      }
+    } catch (error) {
+      lastError = error;
+    } finally {
+      clearTimeout(timer);
+    }
+    if (attempt < attempts) {
+      await new Promise(resolve => setTimeout(resolve, 500 * attempt));
+    }
+  }
+  throw lastError;
+}
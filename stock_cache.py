@@ -0,0 +1,353 @@
+"""In-memory stock snapshots for sml_ic_function_stock_balance_warehouse_location.
+
+The SML stock function evaluates the whole ledger, so running it on every
+product page or search keystroke is far too slow. Each (whcode, loccode) pair
+gets a snapshot that is loaded once, refreshed in the background and patched
+in place when a bill or transfer commits.
+
+Writers announce committed stock movements with NOTIFY on STOCK_CHANNEL so
+that every service holding snapshots (Flask POS, check price API) can patch
+its own copy, including movements written by another process.
+"""
+import json
+import os
+import select
+import threading
+import time
+import uuid
+from decimal import Decimal
+
+STOCK_CHANNEL = "pos_stock_movement"
+
+# Seconds between background reloads of each snapshot in use
+REFRESH_INTERVAL = int(os.getenv("STOCK_CACHE_REFRESH_SECONDS", 60))
+
+# Identifies this process in NOTIFY payloads so it can skip its own movements
+PROCESS_ID = uuid.uuid4().hex
+
+# Postgres rejects NOTIFY payloads of 8000 bytes or more
+_MAX_PAYLOAD_BYTES = 7000
+
+
+def _to_decimal(value):
+    if isinstance(value, Decimal):
+        return value
+    return Decimal(str(value or 0))
+
+
+class StockSnapshot:
+    """Stock balances of one warehouse/location, keyed by ic_code.
+
+    Rows are never mutated in place: a patch swaps in a new row dict, and adding
+    a new item swaps in a new items dict, so readers iterating over `items`
+    never see a half-applied change. `category_counts` (distinct in-stock
+    items per category_name) is swapped the same way whenever it changes.
+    """
+
+    def __init__(self, whcode, loccode, rows):
+        self.whcode = whcode
+        self.loccode = loccode
+        self.items = {}
+        for row in rows:
+            row = dict(row)
+            row["balance_qty"] = _to_decimal(row.get("balance_qty"))
+            # Several rows of one item are summed, as stock_history does
+            existing = self.items.get(row["ic_code"])
+            if existing is not None:
+                row["balance_qty"] += existing["balance_qty"]
+            self.items[row["ic_code"]] = row
+        self.loaded_at = time.time()
+        self.version = 0
+
+        category_counts = {}
+        for row in self.items.values():
+            category = row.get("category_name")
+            if category is not None and row["balance_qty"] > 0:
+                category_counts[category] = category_counts.get(category, 0) + 1
+        self.category_counts = category_counts
+        self._ordered = None
+
+    def _update_category_count(self, old_row, new_row):
+        category = new_row.get("category_name")
+        if category is None:
+            return
+        was_in_stock = old_row is not None and old_row["balance_qty"] > 0
+        is_in_stock = new_row["balance_qty"] > 0
+        if was_in_stock == is_in_stock:
+            return
+        counts = dict(self.category_counts)
+        counts[category] = counts.get(category, 0) + (1 if is_in_stock else -1)
+        if counts[category] <= 0:
+            del counts[category]
+        self.category_counts = counts
+
+    def ordered_keys(self):
+        """(ic_name, ic_code) of every item, sorted; rebuilt only when items are added."""
+        items = self.items
+        cached = self._ordered
+        if cached is None or cached[0] is not items:
+            cached = (items, sorted((row["ic_name"] or "", code) for code, row in items.items()))
+            self._ordered = cached
+        return cached[1]
+
+    def in_stock(self):
+        """Rows with a positive balance, like `WHERE balance_qty > 0`."""
+        return [row for row in self.items.values() if row["balance_qty"] > 0]
+
+    def apply(self, ic_code, delta, ic_name=None, ic_unit_code=None):
+        row = self.items.get(ic_code)
+        if row is not None:
+            new_row = {**row, "balance_qty": row["balance_qty"] + delta}
+            self.items[ic_code] = new_row
+        else:
+            # Category is unknown for an item new to this shelf; the next refresh fills it in
+            new_row = {
+                "ic_code": ic_code,
+                "ic_name": ic_name or "",
+                "ic_unit_code": ic_unit_code or "",
+                "balance_qty": delta,
+            }
+            items = dict(self.items)
+            items[ic_code] = new_row
+            self.items = items
+        self._update_category_count(row, new_row)
+        self.version += 1
+
+
+class StockSnapshotCache:
+    """Snapshots for every (whcode, loccode) that has been read recently.
+
+    Snapshots that have not been read for idle_ttl seconds are dropped instead
+    of being refreshed, so only warehouses that terminals actually use cost a
+    run of the stock function per refresh interval.
+    """
+
+    def __init__(self, refresh_interval=60, idle_ttl=1800):
+        self.refresh_interval = refresh_interval
+        self.idle_ttl = idle_ttl
+        self._snapshots = {}
+        self._last_access = {}
+        self._lock = threading.RLock()
+        self._load_locks = {}
+        self._refresh_thread = None
+        self._stats = {"hits": 0, "misses": 0, "loads": 0, "load_errors": 0,
+                       "load_time_total": 0.0, "movements_applied": 0}
+
+    def get(self, whcode, loccode):
+        """Return the cached snapshot or None, without loading."""
+        key = (whcode, loccode)
+        with self._lock:
+            snapshot = self._snapshots.get(key)
+            if snapshot is not None:
+                self._last_access[key] = time.monotonic()
+            return snapshot
+
+    def put(self, whcode, loccode, rows):
+        """Replace the snapshot for a warehouse/location with freshly loaded rows."""
+        snapshot = StockSnapshot(whcode, loccode, rows)
+        with self._lock:
+            self._snapshots[(whcode, loccode)] = snapshot
+            self._last_access.setdefault((whcode, loccode), time.monotonic())
+        return snapshot
+
+    def get_or_load(self, whcode, loccode, loader):
+        """Return the snapshot, loading it with loader(whcode, loccode) on a miss.
+
+        Concurrent misses for the same key wait for a single load.
+        """
+        snapshot = self.get(whcode, loccode)
+        if snapshot is not None:
+            self._stats["hits"] += 1
+            return snapshot
+
+        key = (whcode, loccode)
+        with self._lock:
+            load_lock = self._load_locks.setdefault(key, threading.Lock())
+        with load_lock:
+            snapshot = self.get(whcode, loccode)
+            if snapshot is not None:
+                self._stats["hits"] += 1
+                return snapshot
+            self._stats["misses"] += 1
+            return self.load(whcode, loccode, loader)
+
+    def load(self, whcode, loccode, loader):
+        started = time.monotonic()
+        try:
+            rows = loader(whcode, loccode)
+        except Exception:
+            self._stats["load_errors"] += 1
+            raise
+        self._stats["loads"] += 1
+        self._stats["load_time_total"] += time.monotonic() - started
+        return self.put(whcode, loccode, rows)
+
+    def keys_to_refresh(self):
+        """Keys still in use; idle snapshots are evicted here."""
+        now = time.monotonic()
+        with self._lock:
+            for key, last_access in list(self._last_access.items()):
+                if now - last_access > self.idle_ttl:
+                    self._snapshots.pop(key, None)
+                    self._last_access.pop(key, None)
+            return list(self._snapshots.keys())
+
+    def apply_movements(self, movements):
+        """Patch cached balances with committed movements.
+
+        Each movement is a dict with wh_code, shelf_code, item_code and a signed
+        qty, plus optional item_name/unit_code used when the item is new to
+        the snapshot. Movements for uncached locations are ignored; they are
+        picked up by the first load.
+
+        A refresh that was already running when a movement committed may
+        overwrite the patch with a pre-commit balance; the next refresh
+        corrects it, so drift is bounded by one refresh interval.
+        """
+        with self._lock:
+            for movement in movements:
+                snapshot = self._snapshots.get((movement["wh_code"], movement["shelf_code"]))
+                if snapshot is None:
+                    continue
+                snapshot.apply(
+                    movement["item_code"],
+                    _to_decimal(movement["qty"]),
+                    movement.get("item_name"),
+                    movement.get("unit_code"),
+                )
+                self._stats["movements_applied"] += 1
+
+    def set_field(self, ic_code, field, value):
+        """Update a non-stock field (e.g. url_image) of an item in every snapshot."""
+        with self._lock:
+            for snapshot in self._snapshots.values():
+                row = snapshot.items.get(ic_code)
+                if row is not None:
+                    snapshot.items[ic_code] = {**row, field: value}
+                    snapshot.version += 1
+
+    def invalidate_all(self):
+        with self._lock:
+            self._snapshots.clear()
+
+    def start_refresh_thread(self, loader):
+        """Refresh every snapshot in use every refresh_interval seconds."""
+        if self._refresh_thread is not None:
+            return
+
+        def refresh_loop():
+            while True:
+                time.sleep(self.refresh_interval)
+                for whcode, loccode in self.keys_to_refresh():
+                    try:
+                        self.load(whcode, loccode, loader)
+                    except Exception as e:
+                        print(f"Error refreshing stock snapshot {whcode}/{loccode}: {e}")
+
+        self._refresh_thread = threading.Thread(target=refresh_loop, name="stock-snapshot-refresh", daemon=True)
+        self._refresh_thread.start()
+
+    def stats(self):
+        with self._lock:
+            snapshots = [
+                {
+                    "whcode": snapshot.whcode,
+                    "loccode": snapshot.loccode,
+                    "items": len(snapshot.items),
+                    "age_seconds": round(time.time() - snapshot.loaded_at, 1),
+                    "version": snapshot.version,
+                }
+                for snapshot in self._snapshots.values()
+            ]
+        stats = dict(self._stats)
+        stats["refresh_interval"] = self.refresh_interval
+        stats["snapshots"] = snapshots
+        return stats
+
+
+def encode_movements(movements):
+    """Split movements into NOTIFY payloads that fit the Postgres size limit."""
+    payloads = []
+    chunk = []
+    for movement in movements:
+        chunk.append({
+            "wh_code": movement["wh_code"],
+            "shelf_code": movement["shelf_code"],
+            "item_code": movement["item_code"],
+            "qty": str(movement["qty"]),
+            "item_name": movement.get("item_name"),
+            "unit_code": movement.get("unit_code"),
+        })
+        payload = json.dumps({"origin": PROCESS_ID, "movements": chunk}, ensure_ascii=False)
+        if len(payload.encode("utf-8")) > _MAX_PAYLOAD_BYTES and len(chunk) > 1:
+            last = chunk.pop()
+            payloads.append(json.dumps({"origin": PROCESS_ID, "movements": chunk}, ensure_ascii=False))
+            chunk = [last]
+    if chunk:
+        payloads.append(json.dumps({"origin": PROCESS_ID, "movements": chunk}, ensure_ascii=False))
+    return payloads
+
+
+def decode_movements(payload):
+    """Return the movements of a NOTIFY payload, or [] if it came from this process."""
+    message = json.loads(payload)
+    if message.get("origin") == PROCESS_ID:
+        return []
+    return message.get("movements", [])
+
+
+def notify_stock_movements(cursor, movements):
+    """Queue NOTIFYs on the current transaction; they are delivered on commit."""
+    for payload in encode_movements(movements):
+        cursor.execute("SELECT pg_notify(%s, %s)", (STOCK_CHANNEL, payload))
+
+
+def start_movement_listener(cache, connect, channel=STOCK_CHANNEL):
+    """LISTEN for stock movements from other processes and patch the cache.
+
+    Runs on a dedicated connection (never a pooled one). Notifications sent
+    while disconnected are lost, so every snapshot is dropped once a
+    reconnect has succeeded; while the database cannot be reached the stale
+    snapshots keep being served.
+    """
+
+    def listen_loop():
+        disconnected = False
+        while True:
+            conn = None
+            try:
+                conn = connect()
+                conn.autocommit = True
+                with conn.cursor() as cur:
+                    cur.execute(f"LISTEN {channel}")
+                if disconnected:
+                    cache.invalidate_all()
+                    disconnected = False
+                while True:
+                    if select.select([conn], [], [], 60) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        notify = conn.notifies.pop(0)
+                        try:
+                            movements = decode_movements(notify.payload)
+                        except ValueError as e:
+                            print(f"Ignoring malformed stock movement payload: {e}")
+                            continue
+                        if movements:
+                            cache.apply_movements(movements)
+            except Exception as e:
+                print(f"Stock movement listener error, reconnecting: {e}")
+                disconnected = True
+                time.sleep(5)
+            finally:
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+
+    thread = threading.Thread(target=listen_loop, name="stock-movement-listener", daemon=True)
+    thread.start()
+    return thread
+
@@ -0,0 +1,304 @@
+"""Daily stock balance snapshots and balance-at-date queries.
+
+sml_ic_function_stock_balance_warehouse_location replays the whole ledger on
+every call, so each "balance at date D" question costs a full history scan.
+take_snapshot() stores the closing balance of every item per
+(warehouse, shelf) for one day in pos_stock_daily_balance (non-zero rows
+only). balance_source() then answers a balance at a past day D as the latest
+snapshot on or before D plus the ic_trans_detail movements after it, which is
+about one day of deltas when snapshots are taken nightly. Balances of today
+always come from the SML function.
+
+Movements skip cancelled lines (last_status <> 0) as the SML function does.
+A document dated on or before a snapshot that is entered, edited or
+cancelled after the snapshot was taken makes that snapshot stale: reads
+skip stale snapshots (using an older one, or the SML function), and
+repair_stale_snapshots() re-takes them. Documents are matched by
+GREATEST(create_datetime, lastedit_datetime) on ic_trans, so every writer
+must set one of them to the time it writes. The expression index behind
+that match is created once with create_entered_index(), see
+create_stock_history_index.py.
+
+The SML function can return several rows for one item; they are summed per
+ic_code everywhere (snapshots, function reads and stock_cache).
+
+Locations without a usable snapshot fall back to the SML function, so
+results are always available; snapshots only make them cheaper.
+"""
+from datetime import date, timedelta
+
+# Documents entered up to this long before a snapshot may still have been
+# uncommitted when it was read, so they also make it stale
+SNAPSHOT_ENTRY_MARGIN_SECONDS = 300
+# Stale snapshots of the last REPAIR_DAYS days are re-taken; older ones are dropped
+REPAIR_DAYS = 7
+
+SNAPSHOT_DDL = """
+    CREATE TABLE IF NOT EXISTS pos_stock_daily_balance (
+        balance_date date NOT NULL,
+        wh_code varchar(50) NOT NULL,
+        shelf_code varchar(50) NOT NULL,
+        ic_code varchar(50) NOT NULL,
+        ic_name varchar(255),
+        ic_unit_code varchar(50),
+        balance_qty numeric NOT NULL,
+        PRIMARY KEY (wh_code, shelf_code, balance_date, ic_code)
+    );
+    CREATE TABLE IF NOT EXISTS pos_stock_snapshot_run (
+        balance_date date NOT NULL,
+        wh_code varchar(50) NOT NULL,
+        shelf_code varchar(50) NOT NULL,
+        item_count integer NOT NULL,
+        created_at timestamp NOT NULL DEFAULT now(),
+        PRIMARY KEY (wh_code, shelf_code, balance_date)
+    );
+"""
+
+# Index behind the staleness checks. Building it locks ic_trans against writes
+# unless it is built CONCURRENTLY, which cannot run inside a transaction, so it
+# is created once by create_stock_history_index.py instead of at startup.
+ENTERED_INDEX_NAME = "pos_ic_trans_entered_idx"
+ENTERED_INDEX_DDL = f"""
+    CREATE INDEX CONCURRENTLY IF NOT EXISTS {ENTERED_INDEX_NAME}
+        ON ic_trans ((GREATEST(create_datetime, lastedit_datetime)))
+"""
+
+# Signed stock movements per line in standard units. Transfers (trans_flag 124)
+# move qty out of wh_code/shelf_code and into wh_code_2/shelf_code_2; every other
+# document moves calc_flag * qty at wh_code/shelf_code. Cancelled lines are skipped.
+_MOVEMENTS_SQL = """
+    SELECT item_code, item_name, unit_code,
+           CASE WHEN trans_flag = 124 THEN -qty ELSE COALESCE(calc_flag, 0) * qty END
+               * COALESCE(NULLIF(stand_value, 0), 1) / COALESCE(NULLIF(divide_value, 0), 1) AS qty
+    FROM ic_trans_detail
+    WHERE doc_date > %({p}snap)s AND doc_date <= %({p}day)s
+      AND wh_code = %({p}wh)s AND shelf_code = %({p}shelf)s
+      AND COALESCE(last_status, 0) = 0
+    UNION ALL
+    SELECT item_code, item_name, unit_code,
+           qty * COALESCE(NULLIF(stand_value, 0), 1) / COALESCE(NULLIF(divide_value, 0), 1) AS qty
+    FROM ic_trans_detail
+    WHERE trans_flag = 124
+      AND doc_date > %({p}snap)s AND doc_date <= %({p}day)s
+      AND wh_code_2 = %({p}wh)s AND shelf_code_2 = %({p}shelf)s
+      AND COALESCE(last_status, 0) = 0
+"""
+
+# True for a snapshot run `r` when a document dated on or before it, touching
+# its location, was entered or changed after it was taken
+_STALE_SQL = """
+    EXISTS (
+        SELECT 1
+        FROM ic_trans t
+        JOIN ic_trans_detail d ON d.doc_no = t.doc_no AND d.trans_flag = t.trans_flag
+        WHERE GREATEST(t.create_datetime, t.lastedit_datetime)
+                  >= r.created_at - interval '{margin} seconds'
+          AND t.doc_date <= r.balance_date
+          AND ((d.wh_code = r.wh_code AND d.shelf_code = r.shelf_code)
+               OR (d.trans_flag = 124 AND d.wh_code_2 = r.wh_code AND d.shelf_code_2 = r.shelf_code))
+    )
+""".format(margin=SNAPSHOT_ENTRY_MARGIN_SECONDS)
+
+_SNAPSHOT_PLUS_DELTAS_SQL = """
+    SELECT ic_code, MAX(ic_name) AS ic_name, MAX(ic_unit_code) AS ic_unit_code, SUM(balance_qty) AS balance_qty
+    FROM (
+        SELECT ic_code, ic_name, ic_unit_code, balance_qty
+        FROM pos_stock_daily_balance
+        WHERE balance_date = %({p}snap)s AND wh_code = %({p}wh)s AND shelf_code = %({p}shelf)s
+        UNION ALL
+        SELECT item_code, item_name, unit_code, qty
+        FROM ({movements}) m
+    ) b
+    GROUP BY ic_code
+"""
+
+_FUNCTION_SQL = """
+    SELECT ic_code, MAX(ic_name) AS ic_name, MAX(ic_unit_code) AS ic_unit_code, SUM(balance_qty) AS balance_qty
+    FROM sml_ic_function_stock_balance_warehouse_location(%({p}day)s, '', %({p}wh)s, %({p}shelf)s)
+    GROUP BY ic_code
+"""
+
+
+def ensure_tables(cur):
+    """Create the pos_* snapshot tables; ic_trans is left to create_entered_index()."""
+    cur.execute(SNAPSHOT_DDL)
+
+
+def create_entered_index(conn):
+    """Build the ic_trans index used by the staleness checks without blocking writes.
+
+    A CONCURRENTLY build that failed half way leaves an invalid index behind,
+    which IF NOT EXISTS would keep; it is dropped and rebuilt. Returns True if
+    the index was (re)built.
+    """
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        cur.execute(
+            "SELECT i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid WHERE c.relname = %s",
+            (ENTERED_INDEX_NAME,),
+        )
+        row = cur.fetchone()
+        if row is not None and row[0]:
+            return False
+        if row is not None:
+            cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {ENTERED_INDEX_NAME}")
+        cur.execute(ENTERED_INDEX_DDL)
+    return True
+
+
+def latest_snapshot_dates(cur, day, locations):
+    """{(wh_code, shelf_code): latest usable snapshot date <= day} for the given locations.
+
+    Stale snapshots are skipped; the newest one is checked first, so this
+    normally looks at a single snapshot per location.
+    """
+    if not locations:
+        return {}
+    cur.execute(
+        f"""
+        SELECT l.wh_code, l.shelf_code, s.balance_date
+        FROM unnest(%s::varchar[], %s::varchar[]) AS l(wh_code, shelf_code)
+        CROSS JOIN LATERAL (
+            SELECT r.balance_date
+            FROM pos_stock_snapshot_run r
+            WHERE r.wh_code = l.wh_code AND r.shelf_code = l.shelf_code AND r.balance_date <= %s
+              AND NOT {_STALE_SQL}
+            ORDER BY r.balance_date DESC
+            LIMIT 1
+        ) s
+        """,
+        ([wh for wh, _ in locations], [shelf for _, shelf in locations], day),
+    )
+    return {(row[0], row[1]): row[2] for row in cur.fetchall()}
+
+
+def stale_snapshots(cur, since):
+    """(balance_date, wh_code, shelf_code) of stale snapshots dated on or after `since`."""
+    cur.execute(
+        f"""
+        SELECT r.balance_date, r.wh_code, r.shelf_code
+        FROM pos_stock_snapshot_run r
+        WHERE r.balance_date >= %s AND {_STALE_SQL}
+        ORDER BY r.balance_date, r.wh_code, r.shelf_code
+        """,
+        (since,),
+    )
+    return [(row[0], row[1], row[2]) for row in cur.fetchall()]
+
+
+def balance_source(prefix, day, wh_code, shelf_code, snapshot_date=None):
+    """SQL and named params yielding (ic_code, ic_name, ic_unit_code, balance_qty) at `day`.
+
+    `prefix` keeps the parameter names of several sources in one query apart.
+    Without a snapshot the SML function is used.
+    """
+    params = {f"{prefix}day": day, f"{prefix}wh": wh_code, f"{prefix}shelf": shelf_code}
+    if snapshot_date is None:
+        return _FUNCTION_SQL.format(p=prefix), params
+    params[f"{prefix}snap"] = snapshot_date
+    movements = _MOVEMENTS_SQL.format(p=prefix)
+    return _SNAPSHOT_PLUS_DELTAS_SQL.format(p=prefix, movements=movements), params
+
+
+def balances_at(cur, day, wh_code, shelf_code):
+    """Rows of (ic_code, ic_name, ic_unit_code, balance_qty) at the end of `day`.
+
+    Only past days use snapshots; today is answered by the SML function.
+    """
+    snapshot_date = None
+    if day < date.today():
+        snapshot_date = latest_snapshot_dates(cur, day, [(wh_code, shelf_code)]).get((wh_code, shelf_code))
+    sql, params = balance_source("b_", day, wh_code, shelf_code, snapshot_date)
+    cur.execute(sql, params)
+    return cur.fetchall()
+
+
+def snapshot_locations(cur):
+    """Every (whcode, shelf code) pair in ic_shelf."""
+    cur.execute("SELECT whcode, code FROM ic_shelf ORDER BY whcode, code")
+    return [(row[0], row[1]) for row in cur.fetchall()]
+
+
+def take_snapshot(conn, day=None, locations=None):
+    """Store closing balances of `day` (default yesterday) for each location.
+
+    Each location is replaced and committed on its own, so a rerun repairs a
+    partial run. Only finished days can be snapshotted. Returns the number of
+    locations written.
+    """
+    day = day or date.today() - timedelta(days=1)
+    if day >= date.today():
+        raise ValueError("Only days before today can be snapshotted")
+
+    with conn.cursor() as cur:
+        ensure_tables(cur)
+        if locations is None:
+            locations = snapshot_locations(cur)
+    conn.commit()
+
+    written = 0
+    for wh_code, shelf_code in locations:
+        try:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "DELETE FROM pos_stock_daily_balance WHERE balance_date = %s AND wh_code = %s AND shelf_code = %s",
+                    (day, wh_code, shelf_code),
+                )
+                cur.execute(
+                    """
+                    INSERT INTO pos_stock_daily_balance
+                        (balance_date, wh_code, shelf_code, ic_code, ic_name, ic_unit_code, balance_qty)
+                    SELECT %s, %s, %s, ic_code, MAX(ic_name), MAX(ic_unit_code), SUM(balance_qty)
+                    FROM sml_ic_function_stock_balance_warehouse_location(%s, '', %s, %s)
+                    GROUP BY ic_code
+                    HAVING SUM(balance_qty) <> 0
+                    """,
+                    (day, wh_code, shelf_code, day, wh_code, shelf_code),
+                )
+                item_count = cur.rowcount
+                cur.execute(
+                    """
+                    INSERT INTO pos_stock_snapshot_run (balance_date, wh_code, shelf_code, item_count)
+                    VALUES (%s, %s, %s, %s)
+                    ON CONFLICT (wh_code, shelf_code, balance_date)
+                    DO UPDATE SET item_count = EXCLUDED.item_count, created_at = now()
+                    """,
+                    (day, wh_code, shelf_code, item_count),
+                )
+            conn.commit()
+            written += 1
+        except Exception as e:
+            conn.rollback()
+            print(f"Error taking stock snapshot {wh_code}/{shelf_code} for {day}: {e}")
+    return written
+
+
+def repair_stale_snapshots(conn, today=None):
+    """Re-take stale snapshots of the last REPAIR_DAYS days and drop older stale ones.
+
+    Returns (re-taken, dropped) location counts.
+    """
+    today = today or date.today()
+    since = today - timedelta(days=REPAIR_DAYS)
+    with conn.cursor() as cur:
+        cur.execute(
+            f"""
+            DELETE FROM pos_stock_daily_balance b
+            USING pos_stock_snapshot_run r
+            WHERE b.balance_date = r.balance_date AND b.wh_code = r.wh_code AND b.shelf_code = r.shelf_code
+              AND r.balance_date < %s AND {_STALE_SQL}
+            """,
+            (since,),
+        )
+        cur.execute(f"DELETE FROM pos_stock_snapshot_run r WHERE r.balance_date < %s AND {_STALE_SQL}", (since,))
+        dropped = cur.rowcount
+        stale = stale_snapshots(cur, since)
+    conn.commit()
+
+    by_day = {}
+    for day, wh_code, shelf_code in stale:
+        by_day.setdefault(day, []).append((wh_code, shelf_code))
+    retaken = 0
+    for day, locations in sorted(by_day.items()):
+        retaken += take_snapshot(conn, day, locations)
+    return retaken, dropped